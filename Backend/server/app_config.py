@@ -1,4 +1,5 @@
 import os
+import json
 
 from dotenv import load_dotenv
 from src.db_instance import db
@@ -38,3 +39,79 @@ UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER")
 
 # S3 BUCKET
 S3_BUCKET_NAME= os.getenv("S3_BUCKET_NAME")
+
+# JOB SUBSYSTEM
+# Whether the web process runs jobs itself. Turn this off once jobs are run by `python -m src.worker` processes,
+# the web process then only enqueues them (needs the database queue)
+JOB_RUN_WORKERS = os.getenv("JOB_RUN_WORKERS", "true").lower() in ("1", "true", "yes")
+# Number of worker threads running generation jobs concurrently
+JOB_WORKER_COUNT = int(os.getenv("JOB_WORKER_COUNT", 4))
+# Worker threads of the other job pipeline stages: downloading PDFs, extracting their text, and saving the results.
+# JOB_WORKER_COUNT is the number generating (waiting on OpenAI)
+JOB_FETCH_WORKERS = int(os.getenv("JOB_FETCH_WORKERS", 2))
+JOB_EXTRACT_WORKERS = int(os.getenv("JOB_EXTRACT_WORKERS", 1))
+JOB_PERSIST_WORKERS = int(os.getenv("JOB_PERSIST_WORKERS", 2))
+# Jobs which may wait in front of each pipeline stage beyond one per worker, a full stage holds up the one before it
+JOB_STAGE_QUEUE_SIZE = int(os.getenv("JOB_STAGE_QUEUE_SIZE", 4))
+# Most finished jobs whose db rows are written in one transaction, and milliseconds the persist stage waits to gather them
+JOB_PERSIST_BATCH_SIZE = int(os.getenv("JOB_PERSIST_BATCH_SIZE", 32))
+JOB_PERSIST_WINDOW_MS = float(os.getenv("JOB_PERSIST_WINDOW_MS", 5))
+# Seconds a queued job waits before moving up a priority (bulk project runs go behind single submissions until then)
+JOB_AGING_SECONDS = float(os.getenv("JOB_AGING_SECONDS", 120))
+# Shares of the workers for units or staff who should get more (or less) than an equal turn,
+# as JSON e.g {"unit:COMP4050": 2, "staff:someone@mq.edu.au": 0.5}
+JOB_TENANT_WEIGHTS = json.loads(os.getenv("JOB_TENANT_WEIGHTS", "{}"))
+# Jobs which may wait on the queue, in total and per unit or staff member, before generation requests are
+# turned away with a 429 (0 for no limit)
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", 1000))
+JOB_MAX_QUEUED_PER_TENANT = int(os.getenv("JOB_MAX_QUEUED_PER_TENANT", 500))
+# Seconds a job may run once the first pipeline stage starts on it before it is stopped, by job type, as JSON e.g {"VIVA_GEN": 300}.
+# Types left out keep their defaults (600 seconds, batch jobs have none), 0 removes a type's deadline
+JOB_DEADLINES = json.loads(os.getenv("JOB_DEADLINES", "{}"))
+# Seconds between idle workers checking the database queue for jobs enqueued by other processes
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 1))
+# Maximum number of OpenAI requests in flight at once, shared by all workers
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+# Requests and tokens per minute sent to OpenAI, for API keys without limits of their own
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", 500))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", 200000))
+# Limits of individual API keys as JSON, e.g {"sk-...": {"rpm": 5000, "tpm": 4000000}}
+OPENAI_KEY_RATE_LIMITS = json.loads(os.getenv("OPENAI_KEY_RATE_LIMITS", "{}"))
+# Attempts per OpenAI call (429s, 5xx and timeouts are retried with backoff), and the time limits of one
+# request and of a whole call including its retries
+AI_MAX_ATTEMPTS = int(os.getenv("AI_MAX_ATTEMPTS", 4))
+AI_REQUEST_TIMEOUT_SECONDS = float(os.getenv("AI_REQUEST_TIMEOUT_SECONDS", 60))
+AI_CALL_DEADLINE_SECONDS = float(os.getenv("AI_CALL_DEADLINE_SECONDS", 180))
+# Consecutive failed OpenAI requests which stop job workers, and how long they wait before trying again
+AI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("AI_CIRCUIT_FAILURE_THRESHOLD", 5))
+AI_CIRCUIT_RESET_SECONDS = float(os.getenv("AI_CIRCUIT_RESET_SECONDS", 30))
+# Seconds between checks on a whole-project OpenAI Batch API run
+JOB_BATCH_POLL_SECONDS = float(os.getenv("JOB_BATCH_POLL_SECONDS", 30))
+# Where queued jobs are kept, "database" (the job_queue table, survives restarts) or "memory"
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "database")
+# Seconds a worker's claim on a database queue job lasts without a heartbeat, after which another worker takes it
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+
+# PDF EXTRACTION CACHE
+# Local directory of cached extraction results, defaults to a temp directory
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR")
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", 512))
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# JOB CHECKPOINTS
+# Local directory of what failed jobs had already produced, so retries resume where they failed. Defaults to a
+# temp directory, with a database job queue they are also kept in the S3 bucket for the other workers
+JOB_CHECKPOINT_DIR = os.getenv("JOB_CHECKPOINT_DIR")
+JOB_CHECKPOINT_MAX_AGE_HOURS = float(os.getenv("JOB_CHECKPOINT_MAX_AGE_HOURS", 24))
+
+# PDF EXTRACTION
+# Documents with at least this many pages are split across worker processes, 0 turns this off
+PDF_PARALLEL_PAGE_THRESHOLD = int(os.getenv("PDF_PARALLEL_PAGE_THRESHOLD", 100))
+# Number of extraction processes, defaults to the cpu count
+PDF_PARALLEL_WORKERS = int(os.getenv("PDF_PARALLEL_WORKERS", os.cpu_count() or 1))
+
+# S3 READ CACHE
+# Size limit of the in-process cache of files read from S3, 0 turns it off
+FILE_CACHE_MAX_BYTES = int(os.getenv("FILE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Seconds a cached file is served before being revalidated against S3
+FILE_CACHE_TTL_SECONDS = float(os.getenv("FILE_CACHE_TTL_SECONDS", 30))
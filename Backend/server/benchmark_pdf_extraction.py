@@ -0,0 +1,126 @@
+# PDF extraction benchmark
+#
+# Compares the single pass extractor in src/ai/pdf_to_text.py against the old
+# behaviour of running PyMuPDF and then pdfplumber over every page.
+#
+# Usage: python benchmark_pdf_extraction.py [repeats] [pdf or directory ...]
+# With no paths it scans uploads/, _TESTDOCUMENTS/ and the repo's AI/ folder.
+
+import io
+import os
+import sys
+import time
+
+import fitz  # PyMuPDF
+import pdfplumber
+
+import src.ai.pdf_to_text as ptt
+
+_DEFAULT_DIRS = [
+    'uploads',
+    '_TESTDOCUMENTS',
+    os.path.join('..', '..', 'AI'),
+]
+
+def legacy_extract_text_and_tables_from_pdf(file_obj):
+    # The extractor as it was before the single pass rewrite, kept here for comparison only
+    text_by_page = []
+    tables_by_page = {}
+
+    try:
+        doc = fitz.open(stream=file_obj.read(), filetype="pdf")
+        if doc.is_encrypted:
+            return "Error: PDF is encrypted."
+        for page_num, page in enumerate(doc, 1):
+            page_text = page.get_text("text-with-spaces")
+            text_by_page.append(f"Page {page_num}:\n{ptt.clean_text(page_text)}\n\n")
+        file_obj.seek(0)
+    except Exception as e:
+        print(f"First Extraction Method (PyMuPDF) failed: {e}")
+
+    try:
+        with pdfplumber.open(file_obj) as pdf:
+            for i, page in enumerate(pdf.pages, 1):
+                page_text = page.extract_text()
+                if page_text:
+                    text_by_page.append(f"Page {i}:\n{ptt.clean_text(page_text)}\n\n")
+                page_tables = page.extract_tables()
+                if page_tables:
+                    formatted_tables = ""
+                    for table in page_tables:
+                        formatted_tables += ptt.format_table_for_ai(table) + "\n"
+                    tables_by_page[i] = formatted_tables
+        return text_by_page, tables_by_page
+    except Exception as e:
+        print(f"Second Extraction Method (pdfplumber) failed: {e}")
+
+    return "Error: Failed all text extraction", {}
+
+def find_pdfs(paths):
+    pdfs = []
+    for path in paths:
+        if os.path.isfile(path) and path.lower().endswith('.pdf'):
+            pdfs.append(path)
+        elif os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith('.pdf'):
+                    pdfs.append(os.path.join(path, name))
+    return pdfs
+
+def time_extractor(extractor, pdf_bytes, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = extractor(io.BytesIO(pdf_bytes))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def output_size(result):
+    if not isinstance(result, tuple):
+        return 0
+    text_by_page, tables_by_page = result
+    return sum(len(text) for text in text_by_page) + sum(len(tables) for tables in tables_by_page.values())
+
+def main(argv):
+    repeats = 3
+    if argv and argv[0].isdigit():
+        repeats = int(argv[0])
+        argv = argv[1:]
+
+    pdfs = find_pdfs(argv or _DEFAULT_DIRS)
+    if not pdfs:
+        print("No PDFs found.")
+        return 1
+
+    print(f"{'file':<40} {'pages':>5} {'legacy s':>9} {'new s':>9} {'speedup':>8} {'legacy chars':>13} {'new chars':>10} {'tables':>7}")
+    legacyTotal = 0.0
+    newTotal = 0.0
+    for path in pdfs:
+        with open(path, 'rb') as file:
+            pdf_bytes = file.read()
+        try:
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+                pages = doc.page_count
+        except Exception:
+            pages = 0
+
+        legacyTime, legacyResult = time_extractor(legacy_extract_text_and_tables_from_pdf, pdf_bytes, repeats)
+        newTime, newResult = time_extractor(ptt.extract_text_and_tables_from_pdf, pdf_bytes, repeats)
+        legacyTotal += legacyTime
+        newTotal += newTime
+
+        # Tables found by both, the new extractor should never miss one the legacy one found
+        legacyTables = set(legacyResult[1]) if isinstance(legacyResult, tuple) else set()
+        newTables = set(newResult[1]) if isinstance(newResult, tuple) else set()
+        tables = f"{len(newTables & legacyTables)}/{len(legacyTables)}"
+
+        print(f"{os.path.basename(path)[:40]:<40} {pages:>5} {legacyTime:>9.3f} {newTime:>9.3f} "
+              f"{legacyTime / max(newTime, 1e-9):>7.1f}x {output_size(legacyResult):>13} {output_size(newResult):>10} {tables:>7}")
+
+    print(f"{'total':<40} {'':>5} {legacyTotal:>9.3f} {newTotal:>9.3f} {legacyTotal / max(newTotal, 1e-9):>7.1f}x")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
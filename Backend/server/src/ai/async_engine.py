@@ -0,0 +1,178 @@
+# Async generation engine
+#
+# Runs viva and rubric generations on an AsyncOpenAI client owned by a single
+# background event loop. Every caller shares the client's HTTP connection pool,
+# and at most max_concurrency requests are in flight at once, so a batch of N
+# submissions takes about as long as the slowest call rather than the sum of them.
+
+import asyncio
+import threading
+import concurrent.futures
+import httpx
+from openai import AsyncOpenAI
+import src.ai.viva_questions as viva
+import src.ai.rubric_gen as rubric
+import src.ai.rate_limiter as limiter
+import src.ai.resilience as resilience
+
+# Initialise async OpenAI client
+client = None
+
+_loop = None
+_loopThread = None
+_semaphore = None
+_cancelCheckSeconds = 0.25                  # How often a blocked caller with a CancelToken checks it
+
+# Method for initialising the async openAI client. base_url can point at a local stub server for testing.
+def init_async_openai(openai_api_key, openai_org_key, openai_proj_key, max_concurrency=16, base_url=None, timeout=120.0):
+    global client, _semaphore
+
+    if max_concurrency <= 0:
+        raise ValueError("max_concurrency must be a positive integer.")
+
+    _start_loop()
+    if client is not None:
+        _run(client.close())
+
+    # Keep enough pooled connections alive that every permitted request can reuse one.
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        timeout=timeout
+    )
+    client = AsyncOpenAI(
+        api_key=openai_api_key,
+        organization=openai_org_key,
+        project=openai_proj_key,
+        base_url=base_url,
+        http_client=http_client,
+        max_retries=0               # Retries are done by src.ai.resilience
+    )
+    _semaphore = asyncio.Semaphore(max_concurrency)
+
+# Method for closing the client and stopping the event loop
+def shutdown():
+    global client, _loop, _loopThread, _semaphore
+    if _loop is None:
+        return
+    if client is not None:
+        _run(client.close())
+    _loop.call_soon_threadsafe(_loop.stop)
+    _loopThread.join()
+    _loop.close()
+    client = None
+    _loop = None
+    _loopThread = None
+    _semaphore = None
+
+def is_initialised():
+    return client is not None
+
+def _start_loop():
+    global _loop, _loopThread
+    if _loop is not None:
+        return
+    _loop = asyncio.new_event_loop()
+    _loopThread = threading.Thread(target=_loop.run_forever, name="async-ai-engine", daemon=True)
+    _loopThread.start()
+
+# Schedules a coroutine on the engine loop, returns a concurrent.futures.Future
+def submit(coro):
+    if _loop is None:
+        raise RuntimeError("Async OpenAI client not initialized, refer to README.md")
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
+
+# Runs a coroutine on the engine loop and blocks the calling thread for its result. With a token
+# (see src/cancellation.py) the coroutine is cancelled, aborting its request, once the token says to stop.
+def _run(coro, token=None):
+    future = submit(coro)
+    if token is None:
+        return future.result()
+    while True:
+        try:
+            return future.result(timeout=_cancelCheckSeconds)
+        except concurrent.futures.TimeoutError:
+            if token.reason is not None:
+                future.cancel()
+                token.check()
+
+# Requests wait for their rate limit budget before taking a concurrency slot, so throttled calls don't hold one.
+# Every attempt, retries included, goes through the limiter and the semaphore; backoffs hold neither.
+async def _create_completion(request):
+    async def send(timeout):
+        async def create():
+            async with _semaphore:
+                return await client.chat.completions.create(**request, timeout=timeout)
+        return await limiter.call_async(client.api_key, request, create)
+    return await resilience.call_async(send)
+
+async def _parse_completion(request):
+    async def send(timeout):
+        async def parse():
+            async with _semaphore:
+                return await client.beta.chat.completions.parse(**request, timeout=timeout)
+        return await limiter.call_async(client.api_key, request, parse)
+    return await resilience.call_async(send)
+
+# Async counterpart of viva_questions.generate_viva_questions, returns the same (success, response) pair
+async def generate_viva_questions_async(input_data):
+    if not client:
+        return False, "Async OpenAI client not initialized, refer to README.md"
+
+    success, request = viva.build_viva_request(input_data)
+    if not success:
+        return False, request
+
+    try:
+        completion = await _create_completion(request)
+        return viva.process_ai_response(completion.choices[0].message.content)
+    except resilience.CircuitOpenError:
+        raise
+    except Exception as e:
+        return False, f"Error generating questions: {str(e)}"
+
+# Async counterpart of viva_questions.regenerate_questions
+async def regenerate_questions_async(input_data):
+    if not client:
+        return False, "Async OpenAI client not initialized, refer to README.md"
+
+    success, request = viva.build_regen_request(input_data)
+    if not success:
+        return False, request
+
+    try:
+        completion = await _create_completion(request)
+        return viva.process_ai_response(completion.choices[0].message.content)
+    except resilience.CircuitOpenError:
+        raise
+    except Exception as e:
+        return False, f"Error regenerating questions: {str(e)}"
+
+# Async counterpart of rubric_gen.generate_rubric, returns the rubric JSON string or None
+async def generate_rubric_async(input_dict):
+    completion = await _parse_completion(rubric.build_rubric_request(input_dict))
+    return rubric.parse_rubric_response(completion)
+
+# Async counterpart of rubric_gen.convert_rubric
+async def convert_rubric_async(rubric_input):
+    completion = await _parse_completion(rubric.build_convert_request(rubric_input))
+    return rubric.parse_rubric_response(completion)
+
+# Blocking wrappers, used by job subsystem workers so that all of them share one pool and concurrency limit.
+# A token which says to stop raises cancellation.Cancelled
+def generate_viva_questions(input_data, token=None):
+    return _run(generate_viva_questions_async(input_data), token)
+
+def regenerate_questions(input_data, token=None):
+    return _run(regenerate_questions_async(input_data), token)
+
+def generate_rubric(input_dict, token=None):
+    return _run(generate_rubric_async(input_dict), token)
+
+def convert_rubric(rubric_input, token=None):
+    return _run(convert_rubric_async(rubric_input), token)
+
+# Generates viva questions for a whole batch of inputs concurrently, results are in the same order as the inputs
+def generate_viva_batch(inputs):
+    async def gather():
+        return await asyncio.gather(*(generate_viva_questions_async(input_data) for input_data in inputs))
+    return _run(gather())
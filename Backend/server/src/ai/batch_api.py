@@ -0,0 +1,124 @@
+# OpenAI Batch API
+#
+# Sends many chat completion requests as a single JSONL batch file instead of one
+# request each. Batches are billed at a discount and don't count against the
+# per-minute rate limits, in exchange the results come back some time within the
+# completion window (24 hours) rather than in seconds. Used for whole-project
+# question generation where nobody is waiting on an individual submission.
+#
+# Checking on or cancelling a batch which has been submitted (and so will be paid
+# for) doesn't go through the circuit breaker: an outage of chat completions mustn't
+# make its caller give up on the batch and submit another. A failed check just
+# counts as the batch still running. For the same reason creating a batch is never
+# retried: a request which timed out may still have created one, and a retry would
+# pay for its requests twice.
+
+import io
+import json
+import time
+
+import src.ai.resilience as resilience
+import src.cancellation as cancellation
+
+_ENDPOINT = "/v1/chat/completions"
+_TERMINAL_STATES = { "completed", "failed", "expired", "cancelled" }
+_CHECK_TIMEOUT = 30.0                       # Seconds a status check or cancel request may take.
+_CREATE_TIMEOUT = 60.0                      # Seconds the (single) request creating a batch may take.
+
+def is_finished(batch):
+    return batch is not None and batch.status in _TERMINAL_STATES
+
+# Method for building the JSONL batch input file from a dict of custom_id -> chat completion request
+def build_batch_file(requests):
+    lines = []
+    for customID, request in requests.items():
+        lines.append(json.dumps({ "custom_id" : customID, "method" : "POST", "url" : _ENDPOINT, "body" : request }))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+# Uploads the requests and creates the batch, returns the batch id. Only the upload is retried (an unused
+# input file costs nothing), a failure creating the batch is raised straight away
+def submit_batch(client, requests, metadata=None, completionWindow="24h"):
+    data = build_batch_file(requests)
+    inputFile = resilience.call(lambda timeout: client.files.create(
+        file=("batch_input.jsonl", io.BytesIO(data)), purpose="batch", timeout=timeout))
+    options = { "metadata" : metadata } if metadata else {}
+    batch = client.batches.create(input_file_id=inputFile.id, endpoint=_ENDPOINT, completion_window=completionWindow,
+                                  timeout=_CREATE_TIMEOUT, **options)
+    return batch.id
+
+# Returns the batch object, or None if it couldn't be retrieved this time
+def check_batch(client, batchID):
+    try:
+        return client.batches.retrieve(batchID, timeout=_CHECK_TIMEOUT)
+    except Exception as e:
+        print(f"Failed to check on batch {batchID}, will check again: {e}")
+        return None
+
+# Asks OpenAI to stop a batch, returns False if the request failed
+def cancel_batch(client, batchID):
+    try:
+        client.batches.cancel(batchID, timeout=_CHECK_TIMEOUT)
+        return True
+    except Exception as e:
+        print(f"Failed to cancel batch {batchID}: {e}")
+        return False
+
+# Blocks until the batch reaches a terminal state or timeout seconds pass, returns the last batch object seen
+# (None if it was never retrieved). A token (see src/cancellation.py) which says to stop ends the wait early the same way
+def wait_for_batch(client, batchID, pollSeconds=30.0, timeout=None, token=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    batch = None
+    while True:
+        batch = check_batch(client, batchID) or batch
+        if is_finished(batch):
+            return batch
+        if deadline is not None and time.monotonic() + pollSeconds > deadline:
+            return batch
+        if token is not None:
+            if token.wait(pollSeconds):
+                return batch
+        else:
+            time.sleep(pollSeconds)
+
+def _read_file(client, fileID):
+    if not fileID:
+        return []
+    content = resilience.call(lambda timeout: client.files.content(fileID, timeout=timeout))
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+# Returns a dict of custom_id -> (success, message content or error) for every request in the batch
+def fetch_results(client, batch, customIDs):
+    results = {}
+    for line in _read_file(client, batch.output_file_id) + _read_file(client, getattr(batch, "error_file_id", None)):
+        customID = line.get("custom_id")
+        response = line.get("response") or {}
+        if line.get("error") or response.get("status_code") != 200:
+            error = line.get("error") or response.get("body", {}).get("error") or f"Status {response.get('status_code')}"
+            results[customID] = (False, f"Error generating questions: {error}")
+            continue
+        try:
+            results[customID] = (True, response["body"]["choices"][0]["message"]["content"])
+        except (KeyError, IndexError, TypeError) as e:
+            results[customID] = (False, f"Error processing AI response: {e}")
+
+    # Requests which never ran, i.e the batch failed, expired or was cancelled
+    for customID in customIDs:
+        if customID not in results:
+            results[customID] = (False, f"Batch {batch.id} ended {batch.status} without a result for this request")
+    return results
+
+# Submits the requests as a batch and waits for it, returns the same dict as fetch_results.
+# A batch still running at the timeout, or once the token says to stop, is cancelled; a stopped token then raises Cancelled
+def run_batch(client, requests, pollSeconds=30.0, timeout=None, metadata=None, token=None):
+    cancellation.check(token)
+    batchID = submit_batch(client, requests, metadata)
+    print(f"Submitted batch {batchID} with {len(requests)} requests")
+    batch = wait_for_batch(client, batchID, pollSeconds, timeout, token)
+    if not is_finished(batch):
+        cancel_batch(client, batchID)
+        cancellation.check(token)
+        batch = wait_for_batch(client, batchID, pollSeconds, pollSeconds * 10)
+    if batch is None:
+        return { customID : (False, f"Batch {batchID} could not be checked on") for customID in requests }
+    print(f"Batch {batchID} ended {batch.status}")
+    return fetch_results(client, batch, list(requests.keys()))
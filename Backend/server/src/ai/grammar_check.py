@@ -1,5 +1,7 @@
 from openai import OpenAI
 import json
+import src.ai.rate_limiter as limiter
+import src.ai.resilience as resilience
 
 # Initialise OpenAI client
 client = None
@@ -10,7 +12,8 @@ def init_openai(openai_api_key, openai_org_key, openai_proj_key):
     client = OpenAI(
         api_key=openai_api_key,
         organization=openai_org_key,
-        project=openai_proj_key
+        project=openai_proj_key,
+        max_retries=0               # Retries are done by src.ai.resilience
     )
 
 def grammer_score(input_data):
@@ -29,15 +32,19 @@ def grammer_score(input_data):
         {input_data}
         """
 
-        # OpenAI API Call for question regeneration
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+        request = {
+            "model": "gpt-4o-mini",
+            "messages": [
                 {"role": "user", "content": promt}
             ],
-            max_tokens=800,
-            response_format={"type": "json_object"}
-        )
+            "max_tokens": 800,
+            "response_format": {"type": "json_object"}
+        }
+
+        # OpenAI API Call for question regeneration
+        def send(timeout):
+            return limiter.call(client.api_key, request, lambda: client.chat.completions.create(**request, timeout=timeout))
+        completion = resilience.call(send)
         
         response = completion.choices[0].message.content
         try:
@@ -1,6 +1,14 @@
 import fitz  # PyMuPDF
 import pdfplumber
 import re
+import io
+import os
+import mmap
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from threading import Lock
+import src.cancellation as cancellation
 
 def clean_text(text):
     cleaned_text = re.sub(r"(?<!\n)\n(?!\n)", " ", text)  
@@ -33,33 +41,52 @@ def format_table_for_ai(table):
         formatted_table += formatted_row + '\n'
     return formatted_table
 
-def extract_text_and_tables_from_pdf(file_obj):
-    text_by_page = []
-    tables_by_page = {}
+# Bumped whenever the shape or content of the extraction output changes, so cached results are not reused
+EXTRACTION_VERSION = 2
 
-    try:
-        #open file content using fitz (PyMuPDF) directly from file object stream
-        doc = fitz.open(stream=file_obj.read(), filetype="pdf")
+# "text-with-spaces" isn't a get_text format, plain text keeping whitespace & ligatures is what was intended
+_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_PRESERVE_LIGATURES
 
-        if doc.is_encrypted:
-            print("Skipping encrypted PDF")
-            return "Error: PDF is encrypted."
+def _page_has_ruling_lines(page):
+    # pdfplumber's default table finder builds cells out of ruling lines & rectangle edges and
+    # drops tables with a single cell, so a page needs at least 2 horizontal and 2 vertical rulings
+    # plus one more of either (e.g. 3 x 2 for two cells) before it can produce a table.
+    # A lone rectangle such as a page background or a text box never qualifies.
+    horizontal = set()
+    vertical = set()
+    for drawing in page.get_drawings():
+        for item in drawing["items"]:
+            if item[0] == "l":
+                p1, p2 = item[1], item[2]
+                if abs(p1.y - p2.y) < 1:
+                    horizontal.add(round(p1.y))
+                elif abs(p1.x - p2.x) < 1:
+                    vertical.add(round(p1.x))
+            elif item[0] in ("re", "qu"):
+                rect = item[1] if item[0] == "re" else item[1].rect
+                horizontal.update((round(rect.y0), round(rect.y1)))
+                vertical.update((round(rect.x0), round(rect.x1)))
+            if len(horizontal) >= 2 and len(vertical) >= 2 and len(horizontal) + len(vertical) >= 5:
+                return True
+    return False
 
-        #extracting text page by page
-        for page_num, page in enumerate(doc, 1):
-            page_text = page.get_text("text-with-spaces")
-            cleaned_page_text = clean_text(page_text)
-            text_by_page.append(f"Page {page_num}:\n{cleaned_page_text}\n\n")
+def _extract_tables(pdf, page_num):
+    page_tables = pdf.pages[page_num - 1].extract_tables()
+    if not page_tables:
+        return None
+    formatted_tables = ""
+    for table in page_tables:
+        formatted_tables += format_table_for_ai(table) + "\n"
+    return formatted_tables
 
-        file_obj.seek(0)  #resets file pointer for pdfplumber
-
-    except Exception as e:
-        print(f"First Extraction Method (PyMuPDF) failed: {e}")
-
-    # Fallback: Try using pdfplumber for both text and tables
+def _extract_with_pdfplumber(pdf_bytes, token=None):
+    # Fallback when PyMuPDF can't open the document: text and tables both from pdfplumber
+    text_by_page = []
+    tables_by_page = {}
     try:
-        with pdfplumber.open(file_obj) as pdf:
+        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
             for i, page in enumerate(pdf.pages, 1):
+                cancellation.check(token)
                 #extracts text from pdfplumber
                 page_text = page.extract_text()
                 if page_text:
@@ -67,16 +94,170 @@ def extract_text_and_tables_from_pdf(file_obj):
                     text_by_page.append(f"Page {i}:\n{cleaned_page_text}\n\n")
 
                 #extracts tables from the page using pdfplumber
-                page_tables = page.extract_tables()
-                if page_tables:
-                    formatted_tables = ""
-                    for table in page_tables:
-                        formatted_tables += format_table_for_ai(table) + "\n"
+                formatted_tables = _extract_tables(pdf, i)
+                if formatted_tables:
                     tables_by_page[i] = formatted_tables  #store formatted tables by page number
 
         return text_by_page, tables_by_page
 
+    except cancellation.Cancelled:
+        raise
     except Exception as e:
         print(f"Second Extraction Method (pdfplumber) failed: {e}")
 
-    return "Error: Failed all text extraction", {}
\ No newline at end of file
+    return "Error: Failed all text extraction", {}
+
+# Parallel extraction of large documents, documents with at least _parallelPageThreshold pages are
+# split into page ranges which are extracted in separate processes (PyMuPDF & pdfplumber hold the GIL)
+_parallelPageThreshold = 100
+_parallelWorkers = os.cpu_count() or 1
+_MIN_SHARD_PAGES = 20                       # Don't split documents into ranges shorter than this
+
+_pool = None
+_poolLock = Lock()
+
+def configure_parallel(pageThreshold=100, maxWorkers=None):
+    # maxWorkers defaults to the cpu count, a value of 1 (or a pageThreshold of 0) turns parallel extraction off
+    global _parallelPageThreshold, _parallelWorkers
+    if pageThreshold < 0 or (maxWorkers is not None and maxWorkers <= 0):
+        return False
+    shutdown_pool()
+    _parallelPageThreshold = pageThreshold
+    _parallelWorkers = maxWorkers or os.cpu_count() or 1
+    return True
+
+def shutdown_pool():
+    global _pool
+    with _poolLock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+def _get_pool():
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            # Spawn rather than fork, the parent is a multithreaded web server
+            _pool = ProcessPoolExecutor(max_workers=_parallelWorkers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def _should_shard(page_count):
+    return _parallelPageThreshold > 0 and _parallelWorkers > 1 and page_count >= _parallelPageThreshold
+
+def _extract_text(doc, start, end, token=None):
+    # Extracts the text of pages [start, end) and picks out the pages that may hold tables, page numbers are 1 based
+    text_by_page = []
+    table_pages = []
+    for page_num in range(start + 1, end + 1):
+        cancellation.check(token)
+        page = doc[page_num - 1]
+        page_text = page.get_text("text", flags=_TEXT_FLAGS)
+        cleaned_page_text = clean_text(page_text)
+        text_by_page.append(f"Page {page_num}:\n{cleaned_page_text}\n\n")
+
+        if _page_has_ruling_lines(page):
+            table_pages.append(page_num)
+    return text_by_page, table_pages
+
+def _extract_table_pages(pdf_file, table_pages, token=None):
+    tables_by_page = {}
+    if not table_pages:
+        return tables_by_page
+    try:
+        with pdfplumber.open(pdf_file) as pdf:
+            for page_num in table_pages:
+                cancellation.check(token)
+                formatted_tables = _extract_tables(pdf, page_num)
+                if formatted_tables:
+                    tables_by_page[page_num] = formatted_tables  #store formatted tables by page number
+    except cancellation.Cancelled:
+        raise
+    except Exception as e:
+        print(f"Table extraction (pdfplumber) failed: {e}")
+    return tables_by_page
+
+def _extract_shard(path, start, end):
+    # Runs in a pool process. Every process maps the same temp file, so the document is shared
+    # through the page cache rather than pickled over to each worker.
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            doc = fitz.open(stream=view, filetype="pdf")
+            try:
+                text_by_page, table_pages = _extract_text(doc, start, end)
+            finally:
+                doc.close()
+        tables_by_page = _extract_table_pages(mapped, table_pages)
+    return text_by_page, tables_by_page
+
+def _wait_for_shard(future, token):
+    # Shards can't be interrupted once running, a stopped extraction drops those still waiting for a process
+    while True:
+        try:
+            return future.result(timeout=0.25 if token is not None else None)
+        except FutureTimeout:
+            cancellation.check(token)
+
+def _extract_parallel(pdf_bytes, page_count, token=None):
+    # Returns None if any shard fails so the caller can retry in process
+    shards = min(_parallelWorkers, max(1, page_count // _MIN_SHARD_PAGES))
+    bounds = [page_count * i // shards for i in range(shards + 1)]
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    try:
+        with tmp:
+            tmp.write(pdf_bytes)
+        pool = _get_pool()
+        futures = [pool.submit(_extract_shard, tmp.name, bounds[i], bounds[i + 1]) for i in range(shards)]
+
+        #merge the shards back together in page order
+        text_by_page = []
+        tables_by_page = {}
+        for future in futures:
+            shard_text, shard_tables = _wait_for_shard(future, token)
+            text_by_page.extend(shard_text)
+            tables_by_page.update(shard_tables)
+        return text_by_page, tables_by_page
+
+    except cancellation.Cancelled:
+        for future in futures:
+            future.cancel()
+        raise
+    except Exception as e:
+        print(f"Parallel extraction failed, extracting in process: {e}")
+        return None
+    finally:
+        os.remove(tmp.name)
+
+def extract_text_and_tables_from_pdf(file_obj, token=None):
+    # Text comes from PyMuPDF in a single pass, pdfplumber is only opened for
+    # table extraction on the pages whose drawings look like a table.
+    # With a token (see src/cancellation.py) it is checked between pages, raising Cancelled to stop.
+    pdf_bytes = file_obj.read()
+
+    try:
+        #open file content using fitz (PyMuPDF) directly from the bytes
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+        if doc.is_encrypted:
+            print("Skipping encrypted PDF")
+            return "Error: PDF is encrypted."
+
+        if _should_shard(doc.page_count):
+            page_count = doc.page_count
+            doc.close()
+            result = _extract_parallel(pdf_bytes, page_count, token)
+            if result is not None:
+                return result
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+        #extracting text page by page
+        text_by_page, table_pages = _extract_text(doc, 0, doc.page_count, token)
+        doc.close()
+
+    except cancellation.Cancelled:
+        raise
+    except Exception as e:
+        print(f"First Extraction Method (PyMuPDF) failed: {e}")
+        return _extract_with_pdfplumber(pdf_bytes, token)
+
+    return text_by_page, _extract_table_pages(io.BytesIO(pdf_bytes), table_pages, token)
@@ -0,0 +1,217 @@
+# OpenAI rate limiter
+#
+# Meters requests per minute and tokens per minute for every API key, so that a
+# large batch of generations runs at the provider's limit instead of bursting
+# over it and failing with 429s. Each key has two token buckets; a call reserves
+# one request and its estimated tokens up front and waits until both buckets
+# can cover it. Reservations may take a bucket below zero, which queues later
+# callers behind earlier ones in the order they arrived.
+#
+# OpenAI counts max_tokens against the token limit when a request is accepted,
+# so the estimate is the prompt size plus max_tokens. Once a response arrives the
+# bucket is corrected with the real usage reported by the API, and a call which
+# raised (i.e a timeout or 5xx about to be retried) gets its tokens back, as it
+# used none. Its request is still counted, it was sent.
+
+import asyncio
+import threading
+import time
+import src.metrics as metrics
+
+_CHARS_PER_TOKEN = 4                        # Rough size of a token in English text, used to estimate prompts.
+_TOKENS_PER_MESSAGE = 4                     # Overhead of the chat format for every message.
+_BURST_SECONDS = 10                         # A bucket holds this many seconds worth of its limit, i.e the largest burst.
+
+# Settings
+_defaultRPM: int = 500                      # Limits used for keys that haven't been configured.
+_defaultTPM: int = 200000
+
+# Metrics
+_tokensPerCall = metrics.histogram('openai_tokens_per_call', 'Tokens used by an OpenAI call, as reported in its response.',
+                                   ('model', 'kind'), metrics.TOKEN_BUCKETS)
+
+# Internal Variables
+_limiters: dict = {}                        # API key -> RateLimiter.
+_limitersLock = threading.Lock()
+
+# A token bucket refilled continuously at perMinute / 60 per second
+class TokenBucket:
+    def __init__(self, perMinute, burstSeconds=_BURST_SECONDS, clock=time.monotonic):
+        if perMinute <= 0:
+            raise ValueError("perMinute must be a positive number.")
+        self.rate = perMinute / 60.0
+        self.capacity = max(1.0, self.rate * burstSeconds)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Takes amount from the bucket and returns how many seconds the caller must wait before using it
+    def reserve(self, amount):
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    # Puts amount back (or takes more if negative), used to correct an estimate after the fact
+    def refund(self, amount):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+# The request and token budgets of a single API key
+class RateLimiter:
+    def __init__(self, rpm, tpm, clock=time.monotonic):
+        self.requests = TokenBucket(rpm, clock=clock)
+        self.tokens = TokenBucket(tpm, clock=clock)
+        self._lock = threading.Lock()
+        self._stats = { 'requests' : 0, 'throttled' : 0, 'wait_seconds' : 0.0, 'estimated_tokens' : 0, 'used_tokens' : 0, 'released_tokens' : 0 }
+
+    # Reserves one request and estimatedTokens, returns the seconds to wait before sending it
+    def reserve(self, estimatedTokens):
+        delay = max(self.requests.reserve(1), self.tokens.reserve(estimatedTokens))
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['estimated_tokens'] += estimatedTokens
+            if delay > 0:
+                self._stats['throttled'] += 1
+                self._stats['wait_seconds'] += delay
+        return delay
+
+    # Blocks the calling thread until the request may be sent
+    def acquire(self, estimatedTokens):
+        delay = self.reserve(estimatedTokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    # Coroutine counterpart of acquire, for the async engine
+    async def acquire_async(self, estimatedTokens):
+        delay = self.reserve(estimatedTokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Corrects the token bucket once the real usage of a request is known
+    def settle(self, estimatedTokens, usedTokens):
+        if usedTokens is None:
+            return
+        self.tokens.refund(estimatedTokens - usedTokens)
+        with self._lock:
+            self._stats['used_tokens'] += usedTokens
+
+    # Gives back the tokens reserved for a request which failed without using any
+    def release(self, estimatedTokens):
+        self.tokens.refund(estimatedTokens)
+        with self._lock:
+            self._stats['released_tokens'] += estimatedTokens
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+# Method for setting the limits of an API key, and the default for keys without their own
+def configure(apiKey=None, rpm=None, tpm=None):
+    global _defaultRPM, _defaultTPM
+    with _limitersLock:
+        if apiKey is None:
+            _defaultRPM = rpm or _defaultRPM
+            _defaultTPM = tpm or _defaultTPM
+            return
+        _limiters[apiKey] = RateLimiter(rpm or _defaultRPM, tpm or _defaultTPM)
+
+# Returns the limiter of an API key, creating one with the default limits on first use
+def get_limiter(apiKey):
+    with _limitersLock:
+        limiter = _limiters.get(apiKey)
+        if limiter is None:
+            limiter = RateLimiter(_defaultRPM, _defaultTPM)
+            _limiters[apiKey] = limiter
+        return limiter
+
+def reset():
+    with _limitersLock:
+        _limiters.clear()
+
+# Estimates the tokens a chat completion request is charged, its prompt plus the completion budget
+def estimate_tokens(request):
+    prompt = 0
+    for message in request.get("messages", []):
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = str(content)
+        prompt += _TOKENS_PER_MESSAGE + (len(content) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+    return prompt + request.get("max_tokens", 0)
+
+# Returns the total tokens reported by a completion, or None if the response has no usage
+def used_tokens(completion):
+    usage = getattr(completion, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+# Waits for the budget of a request sent with apiKey, returns the estimate to pass to record_usage
+def acquire(apiKey, request):
+    estimate = estimate_tokens(request)
+    get_limiter(apiKey).acquire(estimate)
+    return estimate
+
+async def acquire_async(apiKey, request):
+    estimate = estimate_tokens(request)
+    await get_limiter(apiKey).acquire_async(estimate)
+    return estimate
+
+def record_usage(apiKey, estimate, completion):
+    get_limiter(apiKey).settle(estimate, used_tokens(completion))
+    observe_usage(completion)
+
+def record_failure(apiKey, estimate):
+    get_limiter(apiKey).release(estimate)
+
+# Sends a request with send() once apiKey's budget allows, settling the budget with its usage, or giving
+# its tokens back if send raises. Returns send's completion
+def call(apiKey, request, send):
+    estimate = acquire(apiKey, request)
+    try:
+        completion = send()
+    except BaseException:
+        record_failure(apiKey, estimate)
+        raise
+    record_usage(apiKey, estimate, completion)
+    return completion
+
+# Coroutine counterpart of call, send is a coroutine function
+async def call_async(apiKey, request, send):
+    estimate = await acquire_async(apiKey, request)
+    try:
+        completion = await send()
+    except BaseException:               # Including cancellation, the request was abandoned
+        record_failure(apiKey, estimate)
+        raise
+    record_usage(apiKey, estimate, completion)
+    return completion
+
+# Adds the prompt, completion and total tokens of a response to the tokens per call metric
+def observe_usage(completion):
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return
+    model = getattr(completion, "model", None) or ""
+    for kind in ("prompt", "completion", "total"):
+        tokens = getattr(usage, f"{kind}_tokens", None)
+        if isinstance(tokens, (int, float)):
+            _tokensPerCall.observe(tokens, model=model, kind=kind)
+
+# Counters of every limiter, keyed by the last 4 characters of its API key
+def get_stats():
+    with _limitersLock:
+        limiters = list(_limiters.items())
+    return { (apiKey or '')[-4:] : limiter.get_stats() for apiKey, limiter in limiters }
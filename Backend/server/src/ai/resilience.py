@@ -0,0 +1,260 @@
+# AI call resilience
+#
+# Wraps every OpenAI request in classified retries and a shared circuit breaker.
+# Rate limits (429), server errors (5xx), timeouts and dropped connections are
+# retried with jittered exponential backoff, honouring Retry-After when the API
+# sends one, for as long as the call's deadline allows. Anything else (bad
+# requests, auth errors) fails straight away.
+#
+# Retryable failures also count against the circuit breaker. After enough of them
+# in a row it opens and calls are rejected with CircuitOpenError until the reset
+# timeout passes, then a single probe is let through (half open) and its outcome
+# closes or reopens the circuit. The job subsystem stops claiming jobs while the
+# circuit is open, so queued jobs wait for the provider instead of failing.
+#
+# Requests, retries, give ups and circuit transitions are exported at /metrics (see src/metrics.py).
+
+import asyncio
+import random
+import threading
+import time
+
+import openai
+
+import src.metrics as metrics
+
+# Circuit states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Settings
+_maxAttempts: int = 4                       # Attempts per call, including the first.
+_baseDelay: float = 1.0                     # Backoff before the first retry, doubled for each one after.
+_maxDelay: float = 30.0                     # Upper bound of a single backoff.
+_attemptTimeout: float = 60.0               # Timeout of a single request.
+_deadline: float = 180.0                    # Time a call may take over all of its attempts and backoffs.
+_failureThreshold: int = 5                  # Consecutive retryable failures which open the circuit.
+_resetTimeout: float = 30.0                 # Seconds the circuit stays open before letting a probe through.
+
+# Internal Variables
+_lock = threading.Lock()
+_state: str = CLOSED
+_consecutiveFailures: int = 0
+_openedAt: float = 0.0
+_probeInFlight: bool = False
+_metrics: dict = {
+    'calls' : 0, 'successes' : 0, 'failures' : 0, 'rejected' : 0, 'gave_up' : 0, 'deadline_exceeded' : 0,
+    'retries_rate_limited' : 0, 'retries_server_error' : 0, 'retries_timeout' : 0, 'retries_connection' : 0,
+    'circuit_opened' : 0, 'circuit_half_opened' : 0, 'circuit_closed' : 0
+}
+
+# Metrics, unlike _metrics these aren't reset by reset()
+_requests = metrics.counter('ai_requests_total', 'AI requests by outcome, rejected ones were never sent as the circuit was open.', ('outcome',))
+_retries = metrics.counter('ai_retries_total', 'AI requests retried, by the kind of transient failure.', ('kind',))
+_giveUps = metrics.counter('ai_giveups_total', 'AI calls which stopped retrying, out of attempts or past their deadline.', ('reason',))
+_transitions = metrics.counter('ai_circuit_transitions_total', 'Moves of the AI circuit breaker, by the state moved to.', ('state',))
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit is open."""
+    pass
+
+# Method for changing the retry & circuit breaker settings, anything left as None is unchanged
+def configure(maxAttempts=None, baseDelay=None, maxDelay=None, attemptTimeout=None, deadline=None,
+              failureThreshold=None, resetTimeout=None):
+    global _maxAttempts, _baseDelay, _maxDelay, _attemptTimeout, _deadline, _failureThreshold, _resetTimeout
+    _maxAttempts = maxAttempts if maxAttempts is not None else _maxAttempts
+    _baseDelay = baseDelay if baseDelay is not None else _baseDelay
+    _maxDelay = maxDelay if maxDelay is not None else _maxDelay
+    _attemptTimeout = attemptTimeout if attemptTimeout is not None else _attemptTimeout
+    _deadline = deadline if deadline is not None else _deadline
+    _failureThreshold = failureThreshold if failureThreshold is not None else _failureThreshold
+    _resetTimeout = resetTimeout if resetTimeout is not None else _resetTimeout
+
+# Closes the circuit and zeroes the metrics
+def reset():
+    global _state, _consecutiveFailures, _openedAt, _probeInFlight
+    with _lock:
+        _state = CLOSED
+        _consecutiveFailures = 0
+        _openedAt = 0.0
+        _probeInFlight = False
+        for key in _metrics:
+            _metrics[key] = 0
+
+# Returns which kind of transient failure an exception is, or None if retrying it won't help
+def classify(error):
+    if isinstance(error, openai.RateLimitError):
+        return 'rate_limited'
+    if isinstance(error, openai.APITimeoutError) or isinstance(error, TimeoutError) or isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(error, openai.APIConnectionError):
+        return 'connection'
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return 'server_error'
+    return None
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+# Full jitter backoff, a random delay up to the exponential bound, but never less than Retry-After
+def backoff(attempt, error=None):
+    delay = random.uniform(0, min(_maxDelay, _baseDelay * (2 ** attempt)))
+    retryAfter = _retry_after(error) if error is not None else None
+    if retryAfter is not None:
+        delay = max(delay, min(retryAfter, _maxDelay))
+    return delay
+
+def _count(metric):
+    with _lock:
+        _metrics[metric] += 1
+
+def _transition(state):
+    """Moves the circuit to state and counts the transition. Must hold _lock."""
+    global _state, _openedAt
+    if _state == state:
+        return
+    print(f"AI circuit breaker {_state} -> {state}")
+    _state = state
+    _transitions.inc(state=state)
+    if state == OPEN:
+        _openedAt = time.monotonic()
+        _metrics['circuit_opened'] += 1
+    elif state == HALF_OPEN:
+        _metrics['circuit_half_opened'] += 1
+    else:
+        _metrics['circuit_closed'] += 1
+
+# Returns the seconds until the circuit will let a request through, 0 if it would now
+def wait_time():
+    with _lock:
+        if _state != OPEN:
+            return 0.0
+        return max(0.0, _openedAt + _resetTimeout - time.monotonic())
+
+def get_state():
+    with _lock:
+        if _state == OPEN and time.monotonic() >= _openedAt + _resetTimeout:
+            return HALF_OPEN
+        return _state
+
+def _allow():
+    """Decides whether a request may be sent, moving an open circuit to half open once its timeout has passed."""
+    global _probeInFlight
+    with _lock:
+        _metrics['calls'] += 1
+        if _state == OPEN and time.monotonic() >= _openedAt + _resetTimeout:
+            _transition(HALF_OPEN)
+        if _state == CLOSED:
+            return True
+        if _state == HALF_OPEN and not _probeInFlight:
+            _probeInFlight = True
+            return True
+        _metrics['rejected'] += 1
+        _requests.inc(outcome='rejected')
+        return False
+
+def _record_success():
+    global _consecutiveFailures, _probeInFlight
+    with _lock:
+        _metrics['successes'] += 1
+        _requests.inc(outcome='success')
+        _consecutiveFailures = 0
+        _probeInFlight = False
+        _transition(CLOSED)
+
+def _record_failure(kind):
+    global _consecutiveFailures, _probeInFlight
+    with _lock:
+        _metrics['failures'] += 1
+        _requests.inc(outcome='failure')
+        if kind is None:            # The provider answered, it just didn't like the request
+            _probeInFlight = False
+            return
+        _consecutiveFailures += 1
+        if _state == HALF_OPEN or _consecutiveFailures >= _failureThreshold:
+            _transition(OPEN)
+        _probeInFlight = False
+
+def _next_delay(attempt, error, kind, deadlineAt):
+    """Returns the backoff before retrying, or None if the call should give up with error."""
+    if kind is None:
+        return None
+    if attempt + 1 >= _maxAttempts:
+        _count('gave_up')
+        _giveUps.inc(reason='attempts')
+        return None
+    delay = backoff(attempt, error)
+    if time.monotonic() + delay >= deadlineAt:
+        _count('deadline_exceeded')
+        _giveUps.inc(reason='deadline')
+        return None
+    _count('retries_' + kind)
+    _retries.inc(kind=kind)
+    return delay
+
+# Sends a request with send(timeout), retrying transient failures. Raises the last error or CircuitOpenError
+def call(send):
+    deadlineAt = time.monotonic() + _deadline
+    attempt = 0
+    while True:
+        if not _allow():
+            raise CircuitOpenError("AI provider is unavailable, circuit breaker is open.")
+        try:
+            result = send(min(_attemptTimeout, max(0.0, deadlineAt - time.monotonic())))
+        except Exception as e:
+            kind = classify(e)
+            _record_failure(kind)
+            delay = _next_delay(attempt, e, kind, deadlineAt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        _record_success()
+        return result
+
+# Coroutine counterpart of call, send(timeout) returns an awaitable
+async def call_async(send):
+    deadlineAt = time.monotonic() + _deadline
+    attempt = 0
+    while True:
+        if not _allow():
+            raise CircuitOpenError("AI provider is unavailable, circuit breaker is open.")
+        try:
+            result = await send(min(_attemptTimeout, max(0.0, deadlineAt - time.monotonic())))
+        except asyncio.CancelledError:
+            _record_failure(None)       # Frees the half open probe slot
+            raise
+        except Exception as e:
+            kind = classify(e)
+            _record_failure(kind)
+            delay = _next_delay(attempt, e, kind, deadlineAt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        _record_success()
+        return result
+
+# The counters plus the current circuit state
+def get_metrics():
+    state = get_state()
+    with _lock:
+        metrics = dict(_metrics)
+        metrics['consecutive_failures'] = _consecutiveFailures
+    metrics['circuit_state'] = state
+    return metrics
+
+def _circuit_state()->dict:
+    state = get_state()
+    return {(name,) : int(name == state) for name in (CLOSED, OPEN, HALF_OPEN)}
+
+metrics.gauge('ai_circuit_state', 'The state of the AI circuit breaker, 1 for the current one.', ('state',), _circuit_state)
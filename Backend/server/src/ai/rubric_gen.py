@@ -3,6 +3,8 @@ from openai import OpenAI
 from pydantic import BaseModel
 import pandas as pd
 import re
+import src.ai.rate_limiter as limiter
+import src.ai.resilience as resilience
 
 # Initialise OpenAI client
 client = None
@@ -34,7 +36,8 @@ def init_openai(openai_api_key, openai_org_key, openai_proj_key):
     client = OpenAI(
         api_key=openai_api_key,
         organization=openai_org_key,
-        project=openai_proj_key
+        project=openai_proj_key,
+        max_retries=0               # Retries are done by src.ai.resilience
     )
 
 # Helper method to get list of criterion:
@@ -47,6 +50,32 @@ def get_criterion(input_dict):
     return criterion
     
 def generate_rubric(input_dict):
+    return _parse_completion(build_rubric_request(input_dict))
+
+def convert_rubric(rubric_input):
+    return _parse_completion(build_convert_request(rubric_input))
+
+# Sends a structured output request within the rate limits of the client's API key, retrying transient failures
+def _parse_completion(request):
+    def send(timeout):
+        return limiter.call(client.api_key, request, lambda: client.beta.chat.completions.parse(**request, timeout=timeout))
+    return parse_rubric_response(resilience.call(send))
+
+# Returns the parsed rubric as a JSON string, or None if the model refused
+def parse_rubric_response(completion):
+    feedback_response = completion.choices[0].message
+
+    # If the model refuses to respond, you will get a refusal message
+    if (feedback_response.refusal):
+        print(feedback_response.refusal)
+        return None
+    else:
+        parsed= feedback_response.parsed
+        feedback_response_json = parsed.model_dump_json()
+        return feedback_response_json
+
+# Builds the structured output request for generating a rubric, shared by the sync and async clients
+def build_rubric_request(input_dict):
     grade_descriptors = "Fail (0-49), Pass(50-64), Credit (65-74), Distinction (75-84), High Distinction (85-100)"
 
     assessment_criterion = get_criterion(input_dict)
@@ -139,30 +168,19 @@ def generate_rubric(input_dict):
     }
     """
     
-    completion = client.beta.chat.completions.parse(
-        model="gpt-4o-mini",
-        messages=[
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
             {"role": "system", "content": sys_prompt},
             {"role": "user", "content": user_prompt}
         ],
-        max_tokens=1096,
-        # response_format={"type": "json_object"}
-        response_format=AssignmentFeedback
-    )
-
-    feedback_response = completion.choices[0].message
-
-    # If the model refuses to respond, you will get a refusal message
-    if (feedback_response.refusal):
-        print(feedback_response.refusal)
-        return None
-    else:
-        parsed= feedback_response.parsed
-        feedback_response_json = parsed.model_dump_json()
-        return feedback_response_json
-
+        "max_tokens": 1096,
+        # "response_format": {"type": "json_object"}
+        "response_format": AssignmentFeedback
+    }
 
-def convert_rubric(rubric_input):
+# Builds the structured output request for converting a marking guide to a rubric
+def build_convert_request(rubric_input):
     guide = rubric_input["marking_guide"]
     content = get_guide_content(guide)
     grade_descriptors = "Fail (0-49), Pass(50-64), Credit (65-74), Distinction (75-84), High Distinction (85-100)"
@@ -238,27 +256,16 @@ def convert_rubric(rubric_input):
     }
     """
     
-    completion = client.beta.chat.completions.parse(
-        model="gpt-4o-mini",
-        messages=[
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
             {"role": "system", "content": sys_prompt},
             {"role": "user", "content": user_prompt}
         ],
-        max_tokens=1096,
-        # response_format={"type": "json_object"}
-        response_format=AssignmentFeedback
-    )
-
-    feedback_response = completion.choices[0].message
-
-    # If the model refuses to respond, you will get a refusal message
-    if (feedback_response.refusal):
-        print(feedback_response.refusal)
-        return None
-    else:
-        parsed= feedback_response.parsed
-        feedback_response_json = parsed.model_dump_json()
-        return feedback_response_json
+        "max_tokens": 1096,
+        # "response_format": {"type": "json_object"}
+        "response_format": AssignmentFeedback
+    }
   
 def get_guide_content(guide_content):
     # Extract the table content from the dictionary
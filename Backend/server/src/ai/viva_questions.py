@@ -1,16 +1,20 @@
 from openai import OpenAI
 import json
+import src.ai.rate_limiter as limiter
+import src.ai.resilience as resilience
 
 # Initialise OpenAI client
 client = None
 
-# Method for initialising openAI client
-def init_openai(openai_api_key, openai_org_key, openai_proj_key):
+# Method for initialising openAI client. base_url can point at a local stub server for testing.
+def init_openai(openai_api_key, openai_org_key, openai_proj_key, base_url=None):
     global client
     client = OpenAI(
         api_key=openai_api_key,
         organization=openai_org_key,
-        project=openai_proj_key
+        project=openai_proj_key,
+        base_url=base_url,
+        max_retries=0               # Retries are done by src.ai.resilience
     )
 
 # Method for generating viva questions, expects a single dict with all req values
@@ -18,7 +22,37 @@ def generate_viva_questions(input_data):
     # Check if OpenAI client is initialized
     if not client:
         return False, "OpenAI client not initialized, refer to README.md"
-    
+
+    success, request = build_viva_request(input_data)
+    if not success:
+        return False, request
+
+    try:
+        completion = send_request(request)
+        
+        # Parse response into dictionary:
+        response = completion.choices[0].message.content
+        
+        try:
+            processed_response = process_ai_response(response)
+        except Exception as e:
+            return f"Error processing AI response: {e}"
+        
+        return processed_response
+
+    except resilience.CircuitOpenError:
+        raise
+    except Exception as e:
+        return False, f"Error generating questions: {str(e)}"
+
+# Sends a chat completion request within the rate limits of the client's API key, retrying transient failures
+def send_request(request):
+    def send(timeout):
+        return limiter.call(client.api_key, request, lambda: client.chat.completions.create(**request, timeout=timeout))
+    return resilience.call(send)
+
+# Method for building the chat completion request for viva questions, shared by the sync and async clients
+def build_viva_request(input_data):
     # Required fields
     required_fields = [
         'assignment_title', 'unit_name', 'question_challenging_level', 'student_year_level',
@@ -70,8 +104,7 @@ def generate_viva_questions(input_data):
     if question_challenging_level not in valid_levels:
         return False, f"Invalid question challenging level. Must be one of: {', '.join(valid_levels)}"
 
-    try:
-        prompt = f"""
+    prompt = f"""
         You are a renowned expert university professor in {unit_name} tasked with creating a comprehensive oral examination for a student's assignment. Your goal is to generate insightful questions that thoroughly assess the student's understanding, critical thinking skills, and ability to apply knowledge from their assignment
 
         Assignment Details:
@@ -86,15 +119,15 @@ def generate_viva_questions(input_data):
         - Discussion Proficiency: Can the student engage in a meaningful conversation about the concepts presented?
         - Critical Expansion: Can the student expand upon the assignment's content by exploring related ideas and concepts?
         """
-            
-        prompt += """
+
+    prompt += """
         Generate the following number of questions for each type, aligned with appropriate levels of Bloom's taxonomy:
                 """
-            
-        for question_type, count in question_counts.items():
-            prompt += f"- {question_type} questions: {count}\n"
 
-        prompt +=f"""
+    for question_type, count in question_counts.items():
+        prompt += f"- {question_type} questions: {count}\n"
+
+    prompt +=f"""
         Remember to maintain your reputation for comprehensive and insightful questioning. Your questions should not only test the student's knowledge of the assignment content but also their ability to think critically about the subject and apply concepts to new situations. Pay special attention to key themes, methodologies, and arguments presented in the assignment.
         Present the questions in the following JSON format along with what type of question they are: {{ "question_type": {{"question_1:...", "question_2:..."}}, "question_type": {{"question_1:...", "question_2:..."}}......}}
 
@@ -109,27 +142,15 @@ def generate_viva_questions(input_data):
 
         {assignment_content}
         """
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=800,
-            response_format={"type": "json_object"}
-        )
-        
-        # Parse response into dictionary:
-        response = completion.choices[0].message.content
-        
-        try:
-            processed_response = process_ai_response(response)
-        except Exception as e:
-            return f"Error processing AI response: {e}"
-        
-        return processed_response
-
-    except Exception as e:
-        return False, f"Error generating questions: {str(e)}"
+    request = {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": 800,
+        "response_format": {"type": "json_object"}
+    }
+    return True, request
 
 def process_ai_response(response):
     try:
@@ -144,7 +165,31 @@ def regenerate_questions(input_data):
     # Check if OpenAI client is initialized
     if not client:
         return False, "OpenAI client not initialized, refer to README.md"
-    
+
+    success, request = build_regen_request(input_data)
+    if not success:
+        return False, request
+
+    try:
+        # OpenAI API Call for question regeneration
+        completion = send_request(request)
+        
+        response = completion.choices[0].message.content
+        try:
+            processed_response = process_ai_response(response)
+        except Exception as e:
+            return f"Error processing AI response: {e}"
+        
+        return processed_response
+        
+    except resilience.CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Error during question regeneration: {e}")
+        return False, f"Error regenerating questions: {str(e)}"
+
+# Method for building the chat completion request for regenerating questions, shared by the sync and async clients
+def build_regen_request(input_data):
     # Required fields
     required_fields = [
         'assignment_title', 'unit_name', 'question_reason',
@@ -169,24 +214,23 @@ def regenerate_questions(input_data):
     #     {"question": "Explain the design choices made in Sprint 1.", "reason": "Not aligned with assignment content"}
     # ]
     # ## --
-    try:
-        # Regeneration prompt
-        regen_prompt = f"""
+    # Regeneration prompt
+    regen_prompt = f"""
         As a University Professor teaching {unit_name}, a student has submitted their assignment for {assignment_title}.
         The following questions have been flagged for regeneration based on markers feedback and have an associated reason:
         """
 
-        # Loop through questions, reasons, and question types
-        for i, item in enumerate(question_reason, 1):
-            question = item.get(f'question_{i}')
-            reason = item.get('reason')
-            question_type = item.get('question_type')
-            
-            if question and reason and question_type:
-                regen_prompt += f"\nQuestion {i}: {question}\nReason: {reason}\nQuestion Type: {question_type}\n"
+    # Loop through questions, reasons, and question types
+    for i, item in enumerate(question_reason, 1):
+        question = item.get(f'question_{i}')
+        reason = item.get('reason')
+        question_type = item.get('question_type')
 
+        if question and reason and question_type:
+            regen_prompt += f"\nQuestion {i}: {question}\nReason: {reason}\nQuestion Type: {question_type}\n"
 
-        regen_prompt += f"""
+
+    regen_prompt += f"""
         Remember to maintain your reputation for comprehensive and insightful questioning. Your questions should not only test the student's knowledge of the assignment content but also their ability to think critically about the subject and apply concepts to new situations. Pay special attention to key themes, methodologies, and arguments presented in the assignment.
         Please regenerate these questions based on the reasons provided, ensuring that the new questions address the concerns raised and fit within the context of the assignment content below. Only regenerate the question specified and no more.
         Present the questions in the following JSON format. {{ "question_type": {{"regenerated_question_n:...", "regenerated_question_x:..."}}, "question_type": {{"regenerated_question_n:...", "regenerated_question_X:..."}}......}}
@@ -203,26 +247,15 @@ def regenerate_questions(input_data):
         {assignment_content}
         """
 
-        # OpenAI API Call for question regeneration
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "user", "content": regen_prompt}
-            ],
-            max_tokens=800,
-            response_format={"type": "json_object"}
-        )
-        
-        response = completion.choices[0].message.content
-        try:
-            processed_response = process_ai_response(response)
-        except Exception as e:
-            return f"Error processing AI response: {e}"
-        
-        return processed_response
-        
-    except Exception as e:
-        print(f"Error during question regeneration: {e}")
+    request = {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "user", "content": regen_prompt}
+        ],
+        "max_tokens": 800,
+        "response_format": {"type": "json_object"}
+    }
+    return True, request
 
     ## -- Regen Reasons --
     # "Too vague"
@@ -0,0 +1,74 @@
+# Cancellation
+#
+# Lets long running work be stopped part way through, when its job is cancelled or runs past
+# its deadline. The work is handed a CancelToken and checks it between steps: every page of a
+# PDF extraction, every poll of an OpenAI batch, and every fraction of a second while blocked on
+# an OpenAI call through the async engine, which then cancels the request on its event loop.
+# Whatever is stopped raises Cancelled, which the job subsystem turns into the job's outcome.
+
+from threading import Event
+from time import monotonic
+
+CANCELLED = 'cancelled'                     # Reasons work was stopped
+DEADLINE = 'deadline'
+
+class Cancelled(Exception):
+    """Raised by work which stopped because its token was cancelled or its deadline passed."""
+
+    def __init__(self, reason:str):
+        super().__init__("Cancelled." if reason == CANCELLED else "Deadline exceeded.")
+        self.reason = reason
+
+class CancelToken:
+    """Cancelled by cancel(), or by itself once the deadline (in seconds from now) passes. Thread safe.
+    With start=False the deadline only starts counting down once start() is called."""
+
+    def __init__(self, deadline:float = None, clock = monotonic, start:bool = True):
+        self._clock = clock
+        self._deadline = deadline
+        self._deadlineAt = None
+        self._cancelled = Event()
+        if start:
+            self.start()
+
+    def start(self)->None:
+        """Starts the deadline counting down, if there is one and it hasn't already."""
+        if self._deadline and self._deadlineAt is None:
+            self._deadlineAt = self._clock() + self._deadline
+
+    def cancel(self)->None:
+        self._cancelled.set()
+
+    @property
+    def reason(self)->str:
+        """CANCELLED, DEADLINE, or None while the work may go on."""
+        if self._cancelled.is_set():
+            return CANCELLED
+        if self._deadlineAt is not None and self._clock() >= self._deadlineAt:
+            return DEADLINE
+        return None
+
+    def remaining(self)->float:
+        """Seconds until the deadline, None if there isn't one."""
+        if self._deadlineAt is None:
+            return None
+        return max(0.0, self._deadlineAt - self._clock())
+
+    def check(self)->None:
+        """Raises Cancelled if the work should stop."""
+        reason = self.reason
+        if reason is not None:
+            raise Cancelled(reason)
+
+    def wait(self, seconds:float)->bool:
+        """Sleeps for up to seconds, waking early if cancelled or the deadline passes. Returns True if the work should stop."""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._cancelled.wait(seconds)
+        return self.reason is not None
+
+def check(token:CancelToken)->None:
+    """token.check(), for work which may be run without a token."""
+    if token is not None:
+        token.check()
@@ -72,7 +72,10 @@ def generate_marking_guide_rubric(marking_guide_id, data):
         # Check if 'ulos' is a list and has at least one item
         if not isinstance(ulos, list) or len(ulos) == 0:
             return {"message": "The 'ulos' field must be a non-empty list."}, 400
-        # Step 4: TODO Send request to job subsystem 
+        # Step 4: Check there is room on the job queue for this staff member, then send request to job subsystem 
+        admission, wait = js.check_admission(1, staffEmail=staff_email)
+        if admission == js.SubsystemStatus.QUEUE_FULL:
+            return {"message": "Too many jobs are waiting to be generated, try again later.", "retry_after": wait}, 429
         job_status, job_id  = js.submit_new_rubric_convert(marking_guide.marking_guide_s3_file_path, staff_email, ulos, marking_guide_id)
 
         if job_status != js.SubsystemStatus.OKAY:
@@ -80,7 +83,8 @@ def generate_marking_guide_rubric(marking_guide_id, data):
         
         response_body = {
             "job_id": job_id,   
-            "status": str(job_status)
+            "status": str(job_status),
+            "estimated_wait_seconds": wait
         }
             
         return{"message" : "Rubric has been generated successfully",
@@ -3,6 +3,7 @@ from sqlalchemy import select, delete
 from src.db_instance import db
 from src.models.models_all import *
 import src.file_management as fm
+import src.job_subsystem as js
 
 def create_project(unit_code, data):
     """
@@ -118,6 +119,9 @@ def delete_project_from_db(unit_code, project_title):
         # Step 2: If project does not exist, return error message
         if project is None:
             return {"message": f"Project not found in unit {unit_code}."}, 404
+
+        # Step 2b: Stop question generation still queued or running for the project
+        js.cancel_jobs_for(unit_code, project_title)
         
         # Step 3: Retrieve all the submissions for the project
         submissions = db.session.execute(select(Submission).filter_by(project_id=project.project_id)).scalars()
@@ -2,19 +2,26 @@ import json
 import traceback
 from io import StringIO
 from flask import send_file
-from sqlalchemy import select
+from sqlalchemy import select, insert, update
+from sqlalchemy.orm import selectinload
 
 from src.db_instance import db
 from src.models.models_all import *
 import src.file_management as fm
 import src.formatting as formatting
 import src.job_subsystem as js
+import src.ai.resilience as resilience
+import src.ai.rate_limiter as limiter
+import src.job_events as events
 
-def generate_for_all(unit_code, project_title):
+_keepAliveSeconds = 15          # An SSE comment is sent this often while there are no events, so proxies keep the stream open
+
+def generate_for_all(unit_code, project_title, batch=False):
     '''
      Generate questions for all submission file for a specific project within a unit.
     :param unit_code: The unit_code of the unit 
     :param project_title: The title of the project.
+    :param batch: Send every submission as one OpenAI batch (cheaper, results within 24 hours) in a single job.
     :return: JSON object with details of the jobid and job status.
     '''
     try:
@@ -42,14 +49,36 @@ def generate_for_all(unit_code, project_title):
                 "message": "This project does not have any submissions"
             }, 404
 
+        # Step 4: Check there is room on the job queue for this unit
+        admission, wait = js.check_admission(1 if batch else len(submissions), unit_code, bulk=True)
+        if admission == js.SubsystemStatus.QUEUE_FULL:
+            return {"message": "Too many jobs are waiting to be generated, try again later.", "retry_after": wait}, 429
+        if admission == js.SubsystemStatus.INVALID_INPUT:
+            return {"message": f"This project has too many submissions to generate at once ({len(submissions)}), use ?batch=true."}, 400
+
+        # Step 5 (batch mode): Send every submission in one job
+        if batch:
+            job_status, message, job_id = js.submit_new_viva_batch(
+                                            [{ 'submission_id' : submission.submission_id, 'file_path' : submission.submission_file_path }
+                                             for submission in submissions],
+                                            project.project_name, unit.unit_name, unit.unit_level, challengeLevel,
+                                            factual_recall_count, analysis_evaluation_count, open_ended_discussion_count,
+                                            application_problem_solving_count, conceptual_understanding_count, unit_code )
+            if job_status != js.SubsystemStatus.OKAY:
+                return {"error": f"Failed to submit batch job for question generation checking status {job_status}, JobID: {job_id}, message :{str(message)}"}, 500
+            return {"message" : "Submission files have been sent for Question Generation as one batch.",
+                    "job_id" : job_id,
+                    "submission_ids" : [submission.submission_id for submission in submissions],
+                    "estimated_wait_seconds" : wait}, 200
+
         jobs = []
 
-        #Step 4 : Send Each submission to _submit_new_job( sub_id, qns_count, unit code, level )
+        #Step 5 : Send Each submission to _submit_new_job( sub_id, qns_count, unit code, level ), behind single submissions
         for submission in submissions:
             job_status, message, job_id = js.submit_new_viva_gen(submission.submission_id, submission.submission_file_path,
                                             project.project_name, unit.unit_name, unit.unit_level, challengeLevel, 
                                             factual_recall_count, analysis_evaluation_count, open_ended_discussion_count, 
-                                            application_problem_solving_count, conceptual_understanding_count )
+                                            application_problem_solving_count, conceptual_understanding_count, unit_code, bulk=True )
             if job_status != js.SubsystemStatus.OKAY:            
                 return {"error": f"Failed to submit job for question generation checking status {job_status}, JobID: {job_id}, message :{str(message)}"}, 500
 
@@ -59,7 +88,8 @@ def generate_for_all(unit_code, project_title):
                     "status": str(job_status)
             })
         return{"message" : "Submission files have been sent for Question Generation.",
-                    "jobs" : jobs}, 200
+                    "jobs" : jobs,
+                    "estimated_wait_seconds" : wait}, 200
     except Exception as e:
             return {"message": f"An error occurred while generating questions.", "error": str(e)}, 500
 
@@ -90,11 +120,14 @@ def generate_for_submission(unit_code, project_title, submission_id):
     # Step 3: Retrieve submission
     submission = db.session.execute(select(Submission).filter_by(submission_id = submission_id)).scalar_one_or_none()
     
-    # Step 4 : Send the submission to _submit_new_job( sub_id, qns_count, unit code, level )
+    # Step 4 : Check there is room on the job queue, then send the submission to _submit_new_job( sub_id, qns_count, unit code, level )
+    admission, wait = js.check_admission(1, unit_code)
+    if admission == js.SubsystemStatus.QUEUE_FULL:
+        return {"message": "Too many jobs are waiting to be generated, try again later.", "retry_after": wait}, 429
     job_status, message, job_id = js.submit_new_viva_gen(submission.submission_id, submission.submission_file_path,
                                             project.project_name, unit.unit_name, unit.unit_level, challengeLevel, 
                                             factual_recall_count, analysis_evaluation_count, open_ended_discussion_count, 
-                                            application_problem_solving_count, conceptual_understanding_count )
+                                            application_problem_solving_count, conceptual_understanding_count, unit_code )
     # Step 5 : Check the job status
     if job_status != js.SubsystemStatus.OKAY:            
         return {"error": f"Failed to submit job for question generation checking status {job_status}, JobID: {job_id}, message :{str(message)}"}, 500
@@ -103,7 +136,8 @@ def generate_for_submission(unit_code, project_title, submission_id):
         return{
             "message": f"Submission file  {submission_id} has been sent for Question Generation",
             "job_status": str(job_status),
-            "job_id": job_id}, 200
+            "job_id": job_id,
+            "estimated_wait_seconds": wait}, 200
     except Exception as e:
             return {"message": f"An error occurred while generating questions for submission ID {submission_id}.", "error": str(e)}, 500
 
@@ -143,7 +177,53 @@ def upload_generated_files(submission_id, generated_file_name, generated_file_pa
         except Exception as e:
             db.session.rollback()
             return {"message": "An error occurred while saving generated data to DB", "error": str(e)}, 500
-    
+
+def upload_generated_files_batch(generated_files, status):
+        '''
+            Helper method to add the details of many generated question files to the database in one transaction,
+            for the job subsystem to save every job which finished at about the same time together.
+            :param generated_files: list of (submission_id, generated_file_name, generated_file_path).
+            :status : status the submissions are set to eg. Questions generated
+        '''
+        if not generated_files:
+            return {"message": "No generated files to save."}, 201
+
+        # Step 1 : Insert every GeneratedQnFile record, and update the status of their submissions, in one transaction
+        try:
+            db.session.execute(insert(GeneratedQnFile), [
+                {
+                    "generated_qn_file_name": generated_file_name,
+                    "generated_qn_file_path": generated_file_path,
+                    "submission_id": submission_id
+                }
+                for submission_id, generated_file_name, generated_file_path in generated_files
+            ])
+            submission_ids = {submission_id for submission_id, _, _ in generated_files}
+            db.session.execute(update(Submission).where(Submission.submission_id.in_(submission_ids)).values(submission_status = status))
+            db.session.commit()
+            return {
+                "message": "Questions are successfully generated for all Submssions.",
+            }, 201
+        except Exception as e:
+            db.session.rollback()
+            return {"message": "An error occurred while saving generated data to DB", "error": str(e)}, 500
+
+def get_submissions_for_packaging(submission_ids):
+    '''
+    Retrieve the submissions whose questions are about to be packaged, with their projects and question banks,
+    in a few queries rather than a few per submission.
+    :param submission_ids: The IDs of the submissions
+    :return: dict of submission_id -> Submission, without any which don't exist
+    '''
+    if not submission_ids:
+        return {}
+    submissions = db.session.execute(
+        select(Submission)
+        .where(Submission.submission_id.in_(set(submission_ids)))
+        .options(selectinload(Submission.for_project).selectinload(Project.qn_banks))
+    ).scalars().all()
+    return {submission.submission_id: submission for submission in submissions}
+
 def regenerate_questions(unit_code, project_title, submission_id, data):
     '''
     Re-Generate questions for a specific submission
@@ -171,9 +251,12 @@ def regenerate_questions(unit_code, project_title, submission_id, data):
     question_files_generated = db.session.execute(
         select(GeneratedQnFile).filter_by(submission_id=submission_id)).scalars().all()
 
-    # Step 4 : Send the submission to _submit_new_job( sub_id, qns_count, unit code, level ) 
+    # Step 4 : Check there is room on the job queue, then send the submission to _submit_new_job( sub_id, qns_count, unit code, level ) 
+    admission, wait = js.check_admission(1, unit_code)
+    if admission == js.SubsystemStatus.QUEUE_FULL:
+        return {"message": "Too many jobs are waiting to be generated, try again later.", "retry_after": wait}, 429
     job_status, message, job_id = js.submit_new_viva_regen(submission.submission_id, submission.submission_file_path, project.project_name,
-                                                        unit.unit_name, question_reason_list, question_files_generated[-1].generated_qn_file_path)
+                                                        unit.unit_name, question_reason_list, question_files_generated[-1].generated_qn_file_path, unit_code)
     
     # Step 5 : Check the job status
     if job_status != js.SubsystemStatus.OKAY:            
@@ -184,7 +267,8 @@ def regenerate_questions(unit_code, project_title, submission_id, data):
         "submission_id": submission_id,
         "message": "Submission file has been sent for Question Re-Generation",
         "job_status": str(job_status),
-        "job_id": job_id}, 200
+        "job_id": job_id,
+        "estimated_wait_seconds": wait}, 200
     except Exception as e:
         return {"message":f"An error occurred while regenerating questions for submission {submission_id}.", "error": str(e)}, 500
 
@@ -250,31 +334,117 @@ def get_questions_for_submission(submission_id):
         return {"message": f"An error occurred while retrieving questions for submission ID {submission_id}.", "error": str(e)}, 500
 
 def get_job_status(job_id):
+    '''
+    Get the status of a question generation job from the job subsystem's status registry.
+    :param job_id: The ID of the job returned when the job was submitted.
+    :return: JSON object with the job state, timestamps, result S3 path and error if any.
+    '''
     try:
         # Query the job status from the JobSubsystem
-        job_status = get_job_status(job_id)  
+        status, job = js.get_job_status(job_id)
+        if status != js.SubsystemStatus.OKAY:
+            return {"message": f"Job {job_id} not found.", "job_id": job_id}, 404
 
         # Check if current job status
-        if job_status == js.SubsystemStatus.COMPLETED_JOB:
-            return {
-                "message": "Question generation is completed.",
-                "job_id": job_id,
-                "status": "COMPLETED", 
-            }, 200
-        elif job_status == js.SubsystemStatus.AWAITING_INSTANCE:
-            return {
-                "message": "Question generation is in progress.",
-                "job_id": job_id, 
-                "status": "IN_PROGRESS"
-            }, 200
-        else:
-            return {
-                "message": "Question generation failed.",
-                "job_id": job_id, 
-                "status": "FAILED"
-            }, 200
+        messages = {
+            js.JobState.QUEUED.value: "Question generation is queued.",
+            js.JobState.RUNNING.value: "Question generation is in progress.",
+            js.JobState.DONE.value: "Question generation is completed.",
+            js.JobState.FAILED.value: "Question generation failed.",
+            js.JobState.CANCELLED.value: "Question generation was cancelled."
+        }
+        return {"message": messages[job["status"]], **job}, 200
     except Exception as e :
-            return {"message": "An error occurred while getting the status.", "error": str(e)}, 500
+            return {"message": f"An error occurred while getting the status for job {job_id}.", "error": str(e)}, 500
+
+def cancel_job(job_id):
+    '''
+    Cancel a queued or running job. A running job stops at its next check and frees its worker.
+    :param job_id: The ID of the job returned when the job was submitted.
+    :return: JSON object with the job's status after cancelling, 409 if it had already finished.
+    '''
+    try:
+        status, job = js.cancel_job(job_id)
+        if status == js.SubsystemStatus.INVALID_INPUT:
+            return {"message": f"Job {job_id} not found.", "job_id": job_id}, 404
+        if status == js.SubsystemStatus.WRONG_JOB:
+            return {"message": f"Job {job_id} has already finished.", **job}, 409
+        if status != js.SubsystemStatus.OKAY:
+            return {"message": f"Job {job_id} could not be cancelled.", "job_id": job_id, "error": status.name}, 500
+        if job["status"] == js.JobState.CANCELLED.value:
+            return {"message": f"Job {job_id} was cancelled.", **job}, 200
+        return {"message": f"Job {job_id} is being stopped.", **job}, 202
+    except Exception as e:
+        return {"message": f"An error occurred while cancelling job {job_id}.", "error": str(e)}, 500
+
+def _event_stream(subscription, first=None, untilDone=False):
+    '''
+    Yields a subscription's events as Server-Sent Events until the client disconnects.
+    :param first: an already formatted message to send before any events.
+    :param untilDone: end the stream after the first persisted, failed or cancelled event.
+    '''
+    try:
+        if first is not None:
+            yield first
+        while True:
+            event = subscription.get(_keepAliveSeconds)
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield events.format_sse(event)
+            if untilDone and event['event'] in events.TERMINAL:
+                return
+    finally:
+        subscription.close()
+
+def stream_job_events(job_id):
+    '''
+    Stream the progress of a question generation job, replacing polling /job_status.
+    :param job_id: The ID of the job returned when the job was submitted.
+    :return: A generator of SSE messages, starting with a "status" message holding the job's current status
+             and ending once the job has been persisted, failed or been cancelled, or a JSON error with its status code.
+    '''
+    # Subscribe before reading the status so nothing happening in between is missed
+    subscription = events.subscribe(jobID=job_id)
+    status, job = js.get_job_status(job_id)
+    if status != js.SubsystemStatus.OKAY:
+        subscription.close()
+        return {"message": f"Job {job_id} not found.", "job_id": job_id}, 404
+
+    first = f"event: status\ndata: {json.dumps(job)}\n\n"
+    if job["status"] in (js.JobState.DONE.value, js.JobState.FAILED.value, js.JobState.CANCELLED.value):
+        subscription.close()
+        return iter([first]), 200
+    return _event_stream(subscription, first, untilDone=True), 200
+
+def stream_project_events(unit_code, project_title):
+    '''
+    Stream the progress of every question generation job of a project, i.e a whole generate_for_all run.
+    :param unit_code: The unit_code of the unit
+    :param project_title: The title of the project.
+    :return: A generator of SSE messages, open until the client disconnects.
+    '''
+    return _event_stream(events.subscribe(project=events.project_key(unit_code, project_title))), 200
+
+def get_ai_status():
+    '''
+    Get the health of the AI provider as seen by this process.
+    :return: JSON object with the circuit breaker state, retry counters and rate limiter counters per API key.
+    '''
+    try:
+        return {"resilience": resilience.get_metrics(), "rate_limits": limiter.get_stats()}, 200
+    except Exception as e:
+        return {"message": "An error occurred while getting the AI status.", "error": str(e)}, 500
+
+def get_job_stats():
+    '''
+    Get the load on each stage of the job pipeline in this process.
+    :return: JSON object with the jobs waiting on the queue, and the queue depth, wait and processing times of every stage.
+    '''
+    try:
+        return js.get_pipeline_stats(), 200
+    except Exception as e:
+        return {"message": "An error occurred while getting the job pipeline stats.", "error": str(e)}, 500
 
 #TODO => Check if pdf is being generated from the JSON file stored on disk
 def download_questions(submission_id, format):
@@ -325,11 +495,12 @@ def download_questions(submission_id, format):
         return {"message": f"An error occurred while downloading the generated questions for submission ID {submission_id}", "error": str(e)}, 500
 
 
-def package_all_questions(submission_id, ai_questions):
+def package_all_questions(submission_id, ai_questions, submission=None):
     """
     Package static questions, random questions from the question bank, and AI-generated questions 
     into a single JSON file and save it to disk or S3.
     :param submission_id: The ID of the submission
+    :param submission: The submission, if already retrieved (see get_submissions_for_packaging)
     :param unit_code: The unit code of the project
     :param project_title: The title of the project
     :param ai_questions: A list of AI-generated questions
@@ -337,7 +508,8 @@ def package_all_questions(submission_id, ai_questions):
     """
     
     # Step 1: Retrieve the submission based on the submission_id
-    submission = db.session.execute(select(Submission).filter_by(submission_id=submission_id)).scalar_one_or_none()
+    if submission is None:
+        submission = db.session.execute(select(Submission).filter_by(submission_id=submission_id)).scalar_one_or_none()
     # Step 1.1: Retrieve the project the submission is under
     project = submission.for_project
     if project is None:
@@ -30,6 +30,10 @@ def create_rubric(data):
         existing_staff = db.session.execute(select(Staff).filter_by(staff_email=staff_email)).scalar_one_or_none()
         if existing_staff is None:
             return{"message": f"Learning design staff member with email {staff_email} not found"}, 404
+        # Check there is room on the job queue for this staff member
+        admission, wait = js.check_admission(1, staffEmail=staff_email)
+        if admission == js.SubsystemStatus.QUEUE_FULL:
+            return {"message": "Too many jobs are waiting to be generated, try again later.", "retry_after": wait}, 429
         # Send the `data` to the function in the job subsystem responsible for sending a rubric generation request to the AI module
         job_status, job_id  = js.submit_new_rubric_gen(assessment_description, staff_email, criteria, ulos)
         
@@ -38,7 +42,8 @@ def create_rubric(data):
         
         response_body = {
                 "job_id": job_id,   
-                "status": str(job_status)
+                "status": str(job_status),
+                "estimated_wait_seconds": wait
         }
         
         return{"message" : "Rubric has been generated successfully",
@@ -207,31 +212,28 @@ def fetch_all_rubrics(staff_email):
         return {"message": "An error occurred while retrieving all the rubrics.", "error": str(e)}, 500 
 
 def get_job_status(job_id):
+    '''
+    Get the status of a rubric generation job from the job subsystem's status registry.
+    :param job_id: The ID of the job returned when the job was submitted.
+    :return: JSON object with the job state, timestamps, result S3 path and error if any.
+    '''
     try:
         # Query the job status from the JobSubsystem
-        job_status = js.get_job_status(job_id)  
+        status, job = js.get_job_status(job_id)
+        if status != js.SubsystemStatus.OKAY:
+            return {"message": f"Job {job_id} not found.", "job_id": job_id}, 404
 
         # Check if current job status
-        if job_status == js.SubsystemStatus.COMPLETED_JOB:
-            return {
-                "message": "Rubric generation is completed.",
-                "job_id": job_id,
-                "status": "COMPLETED", 
-            }, 200
-        elif job_status == js.SubsystemStatus.AWAITING_INSTANCE:
-            return {
-                "message": "Rubric generation is in progress.",
-                "job_id": job_id, 
-                "status": "IN_PROGRESS"
-            }, 200
-        else:
-            return {
-                "message": "Rubric generation failed.",
-                "job_id": job_id, 
-                "status": "FAILED"
-            }, 200
+        messages = {
+            js.JobState.QUEUED.value: "Rubric generation is queued.",
+            js.JobState.RUNNING.value: "Rubric generation is in progress.",
+            js.JobState.DONE.value: "Rubric generation is completed.",
+            js.JobState.FAILED.value: "Rubric generation failed.",
+            js.JobState.CANCELLED.value: "Rubric generation was cancelled."
+        }
+        return {"message": messages[job["status"]], **job}, 200
     except Exception as e :
-            return {"message": "An error occurred while getting the status for {rubric_id}.", "error": str(e)}, 500
+            return {"message": f"An error occurred while getting the status for job {job_id}.", "error": str(e)}, 500
 
 def download_rubric_as(rubric_id, format):
     rubric = db.session.execute(select(RubricGenerated).filter_by(rubric_id=rubric_id)).scalar_one_or_none()
@@ -4,64 +4,86 @@ from sqlalchemy import text
 from src.db_instance import db
 from src.models.models_all import *
 import src.file_management as fm
+import src.job_subsystem as js
 
 def batch_upload_pdfs(unit_code, project_title, staff_email, files):
     """
     Upload multiple pdfs submissions for a specific project within a unit.
+    Files are uploaded concurrently and their submissions saved in a single transaction,
+    a file which fails is reported back without aborting the rest of the batch.
 
     :param unit_code: The code of the unit.
     :param project_title: The title of the project.
+    :param staff_email: The email of the staff member uploading the files.
     :param files: The uploaded PDF files.
-    :return: JSON object with details of the uploaded files or an error message.
+    :return: JSON object with details of the uploaded & failed files or an error message.
     """
-    # Step 1: Retrieve the project for which submission is done
+    # Step 1: Retrieve the project for which submission is done, and the uploader
     project = db.session.execute(select(Project).filter_by(unit_code = unit_code, project_name = project_title)).scalar_one_or_none()
 
     if project is None:
         return {"message": "Project not found"}, 404
-    
-    # create am empty list to store submission details
-    uploaded_files = []
-    # Step 2: Loop through each file
+
+    staff = db.session.execute(select(Staff).filter_by(staff_email = staff_email)).scalar_one_or_none()
+
+    if staff is None:
+        return {"message": "Staff not found"}, 404
+
+    failed_files = []
+    # Step 2: Validate file extensions, invalid files are reported and skipped
+    valid_files = []
     for file in files:
-        # Step 2.1: Validate file extension
-        if not fm._allowed_filename(file.filename):
-            return {"message": f"File {file.filename} has an invalid extension"}, 400
-        
-        # Step 2.2: Upload the file using file management
-        file_status, file_path = fm.store_file_storage(file)
+        if fm._allowed_filename(file.filename):
+            valid_files.append(file)
+        else:
+            failed_files.append({"submission_file_name": file.filename, "error": "Invalid file extension"})
+
+    # Step 3: Upload the valid files concurrently using file management
+    new_submissions = []
+    for file, (file_status, file_path) in zip(valid_files, fm.store_file_storages(valid_files)):
         if file_status != fm.FileStatus.OKAY:
-            return {"message": f"File {file.filename} upload failed", "error": file_status.name}, 400
-    
-        # Step 3: Get the staff details of the uploader using the staff_email
-        staff = db.session.execute(select(Staff).filter_by(staff_email = staff_email)).scalar_one_or_none()
-        # Step 4: Store the file details in the database (Submission table)
-        new_submission = Submission(
+            failed_files.append({"submission_file_name": file.filename, "error": file_status.name})
+            continue
+
+        new_submissions.append(Submission(
             submission_file_name = file.filename,
             submission_file_path = file_path,
-            submission_status = "Uploaded", 
+            submission_status = "Uploaded",
             uploader_id = staff.staff_id,
             project_id = project.project_id,
             unit_code = unit_code,
-        )
-        
-        db.session.add(new_submission)
+        ))
+
+    # Step 4: Store every uploaded file in the database (Submission table) in one transaction
+    if new_submissions:
+        db.session.add_all(new_submissions)
         try:
-            # Step 4: Commit the transaction to the database
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            return {"message": "An error occurred while saving submission data", "error": str(e)}, 500
-        # Add file details to the response list
-        uploaded_files.append({
-            "submission_id": new_submission.submission_id,
-            "submission_file_name": new_submission.submission_file_name,
-            "submission_status": new_submission.submission_status
-        })
-        
+            # Nothing refers to the uploaded files now, remove them again
+            for submission in new_submissions:
+                fm.del_file(fm.key_of(submission.submission_file_path))
+            return {"message": "An error occurred while saving submission data", "error": str(e),
+                    "failed_files": failed_files}, 500
+
+    uploaded_files = [{
+            "submission_id": submission.submission_id,
+            "submission_file_name": submission.submission_file_name,
+            "submission_status": submission.submission_status
+        } for submission in new_submissions]
+
+    if not uploaded_files:
+        return {
+                "message": "No files were uploaded",
+                "uploaded_files": uploaded_files,
+                "failed_files": failed_files
+            }, 400
+
     return {
-            "message": "Files successfully uploaded",
-            "uploaded_files": uploaded_files
+            "message": "Files successfully uploaded" if not failed_files else "Some files failed to upload",
+            "uploaded_files": uploaded_files,
+            "failed_files": failed_files
         }, 201
 
 
@@ -124,6 +146,9 @@ def delete_all_files(unit_code, project_title):
 
         if project is None:
             return {"message": "Project not found"}, 404
+
+        # Step 1b: Stop question generation still queued or running for the submissions
+        js.cancel_jobs_for(unit_code, project_title)
         
         # Step 2: Retrieve all submissions related to the project
         submissions = db.session.execute(select(Submission).filter_by(unit_code = unit_code, project_id = project.project_id)).scalar_one_or_none()
@@ -154,6 +179,9 @@ def delete_file_from_db(unit_code, project_title, submission_id):
     submission = db.session.execute(select(Submission).filter_by(submission_id = submission_id)).scalar_one_or_none()
     if submission is None:
         return {"message": f"Submission with ID {submission_id} not found"}, 404
+
+    # Stop question generation still queued or running for the submission
+    js.cancel_jobs_for(unit_code, project_title, submission_id)
     
     filestatus = fm.del_file(submission.submission_file_name)
     if filestatus != fm.FileStatus.OKAY:
@@ -3,6 +3,7 @@ from sqlalchemy import select
 from src.db_instance import db
 from src.models.models_all import *
 import src.file_management as fm
+import src.job_subsystem as js
 
 def create_unit(data):
     """
@@ -136,6 +137,9 @@ def delete_unit_from_db(unit_code):
         # If the unit does not exist, return an error message
         if unit is None:
             return {"message": "Unit not found"}, 404
+
+        # Step 1b: Stop question generation still queued or running for any of the unit's projects
+        js.cancel_jobs_for(unit_code)
         
         # Step 2: Retrieve all the projects for the unit
         projects = db.session.execute(select(Project).filter_by(unit_code=unit_code)).scalars()
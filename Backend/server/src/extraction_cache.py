@@ -0,0 +1,226 @@
+# Extraction Cache
+#
+# Caches the output of pdf_to_text.extract_text_and_tables_from_pdf keyed by the
+# SHA-256 of the PDF bytes, so regenerating questions for a submission that has
+# already been parsed skips PyMuPDF & pdfplumber entirely.
+#
+# There are two tiers: a local directory of JSON files with LRU eviction, and a
+# sidecar JSON object in the S3 bucket which is shared by every instance.
+# Hits, misses and evictions are exported at /metrics (see src/metrics.py).
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+
+import src.file_management as fm
+import src.ai.pdf_to_text as ptt
+import src.metrics as metrics
+
+_S3_PREFIX = '_extraction_cache/'           # Bucket prefix the sidecar objects are stored under.
+
+# Settings
+_cacheDir: str = None                       # Local tier directory, None until initialised.
+_maxEntries: int = 512                      # Local tier is evicted (least recently used first) past this many entries...
+_maxBytes: int = 256 * 1024 * 1024          # ...or past this many bytes on disk.
+_useS3: bool = True                         # Enables the S3 sidecar tier.
+
+# Internal Variables
+_index: OrderedDict = OrderedDict()         # Digest -> size in bytes of the local file, least recently used first.
+_indexBytes: int = 0
+_lock: Lock = Lock()
+_stats: dict = { 'local_hits' : 0, 's3_hits' : 0, 'misses' : 0, 'evictions' : 0 }
+
+# Metrics, unlike _stats these aren't reset by clear()
+_hits = metrics.counter('extraction_cache_hits_total', 'PDF extractions served from the cache, by tier.', ('tier',))
+_misses = metrics.counter('extraction_cache_misses_total', 'PDF extractions missing from both tiers of the cache.')
+_evictions = metrics.counter('extraction_cache_evictions_total', 'Entries evicted from the local tier of the extraction cache.')
+
+def initialise(cacheDir:str = None, maxEntries:int = 512, maxBytes:int = 256 * 1024 * 1024, useS3:bool = True)->bool:
+    """Sets up the local tier in cacheDir (a temp directory by default), indexing any entries already on disk."""
+    global _cacheDir, _maxEntries, _maxBytes, _useS3, _index, _indexBytes
+
+    if maxEntries <= 0 or maxBytes <= 0:
+        return False
+
+    if cacheDir is None:
+        cacheDir = os.path.join(tempfile.gettempdir(), 'extraction_cache')
+    os.makedirs(cacheDir, exist_ok=True)
+
+    with _lock:
+        _cacheDir = cacheDir
+        _maxEntries = maxEntries
+        _maxBytes = maxBytes
+        _useS3 = useS3
+
+        # Rebuild the LRU order from modification times, which are bumped on every hit.
+        entries = []
+        for name in os.listdir(_cacheDir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(_cacheDir, name)
+            entries.append((os.path.getmtime(path), name[:-5], os.path.getsize(path)))
+        entries.sort()
+
+        _index = OrderedDict((digest, size) for _, digest, size in entries)
+        _indexBytes = sum(_index.values())
+        _evict()
+    return True
+
+def digest_of(pdf_bytes:bytes)->str:
+    """The cache key of a PDF. It is versioned by the extractor so a change to its output doesn't serve stale entries."""
+    return f"{hashlib.sha256(pdf_bytes).hexdigest()}-v{ptt.EXTRACTION_VERSION}"
+
+def get_or_extract(pdf_bytes:bytes, extractor=ptt.extract_text_and_tables_from_pdf):
+    """Returns the extraction result for the given PDF bytes, running extractor only on a miss in both tiers.
+    Results that aren't a (text_by_page, tables_by_page) pair (i.e extraction errors) are never cached."""
+    digest = digest_of(pdf_bytes)
+
+    result = _get_local(digest)
+    if result is not None:
+        _count('local_hits')
+        _hits.inc(tier='local')
+        return result
+
+    result = _get_s3(digest)
+    if result is not None:
+        _count('s3_hits')
+        _hits.inc(tier='s3')
+        _put_local(digest, _encode(result))
+        return result
+
+    _count('misses')
+    _misses.inc()
+    result = extractor(io.BytesIO(pdf_bytes))
+    if isinstance(result, tuple) and len(result) == 2:
+        data = _encode(result)
+        _put_local(digest, data)
+        _put_s3(digest, data)
+    return result
+
+def get_cache_stats()->dict:
+    """Hit / miss counters and the current size of the local tier."""
+    with _lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_index)
+        stats['bytes'] = _indexBytes
+    return stats
+
+def clear()->None:
+    """Empties the local tier and resets the counters. The S3 tier is left untouched."""
+    global _indexBytes
+    with _lock:
+        for digest in list(_index.keys()):
+            _remove_local_file(digest)
+        _index.clear()
+        _indexBytes = 0
+        for key in _stats:
+            _stats[key] = 0
+
+def _count(stat:str)->None:
+    with _lock:
+        _stats[stat] += 1
+
+def _encode(result)->bytes:
+    text_by_page, tables_by_page = result
+    return json.dumps({ 'text_by_page' : text_by_page, 'tables_by_page' : tables_by_page }).encode('utf-8')
+
+def _decode(data:bytes):
+    loaded = json.loads(data)
+    # JSON turns the page number keys into strings, restore them.
+    tables_by_page = { int(page) : tables for page, tables in loaded['tables_by_page'].items() }
+    return loaded['text_by_page'], tables_by_page
+
+def _local_path(digest:str)->str:
+    return os.path.join(_cacheDir, digest + '.json')
+
+def _get_local(digest:str):
+    if _cacheDir is None:
+        return None
+    with _lock:
+        if digest not in _index:
+            return None
+        _index.move_to_end(digest)
+    path = _local_path(digest)
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+        os.utime(path)
+        return _decode(data)
+    except (OSError, ValueError, KeyError):
+        # The entry was evicted or damaged underneath us, treat it as a miss.
+        _drop_local(digest)
+        return None
+
+def _put_local(digest:str, data:bytes)->None:
+    global _indexBytes
+    if _cacheDir is None:
+        return
+    path = _local_path(digest)
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmpPath, 'wb') as file:
+            file.write(data)
+        os.replace(tmpPath, path)
+    except OSError as e:
+        print(f"Failed to write extraction cache entry {digest}: {e}")
+        return
+    with _lock:
+        _indexBytes -= _index.pop(digest, 0)
+        _index[digest] = len(data)
+        _indexBytes += len(data)
+        _evict()
+
+def _drop_local(digest:str)->None:
+    global _indexBytes
+    with _lock:
+        if digest in _index:
+            _indexBytes -= _index.pop(digest)
+            _remove_local_file(digest)
+
+def _evict()->None:
+    """Removes least recently used local entries until within limits. Must hold _lock."""
+    global _indexBytes
+    while len(_index) > _maxEntries or (_indexBytes > _maxBytes and len(_index) > 1):
+        digest, size = _index.popitem(last=False)
+        _indexBytes -= size
+        _remove_local_file(digest)
+        _stats['evictions'] += 1
+        _evictions.inc()
+
+def _remove_local_file(digest:str)->None:
+    try:
+        os.remove(_local_path(digest))
+    except OSError:
+        pass
+
+def _get_s3(digest:str):
+    if not _useS3:
+        return None
+    try:
+        status, data = fm.get_object_bytes(_S3_PREFIX + digest + '.json')
+        if status != fm.FileStatus.OKAY:
+            return None
+        return _decode(data)
+    except Exception as e:
+        print(f"Failed to read extraction cache entry {digest} from S3: {e}")
+        return None
+
+def _put_s3(digest:str, data:bytes)->None:
+    if not _useS3:
+        return
+    try:
+        fm.put_object_bytes(_S3_PREFIX + digest + '.json', data)
+    except Exception as e:
+        print(f"Failed to write extraction cache entry {digest} to S3: {e}")
+
+def _local_tier(stat:str):
+    def read()->int:
+        return get_cache_stats()[stat]
+    return read
+
+metrics.gauge('extraction_cache_entries', 'Entries in the local tier of the extraction cache.', function=_local_tier('entries'))
+metrics.gauge('extraction_cache_bytes', 'Bytes on disk in the local tier of the extraction cache.', function=_local_tier('bytes'))
@@ -17,16 +17,47 @@ from markdown_pdf import MarkdownPdf, Section
 import _io
 import boto3
 from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 import io
+import re
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
 from urllib.parse import urlparse
+import src.metrics as metrics
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html
 # _UPLOAD_FOLDER = 'file/'
 _UPLOAD_FOLDER =  os.getenv('UPLOAD_FOLDER')
 _EXTENSIONS = {'csv', 'pdf', 'md', 'json'}
-
-# # Initialize S3 client
-# s3 = boto3.client('s3')
-# S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
+_UPLOAD_WORKERS = 8                         # Number of files store_file_storages uploads at once
+# Files over the threshold are sent as a multipart upload, a few parts at a time
+_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=4)
+_RESERVED_NAME_LIMIT = 1024                 # Number of recently allocated names remembered by _rename_for_duplicates
+
+# Read cache for get_object_bytes, entries are served as is for _readCacheTTL seconds and revalidated with a conditional GET after.
+# Hits, revalidations and misses are exported at /metrics alongside the extraction cache (see src/metrics.py)
+_readCacheMaxBytes: int = 64 * 1024 * 1024
+_readCacheTTL: float = 30.0
+_READ_CACHE_MAX_ENTRY = 4 * 1024 * 1024     # Objects bigger than this are never cached
+
+_readCache: OrderedDict = OrderedDict()     # Key -> (ETag, content, time fetched), least recently used first
+_readCacheBytes: int = 0
+_readCacheLock: Lock = Lock()
+_readCacheStats: dict = { 'hits' : 0, 'revalidated' : 0, 'misses' : 0 }
+
+# Read cache metrics, unlike _readCacheStats these aren't reset by clear_read_cache()
+_readCacheHits = metrics.counter('file_read_cache_hits_total', 'Object reads served from the read cache without asking S3.')
+_readCacheRevalidations = metrics.counter('file_read_cache_revalidations_total', 'Stale read cache entries S3 confirmed unchanged.')
+_readCacheMisses = metrics.counter('file_read_cache_misses_total', 'Object reads downloaded from S3.')
+
+_reservedNames: OrderedDict = OrderedDict()
+_reservedNamesLock: Lock = Lock()
+
+# S3 client & bucket, set by initialise()
+s3 = None
+S3_BUCKET_NAME = None
 
 class FileStatus(Enum):
     """A status code returned by functions in this file."""
@@ -74,7 +105,7 @@ def _put_file_default_path(file:FileStorage, name:str)->str:
     """Uploads a given file to S3 under a filename and returns the path."""
     name = _rename_for_duplicates(name)
     try:
-        s3.upload_fileobj(file, S3_BUCKET_NAME, name)
+        s3.upload_fileobj(file, S3_BUCKET_NAME, name, Config=_TRANSFER_CONFIG)
     except ClientError as e:
         # Handle specific AWS errors such as permission issues or missing credentials
         raise RuntimeError(f"Failed to upload to S3: {e.response['Error']['Message']}")
@@ -85,28 +116,45 @@ def _put_file_default_path(file:FileStorage, name:str)->str:
     return f"s3://{S3_BUCKET_NAME}/{name}"
 
 def _rename_for_duplicates(name: str) -> str:
-    """Creates a renamed file in the event that there are other files with the same name."""
+    """Creates a renamed file in the event that there are other files with the same name.
+    Takes a single listing of every key sharing the name's stem and picks the next free _i suffix locally."""
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html
+    comps = name.rsplit('.', 1)
+    stem = comps[0]
+    ext = f".{comps[1]}" if len(comps) > 1 else ''
+    pattern = re.compile(re.escape(stem) + r'(?:_(\d+))?' + re.escape(ext))
+
     try:
-        # Initial check for the given name
-        objects = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=name)
-        
-        if 'Contents' not in objects:
-            return name
-        # Split the name into base and extension
-        comps = name.rsplit('.', 1)
-        i = 0
-        # Generate a new name if the original name exists
-        while True:
-            new_name = f"{comps[0]}_{i}.{comps[1]}" if i > 0 else name
-            # Check if the new_name exists in the bucket
-            response = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=new_name)
-            if 'Contents' not in response or len(response['Contents']) == 0:
-                return new_name  # Return the unique name if no such file exists
-            i += 1
+        objects = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=stem)
     except Exception as e:
         raise RuntimeError(f"Error checking for duplicates: {str(e)}")
 
+    if objects.get('IsTruncated'):
+        # Over a thousand keys share this stem, rather than paging through them all use a name that can't collide
+        return f"{stem}_{uuid.uuid4().hex}{ext}"
+
+    with _reservedNamesLock:
+        taken = set(_reservedNames)
+        taken.update(obj['Key'] for obj in objects.get('Contents', []))
+
+        # The original name maps to suffix 0, existing copies to their _i suffix
+        used = set()
+        for key in taken:
+            match = pattern.fullmatch(key)
+            if match:
+                used.add(int(match.group(1)) if match.group(1) else 0)
+
+        new_name = name if 0 not in used else f"{stem}_{max(used) + 1}{ext}"
+        _reserve_name(new_name)
+    return new_name
+
+def _reserve_name(name: str) -> None:
+    """Remembers a name handed out by _rename_for_duplicates, so concurrent uploads in this process
+    can't pick the same one before the first has landed in the bucket. Must hold _reservedNamesLock."""
+    _reservedNames[name] = None
+    _reservedNames.move_to_end(name)
+    while len(_reservedNames) > _RESERVED_NAME_LIMIT:
+        _reservedNames.popitem(last=False)
 
 def store_file_req(req:request) -> (FileStatus, str):
     """Parses a request for a file and returns a status code & the path it was stored at."""
@@ -134,6 +182,25 @@ def store_file_storage(file:FileStorage)->(FileStatus, str):
         return FileStatus.OKAY,path
     return FileStatus.BAD_EXTENSION,str()
 
+def store_file_storages(files:list)->list:
+    """Stores a batch of files concurrently and returns a (status code, path) pair for each, in the same order.
+    A failed upload is reported as UNKNOWN_ERR with the error message in place of the path, it doesn't stop the others."""
+    def store(file:FileStorage)->(FileStatus, str):
+        try:
+            return store_file_storage(file)
+        except RuntimeError as e:
+            print(f"Failed to store {file.filename}: {e}")
+            return FileStatus.UNKNOWN_ERR, str(e)
+
+    if len(files) <= 1:
+        return [store(file) for file in files]
+    with ThreadPoolExecutor(max_workers=min(_UPLOAD_WORKERS, len(files))) as pool:
+        return list(pool.map(store, files))
+
+def key_of(path:str)->str:
+    """The bucket key of a full S3 URI (e.g., 's3://bucket-name/path/to/file' -> 'path/to/file')."""
+    return urlparse(path).path.lstrip('/')
+
 def get_path(sID:int)->(FileStatus, str):
     """Returns the path of a given file based on its ID"""
 
@@ -143,6 +210,7 @@ def get_path(sID:int)->(FileStatus, str):
 
 def get_file(path: str) -> (FileStatus, io.StringIO):
     """Gets a file from S3 using the full S3 URI and returns a status code along with a file-like object.
+    Reads go through the read cache, so repeat reads of an unchanged file don't download it again.
 
     Parameters:
     path (str): The full S3 URI (e.g., 's3://bucket-name/path/to/file').
@@ -150,59 +218,121 @@ def get_file(path: str) -> (FileStatus, io.StringIO):
     Returns:
     FileStatus: Status of the file retrieval.
     io.StringIO: A file-like object containing the file content."""
-    try:
     # Parse the S3 URI
-        parsed_url = urlparse(path)
-        key = parsed_url.path.lstrip('/')
-        # Check if the file has a valid extension
-        if not _allowed_filename(key):
-            return FileStatus.BAD_EXTENSION, None
-        # Check if the file has a valid extension
-        if not _allowed_filename(key):
-            return FileStatus.BAD_EXTENSION, None
-        # Get the object from S3
-        response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-
-        # Read the file content as bytes (binary mode)
-        file_content = response['Body'].read()
-        print(f"File content type: {type(file_content)}")
-        print(f"First 50 bytes of the file content: {file_content[:50]}")
+    key = key_of(path)
+    # Check if the file has a valid extension
+    if not _allowed_filename(key):
+        return FileStatus.BAD_EXTENSION, None
 
-        # Decode the binary content using 'cp1252'
-        try:
-            decoded_content = file_content.decode('cp1252')
-            print("File content decoded successfully with 'cp1252'.")
-        except UnicodeDecodeError:
-            print("Failed to decode using 'cp1252'.")
-            return FileStatus.OKAY, io.BytesIO(file_content)  # Return as binary data for further processing
+    status, file_content = get_object_bytes(key)
+    if status != FileStatus.OKAY:
+        return status, None
 
-        # If decoding is successful, return as a StringIO object
-        file = io.StringIO(decoded_content)
-        return FileStatus.OKAY, file
+    # Decode the binary content using 'cp1252'
+    try:
+        decoded_content = file_content.decode('cp1252')
+    except UnicodeDecodeError:
+        print("Failed to decode using 'cp1252'.")
+        return FileStatus.OKAY, io.BytesIO(file_content)  # Return as binary data for further processing
+
+    # If decoding is successful, return as a StringIO object
+    file = io.StringIO(decoded_content)
+    return FileStatus.OKAY, file
+
+def configure_read_cache(maxBytes:int = 64 * 1024 * 1024, ttl:float = 30.0)->FileStatus:
+    """Sets the size limit & freshness period of the read cache, a maxBytes of 0 turns it off."""
+    global _readCacheMaxBytes, _readCacheTTL
+    if maxBytes < 0 or ttl < 0:
+        return FileStatus.UNKNOWN_ERR
+    with _readCacheLock:
+        _readCacheMaxBytes = maxBytes
+        _readCacheTTL = ttl
+        _evict_read_cache()
+    return FileStatus.OKAY
+
+def invalidate_cached_file(path:str)->None:
+    """Drops the read cache entry of a file, given either its full S3 URI or its key. Called on every write."""
+    global _readCacheBytes
+    key = key_of(path) if path.startswith('s3://') else path
+    with _readCacheLock:
+        entry = _readCache.pop(key, None)
+        if entry is not None:
+            _readCacheBytes -= len(entry[1])
+
+def clear_read_cache()->None:
+    global _readCacheBytes
+    with _readCacheLock:
+        _readCache.clear()
+        _readCacheBytes = 0
+        for stat in _readCacheStats:
+            _readCacheStats[stat] = 0
+
+def get_read_cache_stats()->dict:
+    with _readCacheLock:
+        stats = dict(_readCacheStats)
+        stats['entries'] = len(_readCache)
+        stats['bytes'] = _readCacheBytes
+    return stats
+
+def _read_cache_stat(stat:str):
+    def read()->int:
+        return get_read_cache_stats()[stat]
+    return read
+
+metrics.gauge('file_read_cache_entries', 'Objects held in the read cache.', function=_read_cache_stat('entries'))
+metrics.gauge('file_read_cache_bytes', 'Bytes held in the read cache.', function=_read_cache_stat('bytes'))
+
+def _get_cached_object(key:str, store:bool = True)->(FileStatus, bytes):
+    """Read through cache in front of get_object. Fresh entries are returned straight away, stale ones are
+    revalidated against their ETag with IfNoneMatch and only downloaded again if the object has changed.
+    Without store a downloaded object isn't added to the cache."""
+    global _readCacheBytes
+    with _readCacheLock:
+        entry = _readCache.get(key)
+        if entry is not None:
+            _readCache.move_to_end(key)
+            if time.monotonic() - entry[2] < _readCacheTTL:
+                _readCacheStats['hits'] += 1
+                _readCacheHits.inc()
+                return FileStatus.OKAY, entry[1]
 
+    try:
+        if entry is not None:
+            response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key, IfNoneMatch=entry[0])
+        else:
+            response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+        file_content = response['Body'].read()
     except ClientError as e:
+        code = e.response['Error']['Code']
+        if entry is not None and code in ('304', 'NotModified'):
+            with _readCacheLock:
+                _readCacheStats['revalidated'] += 1
+                _readCacheRevalidations.inc()
+                if key in _readCache:
+                    _readCache[key] = (entry[0], entry[1], time.monotonic())
+            return FileStatus.OKAY, entry[1]
+        invalidate_cached_file(key)
+        if code in ('NoSuchKey', '404'):
+            return FileStatus.BAD_PATH, None
         print(f"Failed to get object from S3: {e}")
         return FileStatus.UNKNOWN_ERR, None
-        '''
-        
-        file_content = response['Body'].read().decode('utf-8') # Decode bytes to string
-        file = io.StringIO(file_content) # Create a StringIO object for text processing
-        return FileStatus.OKAY, file
-    except ClientError as e:
-        # Check if the error is due to the file not being found
-        if e.response['Error']['Code'] == 'NoSuchKey':
-            return FileStatus.BAD_PATH, None
-        else:
-            print(f"Error retrieving file from S3: {str(e)}")
-            return FileStatus.UNKNOWN_ERR, None
-        '''
-import io
-import boto3
-from botocore.exceptions import ClientError
-from urllib.parse import urlparse
 
-s3 = boto3.client('s3')
-S3_BUCKET_NAME = 'your-bucket-name'
+    with _readCacheLock:
+        _readCacheStats['misses'] += 1
+        _readCacheMisses.inc()
+        _readCacheBytes -= len(_readCache.pop(key, (None, b''))[1])
+        if store and len(file_content) <= _READ_CACHE_MAX_ENTRY and len(file_content) <= _readCacheMaxBytes:
+            _readCache[key] = (response.get('ETag'), file_content, time.monotonic())
+            _readCacheBytes += len(file_content)
+            _evict_read_cache()
+    return FileStatus.OKAY, file_content
+
+def _evict_read_cache()->None:
+    """Removes least recently used entries until the cache fits in _readCacheMaxBytes. Must hold _readCacheLock."""
+    global _readCacheBytes
+    while _readCache and _readCacheBytes > _readCacheMaxBytes:
+        _, entry = _readCache.popitem(last=False)
+        _readCacheBytes -= len(entry[1])
 
 def get_pdf_binary_file(path: str) -> (FileStatus, io.BytesIO):
     """
@@ -215,24 +345,11 @@ def get_pdf_binary_file(path: str) -> (FileStatus, io.BytesIO):
     FileStatus: Status of the file retrieval.
     io.BytesIO: A file-like object containing the file content in binary.
     """
-    try:
-        # Parse the S3 URI
-        parsed_url = urlparse(path)
-        key = parsed_url.path.lstrip('/')
-
-        # Get the object from S3
-        response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+    status, file_content = get_object_bytes(path, cache=False)
+    if status != FileStatus.OKAY:
+        return status, None
+    return FileStatus.OKAY, io.BytesIO(file_content)
 
-        # Read the file content as bytes (binary mode)
-        file_content = response['Body'].read()
-
-        # Return as a BytesIO object
-        return FileStatus.OKAY, io.BytesIO(file_content)
-
-    except ClientError as e:
-        print(f"Failed to get object from S3: {e}")
-        return FileStatus.ERROR, None
-    
 def download_file_from_s3(s3_path: str) -> FileStatus:
     """
     Downloads a file from S3 using the full S3 URI and saves it to the UPLOAD_FOLDER.
@@ -265,6 +382,37 @@ def download_file_from_s3(s3_path: str) -> FileStatus:
         print(f"Failed to download object from S3: {e}")
         return FileStatus.UNKNOWN_ERR, None
     
+def get_object_bytes(path:str, cache:bool = True)->(FileStatus, bytes):
+    """Gets the raw bytes of an object, given its full S3 URI or its bucket key. Every read of an object goes
+    through here and so through the read cache, a missing object is BAD_PATH and any other failure UNKNOWN_ERR.
+    With cache=False an object which isn't cached already isn't kept, i.e a PDF which is only read once."""
+    key = key_of(path) if path.startswith('s3://') else path
+    try:
+        return _get_cached_object(key, cache)
+    except Exception as e:
+        print(f"Failed to read object from S3: {e}")
+        return FileStatus.UNKNOWN_ERR, None
+
+def put_object_bytes(key:str, data:bytes, content_type:str = 'application/json')->FileStatus:
+    """Stores raw bytes under a bucket key as is, overwriting any existing object. No renaming is done."""
+    try:
+        s3.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=data, ContentType=content_type)
+        invalidate_cached_file(key)
+        return FileStatus.OKAY
+    except ClientError as e:
+        print(f"Failed to put object to S3: {e}")
+        return FileStatus.UNKNOWN_ERR
+
+def delete_object(key:str)->FileStatus:
+    """Deletes the object stored under a bucket key as is, without the filename checks of del_file."""
+    try:
+        s3.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+        invalidate_cached_file(key)
+        return FileStatus.OKAY
+    except ClientError as e:
+        print(f"Failed to delete object from S3: {e}")
+        return FileStatus.UNKNOWN_ERR
+
 def get_file_id(sID:int)->(FileStatus,_io.TextIOWrapper):
     """Gets a file stored on disk by the ID used in databases, and returns a status code as well as a File obj."""
 
@@ -288,6 +436,7 @@ def create_json_file(name:str, data: dict, rename:bool = False)->(FileStatus ,st
     file_content = json.dumps(data)
     try: 
         s3.put_object(Bucket=S3_BUCKET_NAME, Key=name, Body=file_content, ContentType='application/json')
+        invalidate_cached_file(name)
         # Construct the full file path
         file_path = f"s3://{S3_BUCKET_NAME}/{name}"
         return FileStatus.OKAY, file_path
@@ -308,6 +457,7 @@ def create_md_file(name:str, data: str, rename:bool = False)->(FileStatus ,str):
     try:
     # Upload the empty file to S3
         s3.put_object(Bucket=S3_BUCKET_NAME, Key=name, Body=data, ContentType='application/json')
+        invalidate_cached_file(name)
         # Construct the full file path
         file_path = f"s3://{S3_BUCKET_NAME}/{name}"
         return FileStatus.OKAY, file_path
@@ -324,6 +474,7 @@ def del_file(name:str)->FileStatus:
     try:
         # Attempt to delete the object from S3
         s3.delete_object(Bucket=S3_BUCKET_NAME, Key=name)
+        invalidate_cached_file(name)
         return FileStatus.OKAY
     except ClientError as e:
         # Check if the error is due to the file not being found
@@ -363,6 +514,8 @@ def clear_folder() -> FileStatus:
                 Delete={'Objects': objects_to_delete}
             )
 
+            clear_read_cache()
+
             # Check for errors in the delete response
             if 'Errors' in delete_response:
                 print(f"Errors occurred while deleting objects: {delete_response['Errors']}")
@@ -449,6 +602,7 @@ def update_file_in_s3(file_path: str, new_content: str, content_type: str) -> (F
 
         # Overwrite the file with new content in S3
         s3.put_object(Bucket=bucket, Key=key, Body=new_content, ContentType=content_type)
+        invalidate_cached_file(key)
 
         return FileStatus.OKAY, "File updated successfully."
     except ClientError as e:
@@ -0,0 +1,170 @@
+# Job Checkpoints
+#
+# Keeps what a failed job had already produced, so a retry of it resumes from the step which
+# failed instead of downloading, extracting and paying for the AI call again. A checkpoint is
+# the furthest artefact the job got to:
+#   extracted - the text extracted from its PDF (a retry starts at the AI call)
+#   response  - the AI's response, checked & corrected (a retry starts at saving it)
+#   packaged  - the questions JSON already saved to S3, by name and path (a retry only writes the db rows)
+#
+# Checkpoints are keyed by the job's fingerprint (see job_subsystem._job_fingerprint), so a job put
+# back on the queue, taken over by another worker, or submitted again with the same inputs all find
+# it. They are only written when a job fails, the success path pays nothing but one lookup, and
+# are dropped once a resumed job succeeds or after they expire.
+#
+# Like the extraction cache there are two tiers: a local directory, and objects in the S3 bucket for
+# retries run by another worker process or host.
+
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from threading import Lock
+
+import src.file_management as fm
+
+_S3_PREFIX = '_job_checkpoints/'            # Bucket prefix the checkpoint objects are stored under.
+
+# Stages, in the order a job reaches them
+EXTRACTED = 'extracted'
+RESPONSE = 'response'
+PACKAGED = 'packaged'
+STAGES = (EXTRACTED, RESPONSE, PACKAGED)
+
+# Settings
+_checkpointDir: str = None                  # Local tier directory, None until initialised.
+_useS3: bool = False                        # Enables the S3 tier.
+_maxAge: timedelta = timedelta(hours=24)    # Older checkpoints are ignored and dropped.
+
+# Internal Variables
+_lock: Lock = Lock()
+_stats: dict = { 'saved' : 0, 'resumed' : 0, 'expired' : 0 }
+
+def initialise(checkpointDir:str = None, useS3:bool = False, maxAge:timedelta = timedelta(hours=24))->bool:
+    """Sets up the local tier in checkpointDir (a temp directory by default). Turn useS3 on when other
+    processes may retry this one's jobs, i.e with a database job queue."""
+    global _checkpointDir, _useS3, _maxAge
+    if maxAge.total_seconds() <= 0:
+        return False
+    if checkpointDir is None:
+        checkpointDir = os.path.join(tempfile.gettempdir(), 'job_checkpoints')
+    os.makedirs(checkpointDir, exist_ok=True)
+    with _lock:
+        _checkpointDir = checkpointDir
+        _useS3 = useS3
+        _maxAge = maxAge
+    return True
+
+def save(key:str, stage:str, value)->bool:
+    """Saves a job's artefact, replacing any earlier one. Returns False if it couldn't be saved anywhere."""
+    if key is None or stage not in STAGES:
+        return False
+    data = json.dumps({ 'stage' : stage, 'saved_at' : datetime.now().isoformat(),
+                        'value' : _encode(stage, value) }, default=str).encode('utf-8')
+    saved = _put_local(key, data)
+    saved = _put_s3(key, data) or saved
+    if saved:
+        _count('saved')
+    return saved
+
+def load(key:str):
+    """Returns (stage, artefact) of a job's checkpoint, or (None, None) if it has none."""
+    if key is None:
+        return None, None
+    data = _get_local(key)
+    if data is None:
+        data = _get_s3(key)
+    if data is None:
+        return None, None
+    try:
+        entry = json.loads(data)
+        if datetime.now() - datetime.fromisoformat(entry['saved_at']) > _maxAge:
+            _count('expired')
+            drop(key)
+            return None, None
+        stage = entry['stage']
+        value = _decode(stage, entry['value'])
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring damaged job checkpoint {key}: {e}")
+        return None, None
+    _count('resumed')
+    return stage, value
+
+def drop(key:str)->None:
+    """Removes a job's checkpoint from both tiers."""
+    if key is None:
+        return
+    if _checkpointDir is not None:
+        try:
+            os.remove(_local_path(key))
+        except OSError:
+            pass
+    if _useS3:
+        try:
+            fm.delete_object(_S3_PREFIX + key + '.json')
+        except Exception as e:
+            print(f"Failed to delete job checkpoint {key} from S3: {e}")
+
+def get_stats()->dict:
+    with _lock:
+        return dict(_stats)
+
+def _count(stat:str)->None:
+    with _lock:
+        _stats[stat] += 1
+
+def _encode(stage:str, value):
+    if stage == EXTRACTED and isinstance(value, tuple):
+        return { 'text_by_page' : value[0], 'tables_by_page' : value[1] }
+    return value
+
+def _decode(stage:str, value):
+    if stage == EXTRACTED and isinstance(value, dict) and 'text_by_page' in value:
+        # JSON turns the page number keys into strings, restore them.
+        return value['text_by_page'], { int(page) : tables for page, tables in value['tables_by_page'].items() }
+    return value
+
+def _local_path(key:str)->str:
+    return os.path.join(_checkpointDir, key + '.json')
+
+def _get_local(key:str)->bytes:
+    if _checkpointDir is None:
+        return None
+    try:
+        with open(_local_path(key), 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+def _put_local(key:str, data:bytes)->bool:
+    if _checkpointDir is None:
+        return False
+    path = _local_path(key)
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmpPath, 'wb') as file:
+            file.write(data)
+        os.replace(tmpPath, path)
+        return True
+    except OSError as e:
+        print(f"Failed to write job checkpoint {key}: {e}")
+        return False
+
+def _get_s3(key:str)->bytes:
+    if not _useS3:
+        return None
+    try:
+        status, data = fm.get_object_bytes(_S3_PREFIX + key + '.json', cache=False)
+        return data if status == fm.FileStatus.OKAY else None
+    except Exception as e:
+        print(f"Failed to read job checkpoint {key} from S3: {e}")
+        return None
+
+def _put_s3(key:str, data:bytes)->bool:
+    if not _useS3:
+        return False
+    try:
+        return fm.put_object_bytes(_S3_PREFIX + key + '.json', data) == fm.FileStatus.OKAY
+    except Exception as e:
+        print(f"Failed to write job checkpoint {key} to S3: {e}")
+        return False
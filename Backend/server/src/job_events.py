@@ -0,0 +1,155 @@
+# Job Events
+#
+# Publishes the progress of jobs to anyone listening, i.e the /job_events Server-Sent Events
+# streams, so clients don't have to poll /job_status. A job goes through:
+#   queued -> extracting -> generating -> persisted (or failed or cancelled at any point)
+# and back to queued if it is put back on the queue.
+#
+# Events published in this process reach subscribers straight away. Jobs run by other worker
+# processes (see src/worker.py) record their progress in the job_queue table instead; while anyone
+# is subscribed a single watcher thread polls it for changes and publishes them here, however many
+# streams are open.
+
+from collections import OrderedDict
+from datetime import datetime
+from queue import Queue, Full, Empty
+from threading import Lock, Thread, Event
+import itertools
+import json
+
+QUEUED = 'queued'
+EXTRACTING = 'extracting'
+GENERATING = 'generating'
+PERSISTED = 'persisted'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TERMINAL = { PERSISTED, FAILED, CANCELLED }
+
+_lock = Lock()
+_subscribers = set()
+_sequence = itertools.count(1)
+_lastEvents: OrderedDict = OrderedDict()   # Job ID -> its last event, drops events seen twice (locally and from the table).
+_lastEventsLimit: int = 10000
+
+_source = None                              # Returns the events recorded by other processes since a datetime, see watch().
+_sourcePollSeconds: float = 1.0
+_watcher: Thread = None
+_watcherStop: Event = Event()
+
+class Subscription:
+    """The events a single stream listens for. Events which don't fit in the queue, because the stream's client
+    has fallen that far behind, are dropped and counted."""
+
+    def __init__(self, matches, maxQueue:int = 1000):
+        self._matches = matches
+        self.queue = Queue(maxsize=maxQueue)
+        self.dropped = 0
+
+    def offer(self, event:dict)->None:
+        if not self._matches(event):
+            return
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def get(self, timeout:float = None)->dict:
+        """Waits up to timeout seconds for the next event, returns None if there wasn't one."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self)->None:
+        with _lock:
+            _subscribers.discard(self)
+
+def project_key(unitCode:str, projectTitle:str)->str:
+    """Identifies a project's jobs in events."""
+    if not unitCode or not projectTitle:
+        return None
+    return f"{unitCode}/{projectTitle}"
+
+def subscribe(jobID:int = None, project:str = None)->Subscription:
+    """Subscribes to the events of a single job, of every job of a project (see project_key), or of every job."""
+    def matches(event):
+        if jobID is not None and event.get('job_id') != jobID:
+            return False
+        if project is not None and event.get('project') != project:
+            return False
+        return True
+    subscription = Subscription(matches)
+    with _lock:
+        _subscribers.add(subscription)
+    _start_watcher()
+    return subscription
+
+def publish(jobID:int, event:str, initial:bool = False, **details)->dict:
+    """Sends an event to every matching subscriber, details being i.e project, submission_id, error.
+    An initial event is only sent if the job has none yet, a worker may already have taken the job by then.
+    Returns the event, or None if it repeats the job's last one."""
+    with _lock:
+        if _lastEvents.get(jobID) == event or (initial and jobID in _lastEvents):
+            return None
+        _lastEvents[jobID] = event
+        _lastEvents.move_to_end(jobID)
+        while len(_lastEvents) > _lastEventsLimit:
+            _lastEvents.popitem(last=False)
+        message = { 'id' : next(_sequence), 'job_id' : jobID, 'event' : event,
+                    'time' : details.pop('time', None) or datetime.now().isoformat(), **details }
+        subscribers = list(_subscribers)
+    for subscription in subscribers:
+        subscription.offer(message)
+    return message
+
+def subscriber_count()->int:
+    with _lock:
+        return len(_subscribers)
+
+def watch(source, pollSeconds:float = 1.0)->None:
+    """Sets where events recorded by other processes come from. source(since) returns (events, newSince),
+    events being (job ID, event, details) tuples changed at or after since."""
+    global _source, _sourcePollSeconds
+    _source = source
+    _sourcePollSeconds = pollSeconds if pollSeconds > 0 else 1.0
+
+def stop_watching()->None:
+    global _source, _watcher
+    with _lock:
+        _source = None
+        watcher = _watcher
+        _watcher = None
+    _watcherStop.set()
+    if watcher is not None:
+        watcher.join()
+
+def _start_watcher()->None:
+    global _watcher
+    with _lock:
+        if _source is None or _watcher is not None:
+            return
+        _watcherStop.clear()
+        _watcher = Thread(target=_watch, name="job-events-watcher", daemon=True)
+        _watcher.start()
+
+def _watch()->None:
+    global _watcher
+    since = datetime.now()
+    while not _watcherStop.wait(_sourcePollSeconds):
+        with _lock:
+            source = _source
+            if source is None or not _subscribers:
+                _watcher = None             # Started again by the next subscriber
+                return
+        try:
+            events, since = source(since)
+        except Exception as e:
+            print(f"Failed to read job progress: {e}")
+            continue
+        for jobID, event, details in events:
+            publish(jobID, event, **details)
+
+def format_sse(event:dict)->str:
+    """Formats an event as a Server-Sent Events message."""
+    data = { key : value for key, value in event.items() if key != 'id' }
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(data, default=str)}\n\n"
@@ -0,0 +1,179 @@
+# Job Pipeline
+#
+# A chain of stages connected by bounded queues, each stage with its own pool of
+# worker threads. The job subsystem runs every job through fetch -> extract ->
+# generate -> persist, so while one job waits on OpenAI in the generate stage the
+# next one is already being downloaded and extracted. A full queue blocks the
+# stage (or submitter) in front of it, which keeps the number of jobs held in
+# memory bounded.
+#
+# Every stage reports its queue depth, how long items waited in its queue, and
+# how long its handler took, see get_stats(). An observer can be given to also
+# receive each item's timings as they happen, i.e to feed metrics.
+#
+# A stage can also take items in groups, i.e so the persist stage writes the db rows of
+# every job which finished at about the same time in one transaction.
+
+from queue import Queue, Empty
+from threading import Lock, Thread
+from time import monotonic
+
+_STOP = object()                            # Sentinel telling a stage worker to exit.
+
+class Stage:
+    """A step of the pipeline. handler(item) returns True to pass the item on to the next stage,
+    or False if it is done with it (i.e the job failed). The last stage's return value is ignored.
+    With a batchSize the handler is given a list instead: every item waiting, up to batchSize, or arriving
+    within batchWindow seconds of the first. It returns a list of those True / False values, in the same order."""
+
+    def __init__(self, name:str, handler, workers:int = 1, maxQueue:int = 8, batchSize:int = None, batchWindow:float = 0.0):
+        if workers <= 0 or maxQueue <= 0:
+            raise ValueError("A stage needs at least one worker and room for one item.")
+        if (batchSize is not None and batchSize <= 0) or batchWindow < 0:
+            raise ValueError("A stage's batches need room for one item and a window of zero or more seconds.")
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = Queue(maxsize = maxQueue)
+        self.maxQueue = maxQueue
+        self.batchSize = batchSize
+        self.batchWindow = batchWindow
+
+        self._lock = Lock()
+        self._threads = []
+        self._exited = 0
+        self._stats = { 'processed' : 0, 'failed' : 0, 'in_flight' : 0,
+                        'wait_seconds' : 0.0, 'busy_seconds' : 0.0, 'max_busy_seconds' : 0.0 }
+
+    def _record(self, waited:float, took:float, failed:bool)->None:
+        with self._lock:
+            self._stats['in_flight'] -= 1
+            self._stats['processed'] += 1
+            self._stats['failed'] += 1 if failed else 0
+            self._stats['wait_seconds'] += waited
+            self._stats['busy_seconds'] += took
+            self._stats['max_busy_seconds'] = max(self._stats['max_busy_seconds'], took)
+
+    def get_stats(self)->dict:
+        with self._lock:
+            stats = dict(self._stats)
+        processed = stats['processed']
+        stats['workers'] = self.workers
+        stats['depth'] = self.queue.qsize()
+        stats['capacity'] = self.maxQueue
+        stats['avg_wait_seconds'] = stats['wait_seconds'] / processed if processed else 0.0
+        stats['avg_busy_seconds'] = stats['busy_seconds'] / processed if processed else 0.0
+        return stats
+
+class Pipeline:
+    """Runs items through stages in order. onError(item, exception) is called, instead of the next stage,
+    for an item whose handler raised. observer(stageName, waited, took, failed) is called after every handler."""
+
+    def __init__(self, stages:list, onError = None, observer = None):
+        if len(stages) == 0:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+        self._onError = onError
+        self._observer = observer
+        self._started = False
+
+    def start(self)->None:
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = Thread(target=self._work, args=[index], name=f"job-{stage.name}-{i}", daemon=True)
+                stage._threads.append(thread)
+                thread.start()
+        self._started = True
+
+    def submit(self, item, timeout:float = None)->None:
+        """Hands an item to the first stage, blocking while its queue is full."""
+        self.stages[0].queue.put((item, monotonic()), timeout=timeout)
+
+    def close(self)->None:
+        """Lets every item already in the pipeline run to the end, then stops the workers.
+        Nothing may be submitted once close has been called."""
+        if not self._started:
+            return
+        first = self.stages[0]
+        for _ in range(first.workers):
+            first.queue.put(_STOP)
+        for stage in self.stages:
+            for thread in stage._threads:
+                thread.join()
+        self._started = False
+
+    def _stop(self, stage:Stage, following:Stage)->None:
+        # The last worker of a stage to stop passes the shutdown on, after every item it had
+        with stage._lock:
+            stage._exited += 1
+            last = stage._exited == stage.workers
+        if last and following is not None:
+            for _ in range(following.workers):
+                following.queue.put(_STOP)
+
+    def _gather(self, stage:Stage, entry)->(list, bool):
+        """Adds to a batch stage's first entry whatever else arrives within its window. Returns the entries,
+        and whether the worker was told to stop while gathering them."""
+        entries = [entry]
+        closesAt = monotonic() + stage.batchWindow
+        while len(entries) < stage.batchSize:
+            try:
+                entry = stage.queue.get(timeout=max(0.0, closesAt - monotonic()))
+            except Empty:
+                break
+            if entry is _STOP:
+                return entries, True
+            entries.append(entry)
+        return entries, False
+
+    def _work(self, index:int)->None:
+        stage = self.stages[index]
+        following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            entry = stage.queue.get()
+            if entry is _STOP:
+                self._stop(stage, following)
+                return
+
+            stopping = False
+            entries = [entry]
+            if stage.batchSize is not None:
+                entries, stopping = self._gather(stage, entry)
+            items = [item for item, queuedAt in entries]
+            started = monotonic()
+            with stage._lock:
+                stage._stats['in_flight'] += len(items)
+            try:
+                passOn = stage.handler(items) if stage.batchSize is not None else [stage.handler(items[0])]
+                failed = False
+            except Exception as e:
+                passOn = [False] * len(items)
+                failed = True
+                print(f"Pipeline stage {stage.name} raised an exception: {e}")
+                if self._onError is not None:
+                    for item in items:
+                        try:
+                            self._onError(item, e)
+                        except Exception as inner:
+                            print(f"Pipeline error handler raised an exception: {inner}")
+            took = monotonic() - started
+            for item, queuedAt in entries:
+                waited = started - queuedAt
+                stage._record(waited, took, failed)
+                if self._observer is not None:
+                    try:
+                        self._observer(stage.name, waited, took, failed)
+                    except Exception as e:
+                        print(f"Pipeline observer raised an exception: {e}")
+
+            if following is not None:
+                for item, passItem in zip(items, passOn):
+                    if passItem:
+                        following.queue.put((item, monotonic()))
+            if stopping:
+                self._stop(stage, following)
+                return
+
+    def get_stats(self)->dict:
+        """Per stage counters, in pipeline order."""
+        return { stage.name : stage.get_stats() for stage in self.stages }
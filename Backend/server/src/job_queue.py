@@ -0,0 +1,630 @@
+# Job Queue
+#
+# Storage for the job subsystem's queue of waiting jobs. Both stores have the same interface:
+#  - MemoryJobQueue keeps jobs in an in-process FairScheduler (see src/job_scheduler.py). It is lost
+#    with the process, the job subsystem can only snapshot it to the .queue file on shutdown.
+#  - DatabaseJobQueue keeps every job as a row of the job_queue table. Enqueueing is a single
+#    insert and workers claim a queued row with SELECT ... FOR UPDATE SKIP LOCKED, so
+#    queued jobs survive a crash and nothing has to be re-serialized on restart. SQLite (used by
+#    tests) has no row locks, there a claim is settled by a conditional UPDATE instead.
+#    Several processes or hosts can share the table, claimed jobs are leased to the claiming
+#    process and handed to another worker if its heartbeat stops renewing the lease.
+#
+# Both hand out jobs by priority (raised as jobs wait), then round robin across tenants (units or staff). The
+# database queue picks the lane to claim from in each process, so with several worker processes the
+# round robin is only fair within each of them. It reads the first job of each lane it knows of with an
+# index seek per lane, finding out which lanes have queued jobs takes a scan, so that is only redone
+# every so often and a lane put by another process may wait that long for its turn.
+#
+# Jobs go in and come out as (job ID, job type, data) tuples. A job may be put with a fingerprint,
+# find_active() then returns it for as long as it is queued or running so duplicates can attach to it.
+# A claimed job can be released with a notBefore time, it stays queued but isn't claimed until then,
+# i.e a batch job waiting on its OpenAI batch between checks.
+#
+# cancel() takes queued jobs off the queue as CANCELLED. Running jobs are stopped by whoever runs them:
+# the job subsystem stops those of its own process, and the database queue flags the rest so their
+# holder's heartbeat hands them to its onCancel callback.
+
+import os
+import socket
+import heapq
+from datetime import datetime, timedelta
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+from sqlalchemy import select, update, delete, func, union_all
+from sqlalchemy.orm import sessionmaker
+
+from src.models.models_all import JobQueueEntry
+import src.job_scheduler as sched
+import src.job_events as events
+
+# Job states as stored in the table, the same values as job_subsystem.JobState
+QUEUED = 'QUEUED'
+RUNNING = 'IN_PROGRESS'
+DONE = 'COMPLETED'
+FAILED = 'FAILED'
+CANCELLED = 'CANCELLED'
+
+def _progress_of(state:str)->str:
+    """The progress event a job finishing in state ends on."""
+    if state == DONE:
+        return events.PERSISTED
+    if state == CANCELLED:
+        return events.CANCELLED
+    return events.FAILED
+
+class MemoryJobQueue:
+    """The in-process job queue. Job IDs are handed out by the queue unless one is given.
+    tenantWeights and agingSeconds are passed on to the FairScheduler."""
+
+    def __init__(self, tenantWeights:dict = None, agingSeconds:float = 120):
+        self._scheduler = sched.FairScheduler(tenantWeights, agingSeconds)
+        self._lock = Condition()
+        self._closed = False
+        self._nextID = 0
+        self._active = {}                   # Fingerprint -> ID of the queued or running job
+        self._fingerprints = {}             # Job ID -> fingerprint, for the jobs in _active
+        self._lanes = {}                    # Job ID -> (priority, tenant), until the job finishes
+        self._delayed = []                  # Heap of (not before, job) of released jobs which can't be claimed yet
+        self._finishTimes = deque(maxlen=10000)     # When recent jobs finished, oldest first
+
+    def put(self, jobType:int, data:dict, jobID:int = None, fingerprint:str = None,
+            priority:int = sched.INTERACTIVE, tenant:str = sched.DEFAULT_TENANT)->int:
+        """Enqueues a job, returning its ID."""
+        with self._lock:
+            if jobID is None:
+                jobID = self._nextID
+            self._nextID = max(self._nextID, jobID + 1)
+            if fingerprint is not None:
+                self._active[fingerprint] = jobID
+                self._fingerprints[jobID] = fingerprint
+            self._lanes[jobID] = (priority, tenant)
+            self._scheduler.push((jobID, jobType, data), priority, tenant)
+            self._lock.notify()
+        return jobID
+
+    def find_active(self, fingerprint:str)->int:
+        """Returns the ID of the queued or running job put with fingerprint, or None if there isn't one."""
+        with self._lock:
+            return self._active.get(fingerprint)
+
+    def _forget(self, jobID:int)->None:
+        with self._lock:
+            self._lanes.pop(jobID, None)
+            fingerprint = self._fingerprints.pop(jobID, None)
+            if fingerprint is not None and self._active.get(fingerprint) == jobID:
+                del self._active[fingerprint]
+
+    def _push(self, job:tuple)->None:
+        priority, tenant = self._lanes.get(job[0], (sched.INTERACTIVE, sched.DEFAULT_TENANT))
+        self._scheduler.push(job, priority, tenant)
+
+    def _promote_due(self)->float:
+        """Moves the delayed jobs which are due to the scheduler. Returns the seconds until the next one is, or None. Must hold _lock."""
+        now = datetime.now()
+        while self._delayed and self._delayed[0][0] <= now:
+            self._push(heapq.heappop(self._delayed)[1])
+        if not self._delayed:
+            return None
+        return (self._delayed[0][0] - now).total_seconds()
+
+    def claim(self):
+        """Blocks until a job is available and takes the one the scheduler picks. Returns None once the queue has been closed."""
+        with self._lock:
+            while True:
+                if self._closed:
+                    return None
+                nextDue = self._promote_due()
+                if len(self._scheduler) > 0:
+                    return self._scheduler.pop()
+                self._lock.wait(nextDue)
+
+    def cancel(self, matches)->(list, list):
+        """Takes the waiting jobs for which matches(job ID, job type, data) is true off the queue. Returns them, and
+        the IDs of the matching running jobs flagged for their holder to stop, of which there are none here."""
+        with self._lock:
+            cancelled = self._scheduler.remove(lambda job: matches(*job))
+            delayed = [entry for entry in self._delayed if matches(*entry[1])]
+            if delayed:
+                self._delayed = [entry for entry in self._delayed if not matches(*entry[1])]
+                heapq.heapify(self._delayed)
+                cancelled += [job for _, job in delayed]
+        for job in cancelled:
+            self._forget(job[0])
+        return cancelled, []
+
+    def release(self, jobID:int, jobType:int, data:dict, notBefore:datetime = None)->None:
+        """Puts a claimed job back on the queue without running it, at its original priority.
+        With notBefore it isn't claimed again until then."""
+        with self._lock:
+            if notBefore is not None and notBefore > datetime.now():
+                heapq.heappush(self._delayed, (notBefore, (jobID, jobType, data)))
+            else:
+                self._push((jobID, jobType, data))
+            self._lock.notify()
+
+    def finish(self, jobID:int, state:str, status:str, resultPath:str = None, error:str = None)->None:
+        """Records the outcome of a claimed job. Nothing outlives the process here, the job just stops being active."""
+        self._forget(jobID)
+        if state not in (DONE, FAILED):
+            return                                  # Like the database, cancelled jobs don't count towards throughput
+        with self._lock:
+            self._finishTimes.append(datetime.now())
+
+    def close(self, waiters:int)->None:
+        """Wakes up every waiter blocked in claim() so they can exit. Waiting jobs stay queued for drain()."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def drain(self)->list:
+        """Takes every waiting job off the queue without running it."""
+        with self._lock:
+            drained = self._scheduler.clear() + [job for _, job in sorted(self._delayed, key=lambda entry: entry[0])]
+            self._delayed = []
+        for job in drained:
+            self._forget(job[0])
+        return drained
+
+    def empty(self)->bool:
+        return self.qsize() == 0
+
+    def qsize(self, tenant:str = None, maxPriority:int = None)->int:
+        """Counts the waiting jobs, only those of tenant and of priority maxPriority or more urgent if given."""
+        with self._lock:
+            if tenant is None and maxPriority is None:
+                return len(self._scheduler) + len(self._delayed)
+            lanes = [self._lanes.get(job[0], (sched.INTERACTIVE, sched.DEFAULT_TENANT)) for _, job in self._delayed]
+            delayed = sum(1 for priority, laneTenant in lanes
+                          if (tenant is None or laneTenant == tenant) and (maxPriority is None or priority <= maxPriority))
+            return self._scheduler.count(tenant, maxPriority) + delayed
+
+    def finished_since(self, since:datetime)->int:
+        """Counts the jobs finished since the given time, for estimating throughput."""
+        with self._lock:
+            while self._finishTimes and self._finishTimes[0] < since:
+                self._finishTimes.popleft()
+            return len(self._finishTimes)
+
+    def get(self, jobID:int)->dict:
+        """Looks up a job. The in-memory queue doesn't keep finished jobs, see job_subsystem's status registry."""
+        return None
+
+    def report_progress(self, jobID:int, progress:str)->None:
+        """Records how far a running job has got. Only this process can see the jobs, nothing to record."""
+        pass
+
+    def progress_since(self, since:datetime):
+        """Returns the progress other processes recorded since then, of which there is none here."""
+        return [], since
+
+    def recover(self)->int:
+        """Requeues jobs orphaned by a crash. Nothing outlives the process here."""
+        return 0
+
+class DatabaseJobQueue:
+    """The durable job queue, backed by the job_queue table. Job IDs come from the table.
+    Any number of processes, on any number of hosts, can share one table. A claimed job is leased to
+    the claiming process, which renews the lease from a heartbeat thread for as long as it runs the job.
+    If the process dies the lease lapses and the job is claimed again by someone else."""
+
+    def __init__(self, engine, pollRate:float = 1.0, retention:timedelta = timedelta(hours=24),
+                 leaseDuration:timedelta = timedelta(seconds=60), maxAttempts:int = 3, workerName:str = None,
+                 tenantWeights:dict = None, agingSeconds:float = 120, onCancel = None):
+        """pollRate is how often an idle worker checks the table for jobs enqueued by other processes,
+        jobs enqueued by this process wake its workers straight away.
+        Finished rows older than retention are deleted every so often.
+        A job is leased for leaseDuration and renewed every third of it. Hosts' clocks need to agree to
+        well within that. A job whose lease has lapsed maxAttempts times is failed rather than claimed again.
+        tenantWeights and agingSeconds set the scheduling of the jobs this process claims, see src/job_scheduler.py.
+        onCancel(job ID) is called from the heartbeat for every job this process holds which has been cancelled."""
+        self._engine = engine
+        self._session = sessionmaker(bind=engine, expire_on_commit=False)
+        self._pollRate = pollRate if pollRate > 0 else 1.0
+        self._retention = retention
+        self._leaseDuration = leaseDuration
+        self._maxAttempts = maxAttempts
+        self.workerName = workerName if workerName else f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = Condition()
+        self._closed = False
+        self._lastPurge = monotonic()
+        # SQLite ignores FOR UPDATE, don't ask for it there
+        self._skipLocked = engine.dialect.name != 'sqlite'
+
+        self._held = set()                  # IDs of the jobs this process holds a lease on
+        self._heldLock = Lock()
+        self._heartbeat = None
+
+        self._share = sched.FairShare(tenantWeights)
+        self._agingSeconds = agingSeconds
+        self._lanes = set()                 # (priority, tenant) of every lane seen with queued jobs since the last refresh
+        self._lanesAt = None                # monotonic() of the last refresh of _lanes from the table
+        self._lanesLock = Lock()
+        self._laneRefresh = self._pollRate * 10
+        self._onCancel = onCancel
+
+        JobQueueEntry.__table__.create(engine, checkfirst=True)
+
+    def put(self, jobType:int, data:dict, jobID:int = None, fingerprint:str = None,
+            priority:int = sched.INTERACTIVE, tenant:str = sched.DEFAULT_TENANT)->int:
+        """Enqueues a job with a single insert, returning its ID. A given jobID is only kept if it's free."""
+        with self._session() as session, session.begin():
+            now = datetime.now()
+            entry = JobQueueEntry(job_type = jobType, job_data = data, state = QUEUED, submitted_at = now,
+                                  fingerprint = fingerprint, priority = priority, tenant = tenant,
+                                  progress = events.QUEUED, progress_at = now)
+            if jobID is not None and session.get(JobQueueEntry, jobID) is None:
+                entry.job_id = jobID
+            session.add(entry)
+            session.flush()
+            jobID = entry.job_id
+        with self._lanesLock:
+            self._lanes.add((priority, tenant))
+        with self._wake:
+            self._wake.notify()
+        return jobID
+
+    def find_active(self, fingerprint:str)->int:
+        """Returns the ID of the oldest queued or running job put with fingerprint by any process, or None.
+        Two processes putting the same job at the same moment can still both enqueue it."""
+        with self._session() as session:
+            return session.execute(
+                select(JobQueueEntry.job_id)
+                .where(JobQueueEntry.fingerprint == fingerprint, JobQueueEntry.state.in_((QUEUED, RUNNING)))
+                .order_by(JobQueueEntry.job_id).limit(1)
+            ).scalar_one_or_none()
+
+    def claim(self):
+        """Blocks until a job is available and takes it. Returns None once the queue has been closed."""
+        self._start_heartbeat()
+        while True:
+            with self._wake:
+                if self._closed:
+                    return None
+            claimed = self._try_claim()
+            if claimed is not None:
+                return claimed
+            self._purge_finished()
+            with self._wake:
+                if self._closed:
+                    return None
+                self._wake.wait(self._pollRate)
+
+    @staticmethod
+    def _claimable(now:datetime):
+        """The condition of a QUEUED row which may be claimed now, i.e not released until later."""
+        return (JobQueueEntry.state == QUEUED) & ((JobQueueEntry.not_before == None) | (JobQueueEntry.not_before <= now))
+
+    def _try_claim(self):
+        """Takes the queued job the scheduler picks, or failing that a job whose holder's lease has lapsed."""
+        claimed = None
+        lanes = self._lane_heads()
+        for _ in range(3):
+            if not lanes:
+                break
+            lane, level = self._share.choose(lanes, self._agingSeconds)
+            claimed = self._try_claim_where((JobQueueEntry.job_id == lane[3]) & self._claimable(datetime.now()),
+                                            JobQueueEntry.job_id)
+            if claimed is not None:
+                self._share.charge(level, lane[1], lane[0])
+                break
+            lanes.remove(lane)              # Its head went to another worker, pick among the rest
+        if claimed is None:
+            # Lost every race for the scheduler's pick to other workers, take whatever is oldest
+            claimed = self._try_claim_where(self._claimable(datetime.now()), JobQueueEntry.job_id)
+        if claimed is None:
+            claimed = self._try_claim_where(
+                (JobQueueEntry.state == RUNNING) & (JobQueueEntry.lease_expires_at < datetime.now()),
+                JobQueueEntry.lease_expires_at
+            )
+        return claimed
+
+    def _lane_heads(self)->list:
+        """Returns (priority, tenant, age in seconds, job ID) of the first claimable job of every known lane which has one.
+        Each lane's head is an index seek (ix_job_queue_state_lane), all of them in one query. The lanes with queued
+        jobs are only looked up again, with a scan, every _laneRefresh seconds."""
+        with self._lanesLock:
+            refresh = self._lanesAt is None or monotonic() - self._lanesAt >= self._laneRefresh
+            if refresh:
+                self._lanesAt = monotonic()
+        with self._session() as session:
+            if refresh:
+                found = session.execute(
+                    select(JobQueueEntry.priority, JobQueueEntry.tenant).distinct().where(JobQueueEntry.state == QUEUED)
+                ).all()
+                with self._lanesLock:
+                    self._lanes = set(tuple(lane) for lane in found)
+            with self._lanesLock:
+                lanes = list(self._lanes)
+            if not lanes:
+                return []
+
+            now = datetime.now()
+            heads = [select(JobQueueEntry.priority, JobQueueEntry.tenant, JobQueueEntry.submitted_at, JobQueueEntry.job_id)
+                     .where(self._claimable(now), JobQueueEntry.priority == priority, JobQueueEntry.tenant == tenant)
+                     .order_by(JobQueueEntry.job_id).limit(1).subquery()
+                     for priority, tenant in lanes]
+            rows = session.execute(union_all(*[select(*head.c) for head in heads])).all()
+        now = datetime.now()
+        return [(priority or 0, tenant or sched.DEFAULT_TENANT, (now - submittedAt).total_seconds(), jobID)
+                for priority, tenant, submittedAt, jobID in rows]
+
+    def _try_claim_where(self, condition, order):
+        while True:
+            with self._session() as session, session.begin():
+                query = select(JobQueueEntry).where(condition).order_by(order).limit(1)
+                if self._skipLocked:
+                    query = query.with_for_update(skip_locked=True)
+                entry = session.execute(query).scalar_one_or_none()
+                if entry is None:
+                    return None
+
+                now = datetime.now()
+                if entry.state == RUNNING:
+                    print(f"Lease on job {entry.job_id} held by {entry.claimed_by} lapsed, reclaiming it.")
+                if entry.cancel_requested:
+                    # Cancelled while running, and put back or abandoned since
+                    values = dict(state = CANCELLED, subsystem_status = 'CANCELLED', finished_at = now,
+                                  claimed_by = None, lease_expires_at = None, progress = events.CANCELLED, progress_at = now)
+                elif entry.attempts >= self._maxAttempts:
+                    # Its workers keep dying, don't hand it to another one
+                    values = dict(state = FAILED, subsystem_status = 'UNKNOWN_ERR', finished_at = now,
+                                  error = f"Job was abandoned by {entry.attempts} workers.", claimed_by = None, lease_expires_at = None)
+                else:
+                    values = dict(state = RUNNING, started_at = now, claimed_by = self.workerName,
+                                  lease_expires_at = now + self._leaseDuration, attempts = entry.attempts + 1,
+                                  not_before = None)
+
+                # Only moves the row if nobody else has, which is what keeps claims unique without row locks
+                result = session.execute(
+                    update(JobQueueEntry)
+                    .where(JobQueueEntry.job_id == entry.job_id, JobQueueEntry.state == entry.state,
+                           JobQueueEntry.attempts == entry.attempts)
+                    .values(**values)
+                )
+                if result.rowcount == 1 and values['state'] == RUNNING:
+                    with self._heldLock:
+                        self._held.add(entry.job_id)
+                    return entry.job_id, entry.job_type, entry.job_data
+            # Lost the race for that row or failed it, try the next one
+
+    def release(self, jobID:int, jobType:int = None, data:dict = None, notBefore:datetime = None)->None:
+        """Puts a claimed job back on the queue without running it, with its data replaced if given.
+        With notBefore it isn't claimed again until then."""
+        with self._heldLock:
+            self._held.discard(jobID)
+        values = dict(state = QUEUED, started_at = None, claimed_by = None, lease_expires_at = None, not_before = notBefore,
+                      attempts = JobQueueEntry.attempts - 1, progress = events.QUEUED, progress_at = datetime.now())
+        if data is not None:
+            values['job_data'] = data
+        with self._session() as session, session.begin():
+            session.execute(
+                update(JobQueueEntry)
+                .where(JobQueueEntry.job_id == jobID, JobQueueEntry.claimed_by == self.workerName)
+                .values(**values)
+            )
+        with self._wake:
+            self._wake.notify()
+
+    def finish(self, jobID:int, state:str, status:str, resultPath:str = None, error:str = None)->bool:
+        """Records the outcome of a claimed job. Returns False if the lease had been lost to another worker,
+        in which case that worker's outcome is the one kept."""
+        with self._heldLock:
+            self._held.discard(jobID)
+        with self._session() as session, session.begin():
+            result = session.execute(
+                update(JobQueueEntry)
+                .where(JobQueueEntry.job_id == jobID, JobQueueEntry.state == RUNNING,
+                       JobQueueEntry.claimed_by == self.workerName)
+                .values(state = state, subsystem_status = status, finished_at = datetime.now(),
+                        result_path = resultPath, error = error[:1000] if error else None,
+                        claimed_by = None, lease_expires_at = None,
+                        progress = _progress_of(state), progress_at = datetime.now())
+            )
+        if result.rowcount != 1:
+            print(f"Lost the lease on job {jobID} before it finished, its outcome wasn't recorded.")
+            return False
+        return True
+
+    def cancel(self, matches)->(list, list):
+        """Cancels the queued jobs for which matches(job ID, job type, data) is true, and flags the running ones
+        for their holder to stop. Returns the cancelled jobs, and the IDs of the flagged running ones."""
+        with self._session() as session:
+            rows = session.execute(
+                select(JobQueueEntry.job_id, JobQueueEntry.job_type, JobQueueEntry.job_data, JobQueueEntry.state)
+                .where(JobQueueEntry.state.in_((QUEUED, RUNNING)))
+            ).all()
+        found = [row for row in rows if matches(row.job_id, row.job_type, row.job_data)]
+        cancelled, running = [], []
+        if not found:
+            return cancelled, running
+
+        with self._session() as session, session.begin():
+            now = datetime.now()
+            for row in found:
+                # Only if it hasn't moved on since, it may have been claimed or finished in the meantime
+                result = session.execute(
+                    update(JobQueueEntry)
+                    .where(JobQueueEntry.job_id == row.job_id, JobQueueEntry.state == QUEUED)
+                    .values(state = CANCELLED, subsystem_status = 'CANCELLED', finished_at = now,
+                            progress = events.CANCELLED, progress_at = now)
+                )
+                if result.rowcount == 1:
+                    cancelled.append((row.job_id, row.job_type, row.job_data))
+                    continue
+                result = session.execute(
+                    update(JobQueueEntry)
+                    .where(JobQueueEntry.job_id == row.job_id, JobQueueEntry.state == RUNNING)
+                    .values(cancel_requested = True)
+                )
+                if result.rowcount == 1:
+                    running.append(row.job_id)
+        return cancelled, running
+
+    def report_progress(self, jobID:int, progress:str)->None:
+        """Records how far a job this process holds has got, for event streams in other processes."""
+        with self._session() as session, session.begin():
+            session.execute(
+                update(JobQueueEntry)
+                .where(JobQueueEntry.job_id == jobID, JobQueueEntry.claimed_by == self.workerName)
+                .values(progress = progress, progress_at = datetime.now())
+            )
+
+    def progress_since(self, since:datetime):
+        """Returns (rows, newSince), rows being (job ID, job type, progress, error, data) of the jobs whose
+        progress changed at or after since, other than those held by this process which report it themselves."""
+        with self._session() as session:
+            rows = session.execute(
+                select(JobQueueEntry.job_id, JobQueueEntry.job_type, JobQueueEntry.progress, JobQueueEntry.error,
+                       JobQueueEntry.job_data, JobQueueEntry.progress_at)
+                .where(JobQueueEntry.progress_at >= since,
+                       (JobQueueEntry.claimed_by == None) | (JobQueueEntry.claimed_by != self.workerName))
+                .order_by(JobQueueEntry.progress_at)
+            ).all()
+        if rows:
+            since = rows[-1].progress_at
+        return [(row.job_id, row.job_type, row.progress, row.error, row.job_data) for row in rows], since
+
+    def heartbeat(self)->int:
+        """Renews the leases of every job this process holds, returning how many were renewed."""
+        with self._heldLock:
+            held = list(self._held)
+        if not held:
+            return 0
+        with self._session() as session, session.begin():
+            result = session.execute(
+                update(JobQueueEntry)
+                .where(JobQueueEntry.job_id.in_(held), JobQueueEntry.state == RUNNING,
+                       JobQueueEntry.claimed_by == self.workerName)
+                .values(lease_expires_at = datetime.now() + self._leaseDuration)
+            )
+        if result.rowcount < len(held):
+            print(f"{len(held) - result.rowcount} job leases held by {self.workerName} had already been lost.")
+        if self._onCancel is not None:
+            self._stop_cancelled(held)
+        return result.rowcount
+
+    def _stop_cancelled(self, held:list)->None:
+        """Hands the held jobs which have been cancelled by another process to onCancel."""
+        with self._session() as session:
+            cancelled = session.execute(
+                select(JobQueueEntry.job_id)
+                .where(JobQueueEntry.job_id.in_(held), JobQueueEntry.cancel_requested == True,
+                       JobQueueEntry.claimed_by == self.workerName)
+            ).scalars().all()
+        for jobID in cancelled:
+            try:
+                self._onCancel(jobID)
+            except Exception as e:
+                print(f"Failed to stop cancelled job {jobID}: {e}")
+
+    def _start_heartbeat(self)->None:
+        with self._heldLock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = Thread(target=self._heartbeat_loop, name="job-queue-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def _heartbeat_loop(self)->None:
+        interval = self._leaseDuration.total_seconds() / 3
+        while True:
+            with self._wake:
+                if self._closed:
+                    return
+                self._wake.wait(interval)
+                if self._closed:
+                    return
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f"Failed to renew job leases: {e}")
+
+    def close(self, waiters:int = 0)->None:
+        """Wakes up every waiter blocked in claim() so they can exit, and stops the heartbeat.
+        Jobs still held when the heartbeat stops are claimed by another worker once their leases lapse."""
+        with self._wake:
+            self._closed = True
+            self._wake.notify_all()
+
+    def drain(self)->list:
+        """Deletes every waiting job without running it, returning them."""
+        with self._session() as session, session.begin():
+            entries = session.execute(
+                select(JobQueueEntry).where(JobQueueEntry.state == QUEUED).with_for_update()
+            ).scalars().all()
+            drained = [(entry.job_id, entry.job_type, entry.job_data) for entry in entries]
+            if drained:
+                session.execute(delete(JobQueueEntry).where(JobQueueEntry.job_id.in_([job[0] for job in drained])))
+        return drained
+
+    def empty(self)->bool:
+        return self.qsize() == 0
+
+    def qsize(self, tenant:str = None, maxPriority:int = None)->int:
+        """Counts the waiting jobs, only those of tenant and of priority maxPriority or more urgent if given."""
+        query = select(func.count()).select_from(JobQueueEntry).where(JobQueueEntry.state == QUEUED)
+        if tenant is not None:
+            query = query.where(JobQueueEntry.tenant == tenant)
+        if maxPriority is not None:
+            query = query.where(JobQueueEntry.priority <= maxPriority)
+        with self._session() as session:
+            return session.execute(query).scalar_one()
+
+    def finished_since(self, since:datetime)->int:
+        """Counts the jobs finished by any process since the given time, for estimating throughput."""
+        with self._session() as session:
+            return session.execute(
+                select(func.count()).select_from(JobQueueEntry)
+                .where(JobQueueEntry.state.in_([DONE, FAILED]), JobQueueEntry.finished_at >= since)
+            ).scalar_one()
+
+    def get(self, jobID:int)->dict:
+        """Looks up a job by ID, returning its row as a dict or None if there is no such job."""
+        with self._session() as session:
+            entry = session.get(JobQueueEntry, jobID)
+            if entry is None:
+                return None
+            return {
+                'job_id' : entry.job_id,
+                'job_type' : entry.job_type,
+                'state' : entry.state,
+                'subsystem_status' : entry.subsystem_status,
+                'submitted_at' : entry.submitted_at,
+                'started_at' : entry.started_at,
+                'finished_at' : entry.finished_at,
+                'result_path' : entry.result_path,
+                'error' : entry.error,
+                'claimed_by' : entry.claimed_by,
+                'attempts' : entry.attempts,
+                'cancel_requested' : entry.cancel_requested
+            }
+
+    def recover(self)->int:
+        """Requeues jobs whose holder's lease has lapsed, returning how many there were.
+        Claims pick these up anyway, this just makes them show up as QUEUED straight away."""
+        with self._session() as session, session.begin():
+            result = session.execute(
+                update(JobQueueEntry)
+                .where(JobQueueEntry.state == RUNNING, JobQueueEntry.lease_expires_at < datetime.now())
+                .values(state = QUEUED, started_at = None, claimed_by = None, lease_expires_at = None)
+            )
+        with self._wake:
+            self._wake.notify_all()
+        return result.rowcount
+
+    def _purge_finished(self)->None:
+        # At most every few minutes, from whichever worker happens to be idle
+        if monotonic() - self._lastPurge < 300:
+            return
+        self._lastPurge = monotonic()
+        cutoff = datetime.now() - self._retention
+        try:
+            with self._session() as session, session.begin():
+                session.execute(
+                    delete(JobQueueEntry)
+                    .where(JobQueueEntry.state.in_([DONE, FAILED, CANCELLED]), JobQueueEntry.finished_at < cutoff)
+                )
+        except Exception as e:
+            print(f"Failed to purge finished jobs: {e}")
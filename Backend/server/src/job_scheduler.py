@@ -0,0 +1,232 @@
+# Job Scheduler
+#
+# Decides which waiting job runs next. Every job has a priority and a tenant:
+#  - Priority 0 (INTERACTIVE) is work somebody is waiting on, i.e regenerating one submission's
+#    questions, priority 1 (BULK) is generation for a whole project. A lower number always goes first.
+#  - The tenant is who the job is for, the unit (unit:<unit_code>) or staff member (staff:<email>).
+#    Within a priority tenants take turns by weighted round robin, so one convener's 500 submission
+#    run doesn't hold up everybody else's single jobs. Within a tenant jobs run in the order they came.
+# The oldest job of a tenant's lane moves up a priority once it has waited the aging interval, and
+# the next one an interval after that, so bulk work still progresses under a steady stream of interactive
+# jobs. Only one job per tenant moves up per interval: aging a whole run at once would put the tenant's
+# own later interactive jobs (i.e a regen) behind all of it.
+#
+# The round robin is stride scheduling: each tenant has a pass value, the tenant with the lowest pass
+# goes next and its pass advances by 1 / weight. A tenant coming back after being idle starts from the
+# pass of the last tenant served, it doesn't get to catch up on the turns it missed.
+
+import heapq
+import itertools
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+# Priorities
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = 2
+
+DEFAULT_TENANT = ''
+
+class FairShare:
+    """The pass values of the weighted round robin, per priority and tenant. Thread safe."""
+
+    def __init__(self, weights:dict = None, clock = monotonic):
+        self._weights = dict(weights) if weights else {}
+        self._passes = {}                   # (priority, tenant) -> pass of its next job
+        self._virtual = {}                  # priority -> pass of the last job served
+        self._promotedAt = {}               # (priority, tenant) -> when a job of the lane was last served after aging
+        self._clock = clock
+        self._lock = Lock()
+
+    def weight(self, tenant:str)->float:
+        return self._weights.get(tenant, 1.0)
+
+    def set_weight(self, tenant:str, weight:float)->None:
+        if weight <= 0:
+            raise ValueError("A tenant's weight must be a positive number.")
+        with self._lock:
+            self._weights[tenant] = weight
+
+    def pass_of(self, priority:int, tenant:str)->float:
+        """The pass the tenant's next job at priority would be served at."""
+        with self._lock:
+            return max(self._passes.get((priority, tenant), 0.0), self._virtual.get(priority, 0.0))
+
+    def charge(self, priority:int, tenant:str, lanePriority:int = None)->float:
+        """Records that the tenant's job was served at priority, returning the tenant's next pass.
+        lanePriority is the priority it was queued at, if it was served at a better one after aging."""
+        with self._lock:
+            if lanePriority is not None and lanePriority > priority:
+                self._promotedAt[(lanePriority, tenant)] = self._clock()
+            current = max(self._passes.get((priority, tenant), 0.0), self._virtual.get(priority, 0.0))
+            self._virtual[priority] = current
+            self._passes[(priority, tenant)] = current + 1.0 / self._weights.get(tenant, 1.0)
+            return self._passes[(priority, tenant)]
+
+    def choose(self, lanes:list, agingSeconds:float):
+        """Picks the lane to serve from (priority, tenant, age in seconds of its oldest job, key) tuples.
+        Returns the chosen tuple and the priority it is served at after aging, or (None, None).
+        A lane only ages again agingSeconds after a job of it was last served aged, see charge()."""
+        best, bestKey = None, None
+        now = self._clock()
+        for lane in lanes:
+            priority, tenant, age, key = lane
+            with self._lock:
+                promotedAt = self._promotedAt.get((priority, tenant))
+            if promotedAt is not None:
+                age = min(age, now - promotedAt)
+            level = effective_priority(priority, age, agingSeconds)
+            rank = (level, self.pass_of(level, tenant), key)
+            if bestKey is None or rank < bestKey:
+                best, bestKey = lane, rank
+        if best is None:
+            return None, None
+        return best, bestKey[0]
+
+def effective_priority(priority:int, age:float, agingSeconds:float)->int:
+    """A job's priority after moving up one for every agingSeconds it has waited."""
+    if agingSeconds is None or agingSeconds <= 0:
+        return priority
+    return max(0, priority - int(age // agingSeconds))
+
+class FairScheduler:
+    """Holds waiting jobs and hands them out by priority, weighted round robin across tenants, and aging.
+    Every priority has a heap of its tenants keyed on their pass, and a heap of the oldest job of each
+    tenant for aging, so push and pop are O(log n). Not thread safe, MemoryJobQueue holds its own lock."""
+
+    def __init__(self, weights:dict = None, agingSeconds:float = 120, levels:int = PRIORITIES, clock = monotonic):
+        self.share = FairShare(weights)
+        self.agingSeconds = agingSeconds
+        self.levels = levels
+        self._clock = clock
+        self._counter = itertools.count()
+        self._count = 0
+        self._lanes = {}                            # (priority, tenant) -> deque of (seq, enteredAt, item)
+        self._ready = [[] for _ in range(levels)]   # Per priority, heap of (pass, token, tenant)
+        self._tokens = {}                           # (priority, tenant) -> token of its valid _ready entry
+        self._heads = [[] for _ in range(levels)]   # Per priority, heap of (aging from, seq, tenant) of lane heads
+        self._promotedAt = {}                       # (priority, tenant) -> when its last job was moved up
+
+    def __len__(self)->int:
+        return self._count
+
+    def push(self, item, priority:int = INTERACTIVE, tenant:str = DEFAULT_TENANT)->None:
+        priority = min(max(priority, 0), self.levels - 1)
+        self._append(priority, tenant if tenant is not None else DEFAULT_TENANT, item, self._clock())
+        self._count += 1
+
+    def pop(self):
+        """Takes the next job, or returns None if there are none."""
+        self._age(self._clock())
+        for priority in range(self.levels):
+            ready = self._ready[priority]
+            while ready:
+                _, token, tenant = heapq.heappop(ready)
+                key = (priority, tenant)
+                if self._tokens.get(key) != token:      # Stale, the lane emptied or was rescheduled since
+                    continue
+                lane = self._lanes[key]
+                _, _, item = lane.popleft()
+                nextPass = self.share.charge(priority, tenant)
+                if lane:
+                    self._schedule(priority, tenant, nextPass)
+                else:
+                    self._drop_lane(key)
+                self._count -= 1
+                return item
+        return None
+
+    def clear(self)->list:
+        """Takes every waiting job, oldest first within each tenant."""
+        items = [entry[2] for lane in self._lanes.values() for entry in lane]
+        self._lanes.clear()
+        self._tokens.clear()
+        self._promotedAt.clear()
+        self._ready = [[] for _ in range(self.levels)]
+        self._heads = [[] for _ in range(self.levels)]
+        self._count = 0
+        return items
+
+    def remove(self, matches)->list:
+        """Takes every waiting job for which matches(item) is true off the scheduler, returning them."""
+        removed = []
+        for key in list(self._lanes.keys()):
+            kept = deque()
+            for entry in self._lanes[key]:
+                if matches(entry[2]):
+                    removed.append(entry[2])
+                else:
+                    kept.append(entry)
+            if len(kept) == len(self._lanes[key]):
+                continue
+            if kept:
+                # The old heap entries go stale with the new token, and the new head is entered for aging
+                self._lanes[key] = kept
+                self._schedule(key[0], key[1], self.share.pass_of(key[0], key[1]))
+            else:
+                self._drop_lane(key)
+        self._count -= len(removed)
+        return removed
+
+    def count(self, tenant:str = None, maxPriority:int = None)->int:
+        """Waiting jobs of tenant and of priority maxPriority or more urgent, either left as None counts all."""
+        return sum(len(lane) for (priority, laneTenant), lane in self._lanes.items()
+                   if (tenant is None or laneTenant == tenant) and (maxPriority is None or priority <= maxPriority))
+
+    def depths(self)->dict:
+        """Waiting jobs per priority."""
+        depths = { priority : 0 for priority in range(self.levels) }
+        for (priority, _), lane in self._lanes.items():
+            depths[priority] += len(lane)
+        return depths
+
+    def _append(self, priority:int, tenant:str, item, enteredAt:float)->None:
+        key = (priority, tenant)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+        lane.append((next(self._counter), enteredAt, item))
+        if len(lane) == 1:
+            self._schedule(priority, tenant, self.share.pass_of(priority, tenant))
+
+    def _schedule(self, priority:int, tenant:str, passValue:float)->None:
+        """(Re)enters a non empty lane into its priority's heaps."""
+        key = (priority, tenant)
+        token = next(self._counter)
+        self._tokens[key] = token
+        heapq.heappush(self._ready[priority], (passValue, token, tenant))
+        if priority > 0:
+            seq, enteredAt, _ = self._lanes[key][0]
+            heapq.heappush(self._heads[priority], (max(enteredAt, self._promotedAt.get(key, enteredAt)), seq, tenant))
+
+    def _drop_lane(self, key:tuple)->None:
+        del self._lanes[key]
+        del self._tokens[key]
+        self._promotedAt.pop(key, None)
+
+    def _age(self, now:float)->None:
+        """Moves the head of every lane which has waited agingSeconds at its priority up one. The next job of the
+        lane starts waiting its agingSeconds then, so a lane moves up a job per interval rather than all at once."""
+        if self.agingSeconds is None or self.agingSeconds <= 0:
+            return
+        for priority in range(1, self.levels):
+            heads = self._heads[priority]
+            while heads:
+                enteredAt, seq, tenant = heads[0]
+                key = (priority, tenant)
+                lane = self._lanes.get(key)
+                if lane is None or lane[0][0] != seq:   # Stale, that job has been served or moved up
+                    heapq.heappop(heads)
+                    continue
+                if now - enteredAt < self.agingSeconds:
+                    break
+                heapq.heappop(heads)
+                _, _, item = lane.popleft()
+                if lane:
+                    self._promotedAt[key] = now
+                    nextSeq, _, _ = lane[0]
+                    heapq.heappush(heads, (now, nextSeq, tenant))
+                else:
+                    self._drop_lane(key)
+                self._append(priority - 1, tenant, item, now)
@@ -1,29 +1,45 @@
 # Job Subsystem
 # By Harris C. McRae, 2024
 #
-# Initializes a separate threaded monitor process which
-# manages a queue of jobs to be submitted to an AI function
-# package. There may be one or more queues based on the queue priority;
-# i.e a "slow queue" which only submits a job every N jobs from the
-# "standard queue".h
+# Initializes a pool of worker threads which consume a shared
+# queue of jobs to be submitted to an AI function
+# package. Jobs are taken off the queue by priority, interactive jobs
+# (a single generation or regen) before bulk ones (a whole project),
+# and in turns across units and staff so nobody's bulk run starves the
+# rest. See src/job_scheduler.py.
 #
 # Most functions will return a SubsystemStatus enum as an info code. See the
 # definition of SubsystemStatus below.
 
 from enum import Enum
 from typing import List
-from threading import Thread
+from threading import Thread, Lock
+from collections import OrderedDict
+from functools import partial
 from time import sleep
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import requests
 import json
 import os
+import hashlib
+import math
 from botocore.exceptions import ClientError
 import src.file_management as fm
 import src.ai.viva_questions as viva
 import src.ai.pdf_to_text as ptt
 import src.ai.rubric_gen as rubric
+import src.ai.async_engine as aiengine
+import src.ai.batch_api as batch_api
+import src.ai.resilience as resilience
+import src.extraction_cache as extraction_cache
+import src.job_checkpoints as checkpoints
+import src.job_queue as jq
+import src.job_pipeline as jp
+import src.job_scheduler as sched
+import src.job_events as events
+import src.metrics as metrics
+import src.cancellation as cancellation
 import src.formatting as format
 
 class SubsystemStatus(Enum):
@@ -46,6 +62,10 @@ class SubsystemStatus(Enum):
     REMOTE_SYS_ERROR = -8           # An error occurred when trying to connect to remote storage
     DB_SYS_ERROR = -9               # An error occurred when trying to connect to databases
     WRONG_JOB = -10                 # Wrong job was passed to a certain function.
+    AI_UNAVAILABLE = -11            # The AI provider is failing (circuit breaker open), the job is put back on the queue.
+    QUEUE_FULL = -12                # The queue, or the tenant's share of it, is at its limit. Try again later.
+    CANCELLED = -13                 # The job was cancelled, i.e its project was deleted.
+    DEADLINE_EXCEEDED = -14         # The job ran past the deadline of its job type and was stopped.
 
 class _SJobType:
     """An enum of all job types."""
@@ -54,16 +74,39 @@ class _SJobType:
     VIVA_REGEN = 2
     RUBRIC_GEN = 3
     RUBRIC_CONVERT = 4
+    VIVA_BATCH = 5                  # Viva gen for many submissions at once through the OpenAI Batch API.
 
 _jobTypeHasFiles = { _SJobType.VIVA_GEN, _SJobType.VIVA_REGEN, _SJobType.RUBRIC_CONVERT }
 _jobTypeIsViva = { _SJobType.VIVA_GEN, _SJobType.VIVA_REGEN }
 _jobTypeIsRubric = { _SJobType.RUBRIC_GEN, _SJobType.RUBRIC_CONVERT }
+_jobTypeNames = { _SJobType.UNDEFINED : 'UNDEFINED', _SJobType.VIVA_GEN : 'VIVA_GEN', _SJobType.VIVA_REGEN : 'VIVA_REGEN',
+                  _SJobType.RUBRIC_GEN : 'RUBRIC_GEN', _SJobType.RUBRIC_CONVERT : 'RUBRIC_CONVERT',
+                  _SJobType.VIVA_BATCH : 'VIVA_BATCH' }
+
+class JobState(Enum):
+    """The lifecycle state of a single job, the values are what the /job_status endpoints report."""
+    QUEUED = 'QUEUED'               # Waiting on the queue for a worker.
+    RUNNING = 'IN_PROGRESS'         # Taken by a worker.
+    DONE = 'COMPLETED'              # Finished and saved to S3 / databases.
+    FAILED = 'FAILED'               # Finished with an error.
+    CANCELLED = 'CANCELLED'         # Cancelled before it finished.
 
 class _SubsystemJob:
     jobID:int
     filePath:str
     jobType:_SJobType
     data:dict
+    resultPath:str = None           # S3 path of the saved output, set once the job has been processed.
+    error:str = None                # Details of a failure while processing, i.e which submissions of a batch failed.
+    pdfBytes:bytes = None           # Carried between the pipeline stages, each is dropped once the next stage is done with it.
+    fileContent = None
+    result = None
+    packaged:dict = None            # Name & S3 path of the output once saved to S3, before the db rows are written.
+    checkpoint:str = None           # Key of the checkpoint the job resumed from (or saved while running), dropped once it's done.
+    token:cancellation.CancelToken = None   # Set while the job runs, says when it has been cancelled or run past its deadline.
+    parent = None                   # The batch job a part (one of its submissions going through fetch & extract) belongs to.
+    parts:dict = None               # Batch ID -> (success, extracted text or error) of the parts of a batch job collected so far.
+    partsLeft:int = 0
 
     def __init__(self, jID:int, jtype:_SJobType, data:dict):
         self.jobID = jID
@@ -75,84 +118,213 @@ class _SubsystemJob:
     
     def deserialize(self, data):
         self.jobID, self.jobType, self.data = json.loads(data)
-    
-            
+
+class _JobRecord:
+    """The status registry entry of a job."""
+    jobID:int
+    jobType:_SJobType
+    state:JobState
+    status:SubsystemStatus
+    submittedAt:datetime
+    startedAt:datetime = None
+    finishedAt:datetime = None
+    resultPath:str = None
+    error:str = None
+
+    def __init__(self, jID:int, jtype:_SJobType):
+        self.jobID = jID
+        self.jobType = jtype
+        self.state = JobState.QUEUED
+        self.status = SubsystemStatus.OKAY
+        self.submittedAt = datetime.now()
+
+    def to_dict(self)->dict:
+        return {
+            'job_id' : self.jobID,
+            'job_type' : _jobTypeNames.get(self.jobType, 'UNDEFINED'),
+            'status' : self.state.value,
+            'subsystem_status' : self.status.name,
+            'submitted_at' : self.submittedAt.isoformat(),
+            'started_at' : self.startedAt.isoformat() if self.startedAt else None,
+            'finished_at' : self.finishedAt.isoformat() if self.finishedAt else None,
+            'result_path' : self.resultPath,
+            'error' : self.error
+        }
+
 
 # Internal Variables
 _globalJobCounter: int = -1                 # The global job ID counter. Each job has a unique ID.
 _jobSubsystemState: SubsystemStatus = SubsystemStatus.NOT_INITIALISED
 
+_jobCounterLock: Lock = Lock()              # Guards _globalJobCounter, jobs are submitted from many request threads.
+_coalesceLock: Lock = Lock()                # Makes looking for an identical job and enqueuing a new one atomic within the process.
+
 # Multi-threaded specific variables
 _jobSubsystemRunning: bool = False
 _jobSubsystemStartShutdown: bool = False
 _jobSubsystemFrequency: float = 0
-_jobQueue: List[_SubsystemJob] = []         # A queue of jobs that are waiting for an available instance.
-_threadObj:Thread = None                    # The thread object.
+_jobQueue = None                            # The queue of jobs waiting for an available instance, a MemoryJobQueue or DatabaseJobQueue.
+_instanceCount: int = 0                     # The number of generate stage worker threads.
+_workerThreads: List[Thread] = []           # The dispatcher thread, taking jobs off the queue into the pipeline.
+_pipeline: jp.Pipeline = None               # The fetch -> extract -> generate -> persist stages jobs are run through.
+_runningJobs: dict = {}                     # Job ID -> _SubsystemJob, of every job this process has claimed and not finished.
+_runningLock: Lock = Lock()
+_partsLock: Lock = Lock()                   # Guards the parts collected by batch jobs.
+_stageWorkers: dict = { 'fetch' : 2, 'extract' : 1, 'generate' : 1, 'persist' : 2 }   # Worker threads per stage, generate is set by initialise().
+_stageQueueSize: int = 4                    # Jobs which may wait in front of a stage beyond one per worker.
+_persistBatchSize: int = 32                 # Most jobs the persist stage saves in one db transaction.
+_persistWindow: float = 0.005               # Seconds the persist stage waits for more jobs to save with the first one.
+_app = None                                 # The flask app, jobs are run inside its app context so they can use the db.
+
+# Job status registry
+_jobRecords: dict = {}                      # Job ID -> _JobRecord, for every job still retained.
+_finishedJobs: OrderedDict = OrderedDict()  # Job IDs of finished jobs, oldest finish first. Drives eviction.
+_jobRecordLock: Lock = Lock()
+_jobRecordLimit: int = 10000                # Finished jobs are evicted (oldest first) once more than this many are retained.
+_jobRecordMaxAge: timedelta = timedelta(hours=24)   # Finished jobs older than this are evicted.
 
 # Debug settings
 _barSubmit:bool = False                     # Debug value : enable this to stop jobs from escalating to the generation state.
 _debugUseLocalAddr:bool = False              # Debug value : enable this to use local files instead of remote for testing.
-_doSingleThread:bool = True                 # TURN THIS TO TRUE TO DISABLE THE SECOND THREAD OBJECT
+_coalesceJobs:bool = True                   # Attaches new jobs to an identical queued or running job instead of enqueuing them.
+_doSingleThread:bool = False                # TURN THIS TO TRUE TO RUN EVERY JOB INLINE IN THE SUBMITTING THREAD
 
 # Misc settings
-_downloadFileBeforeUse:bool = True          # Enables downloading files from S3 instance before passing them to AI functions.
+_downloadFileBeforeUse:bool = False         # Enables downloading files from S3 to UPLOAD_FOLDER before use, instead of streaming them.
+_useAsyncEngine:bool = True                 # Sends AI calls through the shared async engine instead of each module's sync client.
+_batchPollSeconds:float = 30               # How often a batch job checks on its OpenAI batch, it waits on the queue in between.
+_batchTimeout:float = 25 * 60 * 60          # A batch still running after this long is cancelled, past its 24h completion window.
+_queueBackend:str = 'memory'                # 'memory' or 'database', which store the job queue is kept in. Set by initialise().
+_queueFile:str = '.queue'                   # Where shutdown() saves a memory queue, and initialise(load=True) loads it from.
+_agingSeconds:float = 120                   # A queued job moves up a priority for every this many seconds it waits.
+_tenantWeights:dict = {}                    # Tenant ('unit:<unit_code>' or 'staff:<email>') -> its share of the workers, 1 by default.
+_maxQueuedJobs:int = 1000                   # New jobs are turned away while this many are waiting (0 for no limit).
+_maxQueuedPerTenant:int = 500               # ... or while the unit / staff member has this many waiting (0 for no limit).
+_throughputWindow:timedelta = timedelta(minutes=10)  # Completions over this long estimate how fast the queue drains.
+_defaultJobSeconds:float = 30               # Assumed time of a job per worker, until any have finished in the window.
+_maxRetryAfter:int = 3600                   # Upper bound of the Retry-After given to a turned away request.
+_jobDeadlines:dict = { _SJobType.VIVA_GEN : 600, _SJobType.VIVA_REGEN : 600, _SJobType.RUBRIC_GEN : 600,
+                       _SJobType.RUBRIC_CONVERT : 600, _SJobType.VIVA_BATCH : None }
+                                            # Seconds a job of each type may run, from when the pipeline starts on it, before it is stopped.
+                                            # None for no limit.
+                                            # Batch jobs are bounded by _batchTimeout instead.
+
+# Metrics, exported at /metrics (see src/metrics.py). Queue and stage depths are read when scraped, see _queue_depths.
+_stageSeconds = metrics.histogram('job_stage_duration_seconds', 'Time a pipeline stage spent on a job.', ('stage',))
+_stageWaitSeconds = metrics.histogram('job_stage_wait_seconds', 'Time a job waited in front of a pipeline stage.', ('stage',))
+_jobsFinished = metrics.counter('job_subsystem_jobs_finished_total', 'Jobs finished, by job type and SubsystemStatus.', ('job_type', 'status'))
+_jobErrors = metrics.counter('job_subsystem_errors_total', 'Jobs failed or put back on the queue, by SubsystemStatus.', ('status',))
+_jobsResumed = metrics.counter('job_checkpoint_resumes_total', 'Jobs resumed from a checkpoint, by the stage it was saved at.', ('stage',))
 
 def _submit_job(job:_SubsystemJob)->(SubsystemStatus, dict):
-    global _jobSubsystemState
-
+    """Runs the fetch, extract and generate steps of a job one after the other on the calling thread.
+    Worker threads run the same steps as separate stages of the pipeline instead, see _stage_fetch."""
     if _jobSubsystemState == SubsystemStatus.SHUTDOWN or _jobSubsystemState == SubsystemStatus.NOT_INITIALISED:
         return _jobSubsystemState,''
 
-    success:bool
-    result:str
     file_content = None
-
     if job.jobType in _jobTypeHasFiles:
+        status, file_content = _read_job_file(job.data['file_path'])
+        if status != SubsystemStatus.OKAY:
+            return status, file_content
+    return _generate_job(job, file_content)
+
+def _fetch_file(filePath:str)->(SubsystemStatus, object):
+    """Fetches a job's PDF, returning (OKAY, pdf_bytes) or an error status and message."""
+    pdf_bytes = None
+    if not _debugUseLocalAddr:
         
-        if not _debugUseLocalAddr:
+        if _downloadFileBeforeUse:
+            # Download the PDF file from s3 to a local path
+            status, local_pdf_path = fm.download_file_from_s3(filePath)
+            if status != fm.FileStatus.OKAY or not local_pdf_path:
+                return SubsystemStatus.NO_SAVED_FILE, ''
             
-            if _downloadFileBeforeUse:
-                # Download the PDF file from s3 to a local path
-                status, local_pdf_path = fm.download_file_from_s3(job.data['file_path'])
-                if status != fm.FileStatus.OKAY or not local_pdf_path:
-                    return SubsystemStatus.NO_SAVED_FILE, ''
+            # Read the local file
+            with open(local_pdf_path, 'rb') as file:
+                pdf_bytes = file.read()
                 
-                # Open and proces the local file
-                with open(local_pdf_path, 'rb') as file:
-                    file_content = ptt.extract_text_and_tables_from_pdf(file)
-                    
-                # Clean up the local file after processing
-                if os.path.exists(local_pdf_path):
-                    os.remove(local_pdf_path)
-                    
-            else: # load from remote
-                file_content = ptt.extract_text_and_tables_from_pdf(fm.get_pdf_binary_file(job.data['file_path']))
+            # Clean up the local file after reading
+            if os.path.exists(local_pdf_path):
+                os.remove(local_pdf_path)
                 
-        else: # load from local, debug mode
-            file = open(job.data['file_path'], mode='rb')
-            if not file:
+        else: # read from remote straight into memory rather than through UPLOAD_FOLDER
+            status, pdf_bytes = fm.get_object_bytes(filePath, cache=False)
+            if status != fm.FileStatus.OKAY or pdf_bytes is None:
                 return SubsystemStatus.NO_SAVED_FILE, ''
-            file_content = ptt.extract_text_and_tables_from_pdf(file)
-            file.close()
+            
+    else: # load from local, debug mode
+        if not os.path.isfile(filePath):
+            return SubsystemStatus.NO_SAVED_FILE, ''
+        with open(filePath, mode='rb') as file:
+            pdf_bytes = file.read()
+
+    return SubsystemStatus.OKAY, pdf_bytes
+
+def _extract_file(pdf_bytes:bytes, token:cancellation.CancelToken = None)->(SubsystemStatus, object):
+    """Extracts the text of a PDF, returning (OKAY, file_content) or an error status and message.
+    A token is checked between pages, raising cancellation.Cancelled to stop."""
+    # Repeat & regen jobs on the same PDF are served from the extraction cache
+    if token is None:
+        file_content = extraction_cache.get_or_extract(pdf_bytes)
+    else:
+        file_content = extraction_cache.get_or_extract(pdf_bytes, partial(ptt.extract_text_and_tables_from_pdf, token=token))
 
-        if file_content is None:
-            return SubsystemStatus.FM_SYS_ERROR, "Error with file encoding or reading."
+    if file_content is None:
+        return SubsystemStatus.FM_SYS_ERROR, "Error with file encoding or reading."
         
+    return SubsystemStatus.OKAY, file_content
+
+def _read_job_file(filePath:str)->(SubsystemStatus, object):
+    """Fetches a job's PDF and extracts its text, returning (OKAY, file_content) or an error status and message."""
+    status, pdf_bytes = _fetch_file(filePath)
+    if status != SubsystemStatus.OKAY:
+        return status, pdf_bytes
+    return _extract_file(pdf_bytes)
+
+def _generate_job(job:_SubsystemJob, file_content)->(SubsystemStatus, dict):
+    """Sends a job, with its extracted file content if it has one, to the AI and checks the response.
+    Returns AI_UNAVAILABLE if the circuit breaker is open, the job should be put back on the queue."""
+    try:
+        return _generate(job, file_content)
+    except resilience.CircuitOpenError as e:
+        return SubsystemStatus.AI_UNAVAILABLE, str(e)
+
+def _generate(job:_SubsystemJob, file_content)->(SubsystemStatus, dict):
+    success:bool
+    result:str
+
+    # The async engine exposes the same blocking functions as the viva & rubric modules, and can also
+    # abandon a call part way once the job's token says to stop. The sync clients only stop between calls.
+    useEngine = _useAsyncEngine and aiengine.is_initialised()
+    ai_viva = aiengine if useEngine else viva
+    ai_rubric = aiengine if useEngine else rubric
+    options = { 'token' : job.token } if useEngine and job.token is not None else {}
+    cancellation.check(job.token)
+
+    if job.jobType == _SJobType.VIVA_BATCH:
+        status, results = _submit_viva_batch(job)
+        if status == SubsystemStatus.OKAY:
+            # A batch can take hours, keep its results in case this process dies before they're all saved
+            job.checkpoint = _job_fingerprint(job.jobType, job.data)
+            checkpoints.save(job.checkpoint, checkpoints.RESPONSE, results)
+        return status, results
+
+    if job.jobType in _jobTypeHasFiles:
         if job.jobType == _SJobType.VIVA_GEN:           # VIVA QN GEN
             job.data["assignment_content"] = file_content
-            print("Printing the input we send to AI: ", job.data)
-            success, result = viva.generate_viva_questions(job.data)
+            success, result = ai_viva.generate_viva_questions(job.data, **options)
         elif job.jobType == _SJobType.VIVA_REGEN:       # VIVA QN REGEN
             job.data["assignment_content"] = file_content
-            success, result = viva.regenerate_questions(job.data)
+            success, result = ai_viva.regenerate_questions(job.data, **options)
 
         elif job.jobType == _SJobType.RUBRIC_CONVERT:   # RUBRIC CONVERT
             job.data["marking_guide"] = file_content
-            result = rubric.convert_rubric(job.data)
+            result = ai_rubric.convert_rubric(job.data, **options)
             success = result is not None
     else:
         if job.jobType == _SJobType.RUBRIC_GEN:         # RUBRIC GEN
-            result = rubric.generate_rubric(job.data)
+            result = ai_rubric.generate_rubric(job.data, **options)
             success = result is not None
             
     if not success:
@@ -166,9 +338,175 @@ def _submit_job(job:_SubsystemJob)->(SubsystemStatus, dict):
         
     return SubsystemStatus.OKAY, result
     
+def _batch_id_of(item:dict)->str:
+    return f"submission-{item['submission_id']}"
+
+def _submit_viva_batch(job:_SubsystemJob)->(SubsystemStatus, dict):
+    """Sends the viva gen of every submission in a batch job as one OpenAI batch and waits for it.
+    Returns a dict of batch id -> (success, questions or error), a failed submission doesn't fail the others."""
+    results = {}
+    requests = {}
+    for item in job.data['submissions']:
+        cancellation.check(job.token)
+        status, file_content = _read_job_file(item['file_path'])
+        if status != SubsystemStatus.OKAY:
+            results[_batch_id_of(item)] = (False, f"{status.name} {file_content}".strip())
+            continue
+        success, request = viva.build_viva_request({ **item, 'assignment_content' : file_content })
+        if not success:
+            results[_batch_id_of(item)] = (False, request)
+            continue
+        requests[_batch_id_of(item)] = request
+
+    if requests:
+        if viva.client is None:
+            return SubsystemStatus.AI_SYS_ERROR, "OpenAI client not initialized"
+        results.update(batch_api.run_batch(viva.client, requests, _batchPollSeconds, _batchTimeout,
+                                           metadata={ 'job_id' : str(job.jobID) }, token=job.token))
+    return SubsystemStatus.OKAY, _check_batch_results(results)
+
+def _check_batch_results(results:dict)->dict:
+    """Puts the responses of a batch through the same checks & corrections a single viva gen job's response goes through."""
+    for batchID, (success, result) in results.items():
+        if not success:
+            continue
+        success, result = viva.process_ai_response(result)
+        if success:
+            result = format.correct_ai_output(json.loads(result))
+        results[batchID] = (success, result)
+    return results
+
+def _viva_batch_parts(job:_SubsystemJob)->list:
+    """Splits a batch job which hasn't submitted its OpenAI batch yet into a part per submission. The parts go
+    through the fetch and extract stages like any other job, the last one extracted submits the batch (see _collect_part)."""
+    job.parts = {}
+    job.partsLeft = len(job.data['submissions'])
+    parts = []
+    for item in job.data['submissions']:
+        part = _SubsystemJob(job.jobID, _SJobType.VIVA_GEN, dict(item))
+        part.parent = job
+        part.token = job.token
+        parts.append(part)
+    return parts
+
+def _collect_part(part:_SubsystemJob, status:SubsystemStatus, content)->None:
+    """Keeps the extracted text (or the error) of a part of a batch job, submitting the batch once it has them all."""
+    job = part.parent
+    part.pdfBytes = part.fileContent = None
+    with _partsLock:
+        if status == SubsystemStatus.OKAY:
+            job.parts[_batch_id_of(part.data)] = (True, content)
+        else:
+            job.parts[_batch_id_of(part.data)] = (False, f"{status.name} {content or ''}".strip())
+        job.partsLeft -= 1
+        if job.partsLeft > 0:
+            return
+    _send_viva_batch(job)
+
+def _send_viva_batch(job:_SubsystemJob)->None:
+    """Submits the OpenAI batch of a batch job whose parts have all been extracted, then puts the job back on the queue
+    with the batch's ID to check on it every _batchPollSeconds (see _check_viva_batch). Nothing waits on the batch meanwhile,
+    and a retry, or another worker, carries on checking the same batch rather than paying for another."""
+    parts, job.parts = job.parts, None
+    if job.token is not None and job.token.reason == cancellation.CANCELLED:
+        _stop_job(job, cancellation.CANCELLED)
+        return
+
+    requests = {}
+    failed = {}
+    for item in job.data['submissions']:
+        batchID = _batch_id_of(item)
+        success, content = parts.get(batchID, (False, "No result"))
+        if success:
+            success, content = viva.build_viva_request({ **item, 'assignment_content' : content })
+        if success:
+            requests[batchID] = content
+        else:
+            failed[batchID] = content
+
+    if not requests:
+        _finish_job(job, SubsystemStatus.AI_SYS_ERROR, f"{len(failed)} of {len(job.data['submissions'])} submissions failed. " +
+                    "; ".join(f"{item['submission_id']}: {failed[_batch_id_of(item)]}" for item in job.data['submissions']))
+        return
+    if viva.client is None:
+        _finish_job(job, SubsystemStatus.AI_SYS_ERROR, "OpenAI client not initialized")
+        return
+    try:
+        batchID = batch_api.submit_batch(viva.client, requests, metadata={ 'job_id' : str(job.jobID) })
+    except resilience.CircuitOpenError as e:
+        print(f"Job {job.jobID} put back on the queue: {e}")
+        _jobErrors.inc(status=SubsystemStatus.AI_UNAVAILABLE.name)
+        _requeue_job(job)
+        return
+    except Exception as e:
+        _finish_job(job, SubsystemStatus.AI_SYS_ERROR, f"Failed to submit the batch: {e}")
+        return
+
+    print(f"Job {job.jobID} submitted batch {batchID} with {len(requests)} requests")
+    job.data.update({ 'batch_id' : batchID, 'batch_requests' : list(requests.keys()), 'batch_failed' : failed,
+                      'batch_submitted_at' : datetime.now().isoformat() })
+    _defer_job(job, _batchPollSeconds)
+
+def _check_viva_batch(job:_SubsystemJob)->bool:
+    """Checks once on the OpenAI batch a batch job submitted. One still running is put back on the queue until the
+    next check, past _batchTimeout it is cancelled and given a while longer to stop. Once it has ended its results are
+    fetched, returning True for the job to go on to be saved. A failed check counts as the batch still running."""
+    data = job.data
+    batchID = data['batch_id']
+    if viva.client is None:
+        _finish_job(job, SubsystemStatus.AI_SYS_ERROR, "OpenAI client not initialized")
+        return False
+
+    batch = batch_api.check_batch(viva.client, batchID)
+    waited = (datetime.now() - datetime.fromisoformat(data['batch_submitted_at'])).total_seconds()
+    if not batch_api.is_finished(batch) and waited < _batchTimeout + _batchPollSeconds * 10:
+        if waited >= _batchTimeout and not data.get('batch_cancelled'):
+            print(f"Batch {batchID} of job {job.jobID} still running after {_batchTimeout:g} seconds, cancelling it")
+            batch_api.cancel_batch(viva.client, batchID)
+            data['batch_cancelled'] = True
+        _defer_job(job, _batchPollSeconds)
+        return False
+
+    if batch is None:
+        results = { customID : (False, f"Batch {batchID} could not be checked on") for customID in data['batch_requests'] }
+    else:
+        try:
+            results = batch_api.fetch_results(viva.client, batch, data['batch_requests'])
+        except resilience.CircuitOpenError as e:
+            print(f"Job {job.jobID} couldn't fetch the results of batch {batchID} yet: {e}")
+            _defer_job(job, _batchPollSeconds)
+            return False
+        print(f"Batch {batchID} of job {job.jobID} ended {batch.status}")
+    results.update({ customID : (False, error) for customID, error in data.get('batch_failed', {}).items() })
+    job.result = _check_batch_results(results)
+
+    # Keep the results in case this process dies before they're all saved
+    job.checkpoint = _job_fingerprint(job.jobType, job.data)
+    checkpoints.save(job.checkpoint, checkpoints.RESPONSE, job.result)
+    return True
+
+def _process_viva_batch(job:_SubsystemJob, data:dict)->SubsystemStatus:
+    """Saves the questions of every successful submission in a batch job, the same way as a viva gen job."""
+    failed = []
+    for item in job.data['submissions']:
+        success, result = data.get(_batch_id_of(item), (False, "No result"))
+        if success:
+            status = _process_viva(_SubsystemJob(job.jobID, _SJobType.VIVA_GEN, dict(item)), result)
+            if status == SubsystemStatus.OKAY:
+                continue
+            result = status.name
+        failed.append(f"{item['submission_id']}: {result}")
+
+    if failed:
+        job.error = f"{len(failed)} of {len(job.data['submissions'])} submissions failed. " + "; ".join(failed)
+        return SubsystemStatus.AI_SYS_ERROR
+    return SubsystemStatus.OKAY
+
 def _process_completed_job(job:_SubsystemJob, data:dict)->SubsystemStatus:
     """Processes a completed job appropriately."""
 
+    if job.jobType == _SJobType.VIVA_BATCH:
+        return _process_viva_batch(job, data)
     if job.jobType in _jobTypeIsViva:
         return _process_viva(job, data)
     elif job.jobType in _jobTypeIsRubric:
@@ -183,27 +521,45 @@ def _process_viva(job:_SubsystemJob, data:dict)->SubsystemStatus:
     if job.jobType not in _jobTypeIsViva:
         return SubsystemStatus.WRONG_JOB
 
+    status = _package_viva(job, data)
+    if status != SubsystemStatus.OKAY:
+        return status
+
+    # Dump the JSON data to the S3 object
+    # try:
+    #     s3.put_object(Bucket=S3_BUCKET_NAME, Key=s3_path, Body=json.dumps(combined_questions), ContentType='application/json')
+    # except ClientError as e:
+    #     print(f"Error uploading JSON data to S3: {str(e)}")
+    #     return SubsystemStatus.REMOTE_SYS_ERROR
+    
+    msg, code = qgen_queries.upload_generated_files(job.data["submission_id"], job.packaged['name'], job.packaged['s3_path'], 'GENERATED')
+    if code != 201:
+        return SubsystemStatus.DB_SYS_ERROR
+    return SubsystemStatus.OKAY
+
+def _package_viva(job:_SubsystemJob, data:dict, submission = None)->SubsystemStatus:
+    """Packages a viva job's questions with the project's static & question bank ones and saves the JSON to S3,
+    setting job.packaged. The db rows are left to the caller. submission can be given if already retrieved."""
+    import src.controllers.qgen_queries as qgen_queries
+
+    if job.packaged is not None:            # Resumed after the JSON was saved, only the db is left to update
+        job.resultPath = job.packaged['s3_path']
+        return SubsystemStatus.OKAY
+
     if job.jobType is _SJobType.VIVA_REGEN:
         status,data = zipper_merge_dict(job, data)
         if status != SubsystemStatus.OKAY:
             return status
-    
-    combined_questions = qgen_queries.package_all_questions(job.data["submission_id"], data)
+
+    combined_questions = qgen_queries.package_all_questions(job.data["submission_id"], data, submission)
     name = job.data["assignment_title"] + '_generated_' + datetime.now().strftime("%d%m%Y_%H:%M:%S")
 
     status, s3_path = fm.create_json_file(name + '.json', combined_questions, rename=True)
 
     if status != fm.FileStatus.OKAY:
         return SubsystemStatus.FM_SYS_ERROR
-    
-    # Dump the JSON data to the S3 object
-    # try:
-    #     s3.put_object(Bucket=S3_BUCKET_NAME, Key=s3_path, Body=json.dumps(combined_questions), ContentType='application/json')
-    # except ClientError as e:
-    #     print(f"Error uploading JSON data to S3: {str(e)}")
-    #     return SubsystemStatus.REMOTE_SYS_ERROR
-    
-    qgen_queries.upload_generated_files(job.data["submission_id"], name, s3_path, 'GENERATED')
+    job.packaged = { 'name' : name, 's3_path' : s3_path }
+    job.resultPath = s3_path
     return SubsystemStatus.OKAY
 
 def _process_rubric(job:_SubsystemJob, data:dict)->SubsystemStatus:
@@ -212,17 +568,24 @@ def _process_rubric(job:_SubsystemJob, data:dict)->SubsystemStatus:
     import src.controllers.marking_guide_queries as mrgenqueries
 
     
-    if data.get("rubric_title") is not None:
-        name = data["rubric_title"]
-        
-    name = name + '_rubric_' + datetime.now().strftime("%d%m%Y_%H:%M:%S")
     idx = 201
-        
-    filename = name + ".json"
+    if job.packaged is not None:            # Resumed after the JSON was saved, only the db is left to update
+        name, filename = job.packaged['name'], job.packaged['filename']
+    else:
+        if data.get("rubric_title") is not None:
+            name = data["rubric_title"]
+
+        name = name + '_rubric_' + datetime.now().strftime("%d%m%Y_%H:%M:%S")
+        filename = name + ".json"
     if not _debugUseLocalAddr:
-        status, s3_path = fm.create_json_file(filename, data, rename=True)
-        if status != fm.FileStatus.OKAY:
-            return SubsystemStatus.FM_SYS_ERROR
+        if job.packaged is not None:
+            s3_path = job.packaged['s3_path']
+        else:
+            status, s3_path = fm.create_json_file(filename, data, rename=True)
+            if status != fm.FileStatus.OKAY:
+                return SubsystemStatus.FM_SYS_ERROR
+            job.packaged = { 'name' : name, 'filename' : filename, 's3_path' : s3_path }
+        job.resultPath = s3_path
 
         # # Dump the JSON data to the S3 object
         # try:
@@ -243,117 +606,571 @@ def _process_rubric(job:_SubsystemJob, data:dict)->SubsystemStatus:
         return SubsystemStatus.OKAY
     return SubsystemStatus.DB_SYS_ERROR
 
+def _register_job(job:_SubsystemJob)->None:
+    """Adds a newly submitted job to the status registry as QUEUED."""
+    with _jobRecordLock:
+        _jobRecords[job.jobID] = _JobRecord(job.jobID, job.jobType)
+        _evict_finished_jobs()
+
+def _mark_job_running(job:_SubsystemJob)->None:
+    with _jobRecordLock:
+        record = _jobRecords.get(job.jobID)
+        if record is None:
+            record = _jobRecords[job.jobID] = _JobRecord(job.jobID, job.jobType)
+        record.state = JobState.RUNNING
+        record.startedAt = datetime.now()
+
+def _mark_job_finished(job:_SubsystemJob, status:SubsystemStatus, error:str = None)->None:
+    """Records the outcome of a job, a job is DONE only if it finished with an OKAY status."""
+    with _jobRecordLock:
+        record = _jobRecords.get(job.jobID)
+        if record is None:
+            record = _jobRecords[job.jobID] = _JobRecord(job.jobID, job.jobType)
+        record.status = status
+        record.finishedAt = datetime.now()
+        record.resultPath = job.resultPath
+        record.state = _state_of(status)
+        if record.state != JobState.DONE:
+            record.error = error if error else status.name
+        _finishedJobs[job.jobID] = None
+        _evict_finished_jobs()
+
+def _state_of(status:SubsystemStatus)->JobState:
+    """The state a job finishing with status ends in."""
+    if status == SubsystemStatus.OKAY:
+        return JobState.DONE
+    if status == SubsystemStatus.CANCELLED:
+        return JobState.CANCELLED
+    return JobState.FAILED
+
+def _evict_finished_jobs()->None:
+    """Drops the oldest finished jobs past the retention limit or age. Must hold _jobRecordLock."""
+    cutoff = datetime.now() - _jobRecordMaxAge
+    while len(_finishedJobs) > 0:
+        oldestID = next(iter(_finishedJobs))
+        oldest = _jobRecords.get(oldestID)
+        if oldest is not None and len(_jobRecords) <= _jobRecordLimit and oldest.finishedAt > cutoff:
+            break
+        _finishedJobs.popitem(last=False)
+        _jobRecords.pop(oldestID, None)
+
+def _job_project(data:dict)->str:
+    """The project a job belongs to in progress events, if it has one."""
+    title = data.get('assignment_title')
+    if title is None and data.get('submissions'):
+        title = data['submissions'][0].get('assignment_title')
+    return events.project_key(data.get('unit_code'), title)
+
+def _report(job:_SubsystemJob, event:str, error:str = None, initial:bool = False)->None:
+    """Publishes how far a job has got to the progress event streams (see src/job_events.py).
+    The steps in between being queued and finishing are recorded in a database queue too, for streams in other processes."""
+    details = { 'job_type' : _jobTypeNames.get(job.jobType, 'UNDEFINED'), 'project' : _job_project(job.data),
+                'submission_id' : job.data.get('submission_id') }
+    if error:
+        details['error'] = error
+    if event in (events.EXTRACTING, events.GENERATING) and _queueBackend == 'database':
+        try:
+            _jobQueue.report_progress(job.jobID, event)
+        except Exception as e:
+            print(f"Failed to record the progress of job {job.jobID}: {e}")
+    events.publish(job.jobID, event, initial, **details)
+
+def _progress_events(since:datetime):
+    """The event source of a database queue, the progress of jobs run by other processes."""
+    rows, since = _jobQueue.progress_since(since)
+    found = []
+    for jobID, jobType, progress, error, data in rows:
+        details = { 'job_type' : _jobTypeNames.get(jobType, 'UNDEFINED'), 'project' : _job_project(data or {}),
+                    'submission_id' : (data or {}).get('submission_id') }
+        if error:
+            details['error'] = error
+        found.append((jobID, progress, details))
+    return found, since
+
+def _finish_job(job:_SubsystemJob, status:SubsystemStatus, error:str = None)->None:
+    """Records the outcome of a job taken off the queue, in the status registry and the queue's store.
+    A part of a batch job is handed back to the batch job instead. A batch job which fails or is cancelled while
+    its OpenAI batch runs cancels the batch."""
+    if job.parent is not None:
+        _collect_part(job, status, error)
+        return
+    if status != SubsystemStatus.OKAY and job.data.get('batch_id') is not None and job.result is None and viva.client is not None:
+        batch_api.cancel_batch(viva.client, job.data['batch_id'])
+    _forget_running(job)
+    if status not in (SubsystemStatus.OKAY, SubsystemStatus.CANCELLED):
+        print(f"Job {job.jobID} failed with status {status}: {error}")
+        _jobErrors.inc(status=status.name)
+    _jobsFinished.inc(job_type=_jobTypeNames.get(job.jobType, 'UNDEFINED'), status=status.name)
+    _mark_job_finished(job, status, error)
+    _record_job_outcome(job, status, error)
+    _checkpoint_job(job, status)
+    if status == SubsystemStatus.OKAY:
+        _report(job, events.PERSISTED)
+    elif status == SubsystemStatus.CANCELLED:
+        _report(job, events.CANCELLED)
+    else:
+        _report(job, events.FAILED, error if error else status.name)
+
+def _checkpoint_job(job:_SubsystemJob, status:SubsystemStatus = None)->None:
+    """Saves the furthest thing a job which failed (or is being put back on the queue) got to, so a retry
+    picks up from there. Drops the job's checkpoint once it succeeded, was cancelled, or is a batch job,
+    whose successful submissions were saved even though others failed. Clears what the job was carrying."""
+    if status in (SubsystemStatus.OKAY, SubsystemStatus.CANCELLED) or job.jobType == _SJobType.VIVA_BATCH:
+        checkpoints.drop(job.checkpoint)
+    elif job.packaged is not None:
+        checkpoints.save(_job_fingerprint(job.jobType, job.data), checkpoints.PACKAGED, job.packaged)
+    elif job.result is not None:
+        checkpoints.save(_job_fingerprint(job.jobType, job.data), checkpoints.RESPONSE, job.result)
+    elif job.fileContent is not None:
+        checkpoints.save(_job_fingerprint(job.jobType, job.data), checkpoints.EXTRACTED, job.fileContent)
+    job.pdfBytes = job.fileContent = job.result = job.packaged = None
+
+def _resume_job(job:_SubsystemJob)->None:
+    """Picks up a job's checkpoint, if an earlier run of it (or of an identical job) saved one."""
+    key = _job_fingerprint(job.jobType, job.data)
+    stage, value = checkpoints.load(key)
+    if stage is None:
+        return
+    print(f"Job {job.jobID} resuming from its {stage} checkpoint")
+    _jobsResumed.inc(stage=stage)
+    job.checkpoint = key
+    if stage == checkpoints.PACKAGED:
+        job.packaged = value
+    elif stage == checkpoints.RESPONSE:
+        job.result = value
+    else:
+        job.fileContent = value
+
+def _forget_running(job:_SubsystemJob)->None:
+    with _runningLock:
+        if _runningJobs.get(job.jobID) is job:
+            del _runningJobs[job.jobID]
+
+def _stop_job(job:_SubsystemJob, reason:str)->None:
+    """Finishes a job whose token said to stop. One past its deadline keeps what it got to for a retry."""
+    if reason == cancellation.CANCELLED:
+        print(f"Job {job.jobID} cancelled")
+        _finish_job(job, SubsystemStatus.CANCELLED)
+    else:
+        limit = _jobDeadlines.get(job.jobType)
+        _finish_job(job, SubsystemStatus.DEADLINE_EXCEEDED,
+                    f"Stopped after the {limit:g} second deadline of {_jobTypeNames.get(job.jobType, 'UNDEFINED')} jobs.")
+
+def _stoppable(handler, deadline:bool = True):
+    """Wraps a stage handler so a job which has been cancelled, or run past its deadline, goes no further.
+    This is checked before the stage and, by extraction and generation, part way through it.
+    Without deadline only cancellation is, i.e saving a result which is already there.
+    The job's deadline starts with the first stage to work on it, time spent waiting for that stage doesn't count."""
+    def run(job:_SubsystemJob)->bool:
+        token = job.token
+        if token is not None:
+            token.start()
+        reason = token.reason if token is not None else None
+        if reason == cancellation.CANCELLED or (reason is not None and deadline):
+            _stop_job(job, reason)
+            return False
+        try:
+            return handler(job)
+        except cancellation.Cancelled as e:
+            _stop_job(job, e.reason)
+            return False
+    return run
+
+def _in_app_context(handler):
+    """Wraps a stage handler so it runs inside the app context, if one was given, for db access."""
+    def run(job:_SubsystemJob)->bool:
+        if _app is None:
+            return handler(job)
+        with _app.app_context():
+            return handler(job)
+    return run
+
+def _stage_fetch(job:_SubsystemJob)->bool:
+    """Pipeline stage 1, downloads the job's PDF. Network bound. A job with a checkpoint skips what it covers.
+    A batch job which has submitted its OpenAI batch checks on it here instead."""
+    if job.parent is None:
+        _resume_job(job)
+    if job.data.get('batch_id') is not None and job.result is None and job.packaged is None:
+        return _check_viva_batch(job)
+    if job.jobType not in _jobTypeHasFiles or job.fileContent is not None or job.result is not None or job.packaged is not None:
+        return True
+    if job.parent is None:
+        _report(job, events.EXTRACTING)
+    status, data = _fetch_file(job.data['file_path'])
+    if status != SubsystemStatus.OKAY:
+        _finish_job(job, status, str(data) if data else None)
+        return False
+    job.pdfBytes = data
+    return True
+
+def _stage_extract(job:_SubsystemJob)->bool:
+    """Pipeline stage 2, extracts the text of the PDF. CPU bound."""
+    if job.pdfBytes is None:
+        return True
+    try:
+        status, data = _extract_file(job.pdfBytes, job.token)
+    finally:
+        job.pdfBytes = None
+    if status != SubsystemStatus.OKAY:
+        _finish_job(job, status, str(data) if data else None)
+        return False
+    if job.parent is not None:                  # A part of a batch job goes no further, see _viva_batch_parts
+        _collect_part(job, status, data)
+        return False
+    job.fileContent = data
+    return True
+
+def _stage_generate(job:_SubsystemJob)->bool:
+    """Pipeline stage 3, sends the job to the AI. Waits on OpenAI, a job which couldn't reach it
+    is put back on the queue rather than failed."""
+    if job.result is not None or job.packaged is not None:
+        return True
+    _report(job, events.GENERATING)
+    status, data = _generate_job(job, job.fileContent)
+    if status == SubsystemStatus.AI_UNAVAILABLE:
+        print(f"Job {job.jobID} put back on the queue: {data}")
+        _jobErrors.inc(status=status.name)
+        _requeue_job(job)
+        return False
+    if status != SubsystemStatus.OKAY:
+        _finish_job(job, status, str(data) if data else None)
+        return False
+    job.fileContent = None
+    job.result = data
+    return True
+
+def _stage_persist(jobs:list)->list:
+    """Pipeline stage 4, saves the output of a group of jobs: every job waiting, up to _persistBatchSize, or
+    finishing generation within _persistWindow of the first. Each job's questions are saved to S3 on their own,
+    then the db rows of all of them are written in one transaction, instead of a commit per job. Rubrics are
+    saved one by one as before, they come a few at a time."""
+    import src.controllers.qgen_queries as qgen_queries
+
+    unfinished = { job.jobID : job for job in jobs }
+    def finish(job:_SubsystemJob, status:SubsystemStatus, error:str = None)->None:
+        del unfinished[job.jobID]
+        _finish_job(job, status, error)
+
+    try:
+        outputs = []                        # (job, job of one submission, its questions) of every viva output to save
+        failures = {}                       # Job ID -> (submission ID, status, message or None) of every submission of it which failed
+        for job in jobs:
+            if job.token is not None and job.token.reason == cancellation.CANCELLED:
+                del unfinished[job.jobID]
+                _stop_job(job, cancellation.CANCELLED)
+            elif job.jobType == _SJobType.VIVA_BATCH:
+                failures[job.jobID] = []
+                for item in job.data['submissions']:
+                    success, result = job.result.get(_batch_id_of(item), (False, "No result"))
+                    if success:
+                        outputs.append((job, _SubsystemJob(job.jobID, _SJobType.VIVA_GEN, dict(item)), result))
+                    else:
+                        failures[job.jobID].append((item['submission_id'], SubsystemStatus.AI_SYS_ERROR, result))
+            elif job.jobType in _jobTypeIsViva:
+                failures[job.jobID] = []
+                outputs.append((job, job, job.result))
+            else:
+                finish(job, _process_completed_job(job, job.result), job.error)
+
+        # One lookup of every submission & project, rather than a few per job
+        submissions = qgen_queries.get_submissions_for_packaging(
+            [output.data['submission_id'] for _, output, _ in outputs if output.packaged is None])
+        packaged = []
+        for job, output, questions in outputs:
+            submissionID = output.data['submission_id']
+            try:
+                status = _package_viva(output, questions, submissions.get(submissionID))
+            except Exception as e:
+                failures[job.jobID].append((submissionID, SubsystemStatus.UNKNOWN_ERR, str(e)))
+                continue
+            if status == SubsystemStatus.OKAY:
+                packaged.append((job, output))
+            else:
+                failures[job.jobID].append((submissionID, status, None))
+
+        for (job, output), saved in zip(packaged, _save_generated_files([output for _, output in packaged])):
+            if not saved:
+                failures[job.jobID].append((output.data['submission_id'], SubsystemStatus.DB_SYS_ERROR, None))
+
+        for jobID, failed in failures.items():
+            job = unfinished[jobID]
+            if job.jobType == _SJobType.VIVA_BATCH and failed:
+                job.error = f"{len(failed)} of {len(job.data['submissions'])} submissions failed. " + \
+                            "; ".join(f"{submissionID}: {message or status.name}" for submissionID, status, message in failed)
+                finish(job, SubsystemStatus.AI_SYS_ERROR, job.error)
+            elif failed:
+                submissionID, status, message = failed[0]
+                finish(job, status, message or job.error)
+            else:
+                finish(job, SubsystemStatus.OKAY, job.error)
+    except Exception as e:
+        print(f"Saving a group of {len(jobs)} jobs raised an exception: {e}")
+        for job in list(unfinished.values()):
+            finish(job, SubsystemStatus.UNKNOWN_ERR, str(e))
+    return [False] * len(jobs)
+
+def _save_generated_files(outputs:list)->list:
+    """Writes the db rows of packaged viva outputs in one transaction. If that fails, each is tried in a
+    transaction of its own so one bad row (i.e of a submission deleted meanwhile) doesn't fail the others.
+    Returns whether each was saved."""
+    import src.controllers.qgen_queries as qgen_queries
+
+    rows = [(output.data['submission_id'], output.packaged['name'], output.packaged['s3_path']) for output in outputs]
+    if not rows:
+        return []
+    msg, code = qgen_queries.upload_generated_files_batch(rows, 'GENERATED')
+    if code == 201:
+        return [True] * len(rows)
+    print(f"Failed to save {len(rows)} generated files together, saving them one at a time: {msg.get('error')}")
+    saved = []
+    for row in rows:
+        try:
+            msg, code = qgen_queries.upload_generated_files(*row, 'GENERATED')
+        except Exception as e:
+            print(f"Failed to save the generated file of submission {row[0]}: {e}")
+            code = 500
+        saved.append(code == 201)
+    return saved
+
+def _on_stage_error(job:_SubsystemJob, error:Exception)->None:
+    _finish_job(job, SubsystemStatus.UNKNOWN_ERR, str(error))
+
+def _observe_stage(stage:str, waited:float, took:float, failed:bool)->None:
+    _stageWaitSeconds.observe(waited, stage=stage)
+    _stageSeconds.observe(took, stage=stage)
+
+def _build_pipeline(generateWorkers:int)->jp.Pipeline:
+    workers = dict(_stageWorkers)
+    workers['generate'] = generateWorkers
+    stages = []
+    for name, handler in (('fetch', _stoppable(_stage_fetch)), ('extract', _stoppable(_stage_extract)),
+                          ('generate', _stoppable(_stage_generate))):
+        # Room for every worker of the stage plus a few waiting, so the stage never starves
+        stages.append(jp.Stage(name, _in_app_context(handler), workers[name], workers[name] + _stageQueueSize))
+    # The persist stage takes jobs in groups, which need room to build up in front of it
+    stages.append(jp.Stage('persist', _in_app_context(_stage_persist), workers['persist'],
+                           workers['persist'] + max(_stageQueueSize, _persistBatchSize), _persistBatchSize, _persistWindow))
+    return jp.Pipeline(stages, _on_stage_error, _observe_stage)
+
+def _requeue_job(job:_SubsystemJob)->None:
+    """Puts a claimed job back on the queue as it was submitted, without the file content added while running it."""
+    if job.token is not None and job.token.reason == cancellation.CANCELLED:
+        _stop_job(job, cancellation.CANCELLED)
+        return
+    _forget_running(job)
+    _checkpoint_job(job)
+    data = { key : value for key, value in job.data.items() if key not in ('assignment_content', 'marking_guide') }
+    with _jobRecordLock:
+        record = _jobRecords.get(job.jobID)
+        if record is not None:
+            record.state = JobState.QUEUED
+            record.startedAt = None
+    try:
+        _jobQueue.release(job.jobID, job.jobType, data)
+    except Exception as e:
+        print(f"Failed to requeue job {job.jobID}: {e}")
+    _report(job, events.QUEUED)
+
+def _defer_job(job:_SubsystemJob, seconds:float)->None:
+    """Puts a batch job back on the queue until its next check on its OpenAI batch, so no worker waits on it.
+    It stays running in the status registry."""
+    if job.token is not None and job.token.reason == cancellation.CANCELLED:
+        _stop_job(job, cancellation.CANCELLED)
+        return
+    _forget_running(job)
+    job.pdfBytes = job.fileContent = job.result = job.packaged = None
+    try:
+        _jobQueue.release(job.jobID, job.jobType, job.data, datetime.now() + timedelta(seconds=seconds))
+    except Exception as e:
+        print(f"Failed to put job {job.jobID} back on the queue: {e}")
+
+def _record_job_outcome(job:_SubsystemJob, status:SubsystemStatus, error:str = None)->None:
+    """Saves the outcome of a job taken off the queue to the queue's store."""
+    state = _state_of(status)
+    if state == JobState.FAILED and not error:
+        error = status.name
+    try:
+        _jobQueue.finish(job.jobID, state.value, status.name, job.resultPath, error)
+    except Exception as e:
+        print(f"Failed to record the outcome of job {job.jobID}: {e}")
+
 def _process()->SubsystemStatus:
-    """At regular periods of time, checks to see if a job can be passed to the AI functions."""
-    global _jobSubsystemRunning, _jobSubsystemState, _jobQueue, _jobWaiting, _jobSubsystemFrequency, \
-           _jobSubsystemStartShutdown, _instanceCount, _barSubmit
+    """Dispatcher loop. Blocks on the job queue and hands each job to the pipeline as soon as it is taken
+    off the queue, waiting while the pipeline's first stage is full so jobs stay on the queue until then."""
+    global _jobSubsystemState
 
     if _jobSubsystemState == SubsystemStatus.SHUTDOWN or _jobSubsystemState == SubsystemStatus.NOT_INITIALISED:
         return _jobSubsystemState
 
-    while _jobSubsystemRunning:
-        if _jobSubsystemStartShutdown:
-            break
-        
-        sleep(_jobSubsystemFrequency)
+    queue = _jobQueue
+    while True:
+        if resilience.wait_time() > 0:          # The AI provider is failing, leave jobs queued until the circuit lets a probe through.
+            if _jobSubsystemStartShutdown:
+                break
+            sleep(min(resilience.wait_time(), _jobSubsystemFrequency if _jobSubsystemFrequency > 0 else 1))
+            continue
+        try:
+            if queue.empty():
+                _jobSubsystemState = SubsystemStatus.NO_JOBS
+            claimed = queue.claim()
+        except Exception as e:                  # i.e the queue's database is unreachable, try again later
+            print(f"Failed to take a job off the queue: {e}")
+            sleep(_jobSubsystemFrequency if _jobSubsystemFrequency > 0 else 1)
+            continue
 
-        # Check if the queue is empty or not; if so, sleep for the _jobSubsystemFrequency
-        if len(_jobQueue) == 0 or _barSubmit:
-            _jobSubsystemState = SubsystemStatus.NO_JOBS
+        if claimed is None:                     # The queue has been closed for shutdown.
+            break
+        jobSubmit = _SubsystemJob(*claimed)
+        if _jobSubsystemStartShutdown:          # Leave the job on the queue so it is saved.
+            queue.release(*claimed)
+            break
+        if _barSubmit:
+            queue.release(*claimed)
+            sleep(_jobSubsystemFrequency)
             continue
 
         _jobSubsystemState = SubsystemStatus.AWAITING_INSTANCE
-        jobSubmit = _jobQueue.pop(0)
-        status,data = _submit_job(jobSubmit)
-
+        jobSubmit.token = cancellation.CancelToken(_jobDeadlines.get(jobSubmit.jobType), start=False)
+        with _runningLock:
+            _runningJobs[jobSubmit.jobID] = jobSubmit
+        _mark_job_running(jobSubmit)
+        if jobSubmit.jobType == _SJobType.VIVA_BATCH and jobSubmit.data.get('batch_id') is None:
+            _report(jobSubmit, events.EXTRACTING)
+            for part in _viva_batch_parts(jobSubmit):
+                _pipeline.submit(part)
+        else:
+            _pipeline.submit(jobSubmit)
         _jobSubsystemState = SubsystemStatus.COMPLETED_JOB
-        if status != SubsystemStatus.OKAY:
-            # log err
-            pass
-
-        _process_completed_job(jobSubmit, data)
-
-        continue
-
-    _jobSubsystemState = SubsystemStatus.SHUTDOWN
-    _jobSubsystemRunning = False
-    
-    return _jobSubsystemState
 
-def initialise(pollRate:float, instanceCount:int = 1, load:bool = False, s3_client=None, s3_bucket_name=None, aiKeys:dict=None) -> SubsystemStatus:
-    """Initializes the subsystem process to run at a given poll rate, and target a given number of instances (defaults to 1)."""
-    global _jobSubsystemRunning, _jobSubsystemState, _jobQueue, _jobWaiting, _jobSubsystemFrequency, \
-           _jobSubsystemStartShutdown, _instanceCount, _threadObj, _globalJobCounter, _url, _barSubmit, \
-           s3, S3_BUCKET_NAME
-
-    if instanceCount <= 0 or pollRate < 0:
+    return SubsystemStatus.SHUTDOWN
+
+def initialise(pollRate:float, instanceCount:int = 1, load:bool = False, s3_client=None, s3_bucket_name=None, aiKeys:dict=None, app=None, aiConcurrency:int = 16, queueBackend:str = 'memory', leaseSeconds:float = 60, runWorkers:bool = True, stageWorkers:dict = None) -> SubsystemStatus:
+    """Initializes the subsystem with a dispatcher thread taking jobs off the job queue, and a pipeline of
+    fetch, extract, generate and persist stages running them. The generate stage has instanceCount worker
+    threads (defaults to 1), stageWorkers can set the worker counts of the others, e.g { 'fetch' : 4 }.
+    pollRate is how often idle workers check a database queue for jobs enqueued by other processes, and the
+    back-off while _barSubmit is set.
+    If a flask app is given, every job is run inside its app context.
+    aiConcurrency caps the number of OpenAI requests the async engine has in flight at once.
+    queueBackend picks where the queue is kept: 'memory', or 'database' (the job_queue table, needs the app)
+    which survives restarts and can be shared by any number of processes. Jobs taken off a database queue
+    are leased for leaseSeconds, and handed to another worker if this process stops renewing the lease.
+    With load set, a memory queue is loaded from the .queue file and a database queue requeues the
+    jobs whose lease has lapsed.
+    Without runWorkers this process only enqueues jobs (e.g the web server), they are run by worker
+    processes started with `python -m src.worker` sharing the database queue."""
+    global _jobSubsystemRunning, _jobSubsystemState, _jobQueue, _jobSubsystemFrequency, \
+           _jobSubsystemStartShutdown, _instanceCount, _workerThreads, _globalJobCounter, _url, _barSubmit, \
+           _app, s3, S3_BUCKET_NAME, _queueBackend, _pipeline, _stageWorkers
+
+    if instanceCount <= 0 or pollRate < 0 or aiConcurrency <= 0 or leaseSeconds <= 0:
+        return SubsystemStatus.INVALID_INPUT
+    if stageWorkers is not None and any(name not in _stageWorkers or count <= 0 for name, count in stageWorkers.items()):
+        return SubsystemStatus.INVALID_INPUT
+    if queueBackend not in ('memory', 'database') or (queueBackend == 'database' and app is None):
         return SubsystemStatus.INVALID_INPUT
+    if not runWorkers and queueBackend != 'database':     # Nobody else could ever see the jobs
+        return SubsystemStatus.INVALID_INPUT
+
+    # Stop any workers left over from a previous initialise so they don't keep consuming a stale queue.
+    if _jobSubsystemRunning:
+        shutdown(False)
     
     _globalJobCounter = 0
     _jobSubsystemFrequency = pollRate
-    _threadObj = Thread(target=_process, args=[])
+    _instanceCount = instanceCount
+    if stageWorkers is not None:
+        _stageWorkers.update(stageWorkers)
+    _app = app
+    s3 = s3_client
+    S3_BUCKET_NAME = s3_bucket_name
     
     _jobSubsystemState = SubsystemStatus.OKAY
     _jobSubsystemRunning = True
     _jobSubsystemStartShutdown = False
 
-    _jobQueue = []
+    _queueBackend = queueBackend
+    if queueBackend == 'database':
+        from src.db_instance import db
+        with app.app_context():
+            _jobQueue = jq.DatabaseJobQueue(db.engine, pollRate, _jobRecordMaxAge, timedelta(seconds=leaseSeconds),
+                                            tenantWeights=_tenantWeights, agingSeconds=_agingSeconds, onCancel=_stop_running_job)
+        # Progress of the jobs other processes run reaches this process's event streams through the table
+        events.watch(_progress_events, pollRate)
+    else:
+        _jobQueue = jq.MemoryJobQueue(_tenantWeights, _agingSeconds)
     
+    if not runWorkers:
+        # Enqueue only, the AI clients are never used in this process
+        if load:
+            _load()
+        _workerThreads = []
+        return SubsystemStatus.OKAY
+
     if aiKeys is None:
-        viva.init_openai(
-            openai_api_key=os.getenv("OPENAI_API_KEY"),
-            openai_org_key=os.getenv("OPENAI_ORG_KEY"),
-            openai_proj_key=os.getenv("OPENAI_PROJ_KEY")
-        )
+        aiKeys = {
+            "OPENAI_API_KEY" : os.getenv("OPENAI_API_KEY"),
+            "OPENAI_ORG_KEY" : os.getenv("OPENAI_ORG_KEY"),
+            "OPENAI_PROJ_KEY" : os.getenv("OPENAI_PROJ_KEY")
+        }
 
-        rubric.init_openai(
-            openai_api_key=os.getenv("OPENAI_API_KEY"),
-            openai_org_key=os.getenv("OPENAI_ORG_KEY"),
-            openai_proj_key=os.getenv("OPENAI_PROJ_KEY")
-        )
-    else:
-        viva.init_openai(
+    viva.init_openai(
+        aiKeys.get("OPENAI_API_KEY"),
+        aiKeys.get("OPENAI_ORG_KEY"),
+        aiKeys.get("OPENAI_PROJ_KEY")
+    )
+    rubric.init_openai(
+        aiKeys.get("OPENAI_API_KEY"),
+        aiKeys.get("OPENAI_ORG_KEY"),
+        aiKeys.get("OPENAI_PROJ_KEY")
+    )
+    if _useAsyncEngine:
+        aiengine.init_async_openai(
             aiKeys.get("OPENAI_API_KEY"),
             aiKeys.get("OPENAI_ORG_KEY"),
-            aiKeys.get("OPENAI_PROJ_KEY")
-        )
-        rubric.init_openai(
-            aiKeys.get("OPENAI_API_KEY"),
-            aiKeys.get("OPENAI_ORG_KEY"),
-            aiKeys.get("OPENAI_PROJ_KEY")
+            aiKeys.get("OPENAI_PROJ_KEY"),
+            max_concurrency=aiConcurrency
         )
     
-    s3 = s3_client
-    S3_BUCKET_NAME = s3_bucket_name
-    
     if load:
         _load()
 
     _url = 'https://comp4050espana.onrender.com/generatequestions'
 
+    _workerThreads = []
     if not _doSingleThread:
-        _threadObj.start()
+        _pipeline = _build_pipeline(_instanceCount)
+        _pipeline.start()
+        dispatcher = Thread(target=_process, args=[], name="job-dispatcher", daemon=True)
+        _workerThreads.append(dispatcher)
+        dispatcher.start()
     
     return SubsystemStatus.OKAY
 
 def shutdown(save:bool = True)->SubsystemStatus:
-    """Appropriately shuts down the job subsystem, saving the contents of the subsystem to disk (can be disabled)."""
-    global _jobSubsystemRunning, _jobSubsystemState, _jobQueue, _jobWaiting, _jobSubsystemFrequency, \
-           _jobSubsystemStartShutdown, _instanceCount, _threadObj, _globalJobCounter
+    """Appropriately shuts down the job subsystem, saving the contents of the subsystem to disk (can be disabled).
+    Jobs that are already running are allowed to finish."""
+    global _jobSubsystemRunning, _jobSubsystemState, _jobQueue, _jobSubsystemFrequency, \
+           _jobSubsystemStartShutdown, _instanceCount, _workerThreads, _globalJobCounter, _pipeline
     
     if _jobSubsystemState == SubsystemStatus.SHUTDOWN or _jobSubsystemState == SubsystemStatus.NOT_INITIALISED:
         return _jobSubsystemState
-    # trigger a shutdown of the subprocess
+    # trigger a shutdown of the dispatcher, then let the jobs it already handed to the pipeline finish
     _jobSubsystemStartShutdown = True
-    _jobSubsystemFrequency = 0.01
+    _jobQueue.close(len(_workerThreads))
     
-    if not _doSingleThread:
-        _threadObj.join()
+    for worker in _workerThreads:
+        worker.join()
+    if _pipeline is not None:
+        _pipeline.close()
+        _pipeline = None
+    events.stop_watching()
         
     if save:
         _save()
     _jobQueue = None
-    _threadObj = None
+    _workerThreads = []
+    _jobSubsystemRunning = False
     _jobSubsystemState = SubsystemStatus.SHUTDOWN
     return _jobSubsystemState
 
@@ -399,17 +1216,121 @@ def submit_new_job(subID:int = 0,
             return status, data, jID
         return _process_completed_job(job, data), data, jID
     else:
-        _jobQueue.append(job)
+        _jobQueue.put(job.jobType, job.data, job.jobID)
 
     return SubsystemStatus.OKAY, jID
 
-def submit_new_viva_gen(subID, submissionFilePath, projName, unitName, unitLevel, challengeLevel, factRecallQns, analysisQns, openQns, applicQns, conceptualQns)->(SubsystemStatus, int):
-    """Creates a new viva gen job, returns the job id."""
-    global _jobQueue, _globalJobCounter, _jobSubsystemState, _doSingleThread
-    if _jobSubsystemState == SubsystemStatus.SHUTDOWN or _jobSubsystemState == SubsystemStatus.NOT_INITIALISED:
-        return _jobSubsystemState
-    jID = _globalJobCounter
-    _globalJobCounter += 1
+def _next_job_id()->int:
+    """Reserves the next unique job ID."""
+    global _globalJobCounter
+    with _jobCounterLock:
+        jID = _globalJobCounter
+        _globalJobCounter += 1
+    return jID
+
+def _job_fingerprint(jobType:_SJobType, data:dict)->str:
+    """Identifies what a job would produce: its type, file path and question template (or rubric inputs).
+    Two jobs with the same fingerprint would download, extract and generate the same thing."""
+    inputs = { key : value for key, value in data.items() if key not in ('assignment_content', 'marking_guide') }
+    return hashlib.sha256(json.dumps([jobType, inputs], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _job_tenant(data:dict)->str:
+    """Who a job is for, which the scheduler takes turns between: its unit, or failing that its staff member."""
+    if data.get('unit_code'):
+        return f"unit:{data['unit_code']}"
+    if data.get('staff_email'):
+        return f"staff:{data['staff_email']}"
+    return sched.DEFAULT_TENANT
+
+def _seconds_to_run(jobs:int)->int:
+    """Estimates how long the workers take to get through jobs, from how many finished recently."""
+    if jobs <= 0:
+        return 0
+    finished = 0
+    try:
+        finished = _jobQueue.finished_since(datetime.now() - _throughputWindow)
+    except Exception as e:
+        print(f"Failed to count the recently finished jobs: {e}")
+    if finished > 0:
+        seconds = jobs * _throughputWindow.total_seconds() / finished
+    else:
+        seconds = jobs * _defaultJobSeconds / max(1, _instanceCount)
+    return math.ceil(seconds)
+
+def check_admission(jobCount:int = 1, unitCode:str = None, staffEmail:str = None, bulk:bool = False)->(SubsystemStatus, int):
+    """Checks whether jobCount more jobs for the unit (or staff member) fit on the queue, before submitting them.
+    Returns (OKAY, estimated seconds until they have all run), or (QUEUE_FULL, seconds to wait before trying
+    again) while the queue or the tenant's share of it is full. INVALID_INPUT if there are more jobs than
+    the tenant may ever have queued at once."""
+    if not _is_accepting_jobs() or _jobQueue is None:
+        return _jobSubsystemState, 0
+    if jobCount <= 0 or (_maxQueuedPerTenant > 0 and jobCount > _maxQueuedPerTenant) \
+                     or (_maxQueuedJobs > 0 and jobCount > _maxQueuedJobs):
+        return SubsystemStatus.INVALID_INPUT, 0
+
+    tenant = _job_tenant({ 'unit_code' : unitCode, 'staff_email' : staffEmail })
+    try:
+        queued = _jobQueue.qsize()
+        excess = queued + jobCount - _maxQueuedJobs if _maxQueuedJobs > 0 else 0
+        if _maxQueuedPerTenant > 0 and tenant != sched.DEFAULT_TENANT:
+            excess = max(excess, _jobQueue.qsize(tenant) + jobCount - _maxQueuedPerTenant)
+        if excess > 0:
+            return SubsystemStatus.QUEUE_FULL, min(_maxRetryAfter, max(1, _seconds_to_run(excess)))
+
+        # Interactive jobs only wait behind the other interactive ones, bulk jobs behind everything
+        ahead = queued if bulk else _jobQueue.qsize(maxPriority=sched.INTERACTIVE)
+    except Exception as e:
+        print(f"Failed to check the queue's capacity: {e}")
+        return SubsystemStatus.DB_SYS_ERROR, 0
+    return SubsystemStatus.OKAY, _seconds_to_run(ahead + jobCount)
+
+def _enqueue_job(jobType:_SJobType, data:dict, priority:int = sched.INTERACTIVE)->(SubsystemStatus, object, int):
+    """Creates a job and hands it to the worker pool, returning straight away with the job ID.
+    If an identical job is already queued or running, its ID is returned instead and every caller
+    shares its result.
+    priority is sched.INTERACTIVE for jobs somebody is waiting on, sched.BULK for whole-project runs.
+    In single thread mode the job is run inline and its result is returned as well."""
+    if not _doSingleThread:
+        fingerprint = _job_fingerprint(jobType, data) if _coalesceJobs else None
+        try:
+            with _coalesceLock:
+                if fingerprint is not None:
+                    jID = _jobQueue.find_active(fingerprint)
+                    if jID is not None:
+                        print(f"Attached a new {_jobTypeNames.get(jobType, 'UNDEFINED')} job to identical job {jID}")
+                        return SubsystemStatus.OKAY, 'Attached to an identical job already queued or running.', jID
+                # A database queue numbers jobs itself, so IDs stay unique across restarts and processes
+                jID = _jobQueue.put(jobType, data, None if _queueBackend == 'database' else _next_job_id(), fingerprint,
+                                    priority, _job_tenant(data))
+                job = _SubsystemJob(jID, jobType, data)
+                _register_job(job)
+            _report(job, events.QUEUED, initial=True)
+        except Exception as e:
+            print(f"Failed to enqueue job: {e}")
+            return SubsystemStatus.DB_SYS_ERROR, str(e), None
+        return SubsystemStatus.OKAY, '', jID
+
+    jID = _next_job_id()
+    job = _SubsystemJob(jID, jobType, data)
+    _register_job(job)
+
+    _mark_job_running(job)
+    status,data = _submit_job(job)
+    if status != SubsystemStatus.OKAY:
+        _mark_job_finished(job, status, str(data))
+        return status, data, jID
+    status = _process_completed_job(job, data)
+    _mark_job_finished(job, status, job.error)
+    return status, data, jID
+
+def _is_accepting_jobs()->bool:
+    return _jobSubsystemState != SubsystemStatus.SHUTDOWN and _jobSubsystemState != SubsystemStatus.NOT_INITIALISED
+
+def submit_new_viva_gen(subID, submissionFilePath, projName, unitName, unitLevel, challengeLevel, factRecallQns, analysisQns, openQns, applicQns, conceptualQns, unitCode = None, bulk:bool = False)->(SubsystemStatus, object, int):
+    """Creates a new viva gen job, returns the job id. Set bulk for jobs submitted for a whole project at once,
+    they wait behind single submissions. unitCode is who the job is scheduled for."""
+    if not _is_accepting_jobs():
+        return _jobSubsystemState, '', None
 
     data = {
             'assignment_title': projName,
@@ -423,28 +1344,41 @@ def submit_new_viva_gen(subID, submissionFilePath, projName, unitName, unitLevel
             'no_of_questions_application_problem_solving': applicQns,
             'no_of_questions_conceptual_understanding' : conceptualQns,
             'question_challenging_level': challengeLevel,
-            'assignment_content': None
+            'assignment_content': None,
+            'unit_code': unitCode
         }
 
-    job = _SubsystemJob(jID, _SJobType.VIVA_GEN, data)
-
-    if _doSingleThread:
-        status,data = _submit_job(job)
-        if status != SubsystemStatus.OKAY:
-            return status, data, jID
-        return _process_completed_job(job, data), data, jID
-    else:
-        _jobQueue.append(job)
-        return SubsystemStatus.OKAY, jID
-    
+    return _enqueue_job(_SJobType.VIVA_GEN, data, sched.BULK if bulk else sched.INTERACTIVE)
     
-def submit_new_viva_regen(subID, submissionFilePath, projName, unitName, regenReasons, originalJsonFilePath)->(SubsystemStatus, int):
+def submit_new_viva_batch(submissions:[dict], projName, unitName, unitLevel, challengeLevel, factRecallQns, analysisQns, openQns, applicQns, conceptualQns, unitCode = None)->(SubsystemStatus, object, int):
+    """Creates a single job generating viva questions for every submission through the OpenAI Batch API,
+    submissions being a list of { 'submission_id', 'file_path' } dicts. Returns the job id."""
+    if not _is_accepting_jobs():
+        return _jobSubsystemState, '', None
+    if len(submissions) == 0:
+        return SubsystemStatus.INVALID_INPUT, 'No submissions', None
+
+    template = {
+            'assignment_title': projName,
+            'unit_name': unitName,
+            'student_year_level': unitLevel,
+            'no_of_questions_factual_recall': factRecallQns,
+            'no_of_questions_analysis_evaluation': analysisQns,
+            'no_of_questions_open_ended': openQns,
+            'no_of_questions_application_problem_solving': applicQns,
+            'no_of_questions_conceptual_understanding' : conceptualQns,
+            'question_challenging_level': challengeLevel
+        }
+    data = { 'submissions' : [ { **template, 'submission_id' : sub['submission_id'], 'file_path' : sub['file_path'] }
+                               for sub in submissions ],
+             'unit_code' : unitCode }
+
+    return _enqueue_job(_SJobType.VIVA_BATCH, data, sched.BULK)
+
+def submit_new_viva_regen(subID, submissionFilePath, projName, unitName, regenReasons, originalJsonFilePath, unitCode = None)->(SubsystemStatus, object, int):
     """Creates a new viva regen job, returns the job id"""
-    global _jobQueue, _globalJobCounter, _jobSubsystemState, _doSingleThread
-    if _jobSubsystemState == SubsystemStatus.SHUTDOWN or _jobSubsystemState == SubsystemStatus.NOT_INITIALISED:
-        return _jobSubsystemState
-    jID = _globalJobCounter
-    _globalJobCounter += 1
+    if not _is_accepting_jobs():
+        return _jobSubsystemState, '', None
 
     data = {
         'assignment_title': projName,
@@ -453,28 +1387,16 @@ def submit_new_viva_regen(subID, submissionFilePath, projName, unitName, regenRe
 		'unit_name': unitName,	
 		'question_reason': regenReasons,
 		'assignment_content': None,
-        'old_file_path' : originalJsonFilePath
+        'old_file_path' : originalJsonFilePath,
+        'unit_code' : unitCode
         }
     
-    job = _SubsystemJob(jID, _SJobType.VIVA_REGEN, data)
-
-    if _doSingleThread:
-        status,data = _submit_job(job)
-        data = json.loads(data)
-        if status != SubsystemStatus.OKAY:
-            return status, data, jID
-        return _process_completed_job(job, data), data, jID
-    else:
-        _jobQueue.append(job)
-        return SubsystemStatus.OKAY, jID
+    return _enqueue_job(_SJobType.VIVA_REGEN, data)
 
 def submit_new_rubric_gen(description:str, staffemail:str, criteria:[dict], ulos:[str])->(SubsystemStatus, int):
     """Creates and submits a new rubric gen job, returns the job id"""
-    global _jobQueue, _globalJobCounter, _jobSubsystemState, _doSingleThread
-    if _jobSubsystemState == SubsystemStatus.SHUTDOWN or _jobSubsystemState == SubsystemStatus.NOT_INITIALISED:
-        return _jobSubsystemState
-    jID = _globalJobCounter
-    _globalJobCounter += 1
+    if not _is_accepting_jobs():
+        return _jobSubsystemState, None
 
     data = {
             'assessment_description' : description,
@@ -483,25 +1405,13 @@ def submit_new_rubric_gen(description:str, staffemail:str, criteria:[dict], ulos
             'ulos' : ulos
         }
 
-    job = _SubsystemJob(jID, _SJobType.RUBRIC_GEN, data)
-
-    if _doSingleThread:
-        status,data = _submit_job(job)
-        if status != SubsystemStatus.OKAY:
-            return status, jID
-        return _process_completed_job(job, data), jID
-    else:
-        _jobQueue.append(job)
-
-    return SubsystemStatus.OKAY, jID
+    status, _, jID = _enqueue_job(_SJobType.RUBRIC_GEN, data)
+    return status, jID
 
 def submit_new_rubric_convert(filepath:str, staffemail:str, ulos:[str], guideid:int)->(SubsystemStatus, int):
     """Creates and submits a new rubric convert job, returns the job id"""
-    global _jobQueue, _globalJobCounter, _jobSubsystemState, _doSingleThread
-    if _jobSubsystemState == SubsystemStatus.SHUTDOWN or _jobSubsystemState == SubsystemStatus.NOT_INITIALISED:
-        return _jobSubsystemState
-    jID = _globalJobCounter
-    _globalJobCounter += 1
+    if not _is_accepting_jobs():
+        return _jobSubsystemState, None
 
     data = {
             'staff_email' : staffemail,
@@ -511,17 +1421,8 @@ def submit_new_rubric_convert(filepath:str, staffemail:str, ulos:[str], guideid:
             'marking_guide_id' : guideid
         }
 
-    job = _SubsystemJob(jID, _SJobType.RUBRIC_CONVERT, data)
-
-    if _doSingleThread:
-        status,data = _submit_job(job)
-        if status != SubsystemStatus.OKAY:
-            return status, jID
-        return _process_completed_job(job, json.loads(data)), jID
-    else:
-        _jobQueue.append(job)
-
-    return SubsystemStatus.OKAY, jID
+    status, _, jID = _enqueue_job(_SJobType.RUBRIC_CONVERT, data)
+    return status, jID
 
 # Used by pytests, for inserting dummy rubric data
 def test_submit_new_rubric_job(staff_email:str,
@@ -549,7 +1450,7 @@ def test_submit_new_rubric_job(staff_email:str,
             return status, jID
         return fm._process_completed_rubric(job, json.loads(data)), jID
     else:
-        _jobQueue.append(job)
+        _jobQueue.put(job.jobType, job.data, job.jobID)
 
     return SubsystemStatus.OKAY, jID
 
@@ -564,18 +1465,169 @@ def debug_destroy_waiting()->SubsystemStatus:
 
 def debug_wipe_queue()->SubsystemStatus:
     """Resets the queue. For debug purposes."""
-    global _jobQueue
-
-    _jobQueue = []
+    _drain_queue()
 
     return SubsystemStatus.OKAY
 
+def _drain_queue()->List[_SubsystemJob]:
+    """Takes every waiting job off the queue without running it."""
+    if _jobQueue is None:
+        return []
+    return [_SubsystemJob(*job) for job in _jobQueue.drain()]
+
+def get_job_status(jobID:int)->(SubsystemStatus, dict):
+    """Looks up a job in the status registry. Returns INVALID_INPUT if the job is unknown or has been evicted.
+    With a database queue the table is the authority, the job may be running in another process."""
+    if _queueBackend != 'database':
+        with _jobRecordLock:
+            record = _jobRecords.get(jobID)
+            if record is not None:
+                return SubsystemStatus.OKAY, record.to_dict()
+            return SubsystemStatus.INVALID_INPUT, None
+
+    try:
+        entry = _jobQueue.get(jobID) if _jobQueue is not None else None
+    except Exception as e:
+        print(f"Failed to look up job {jobID}: {e}")
+        return SubsystemStatus.DB_SYS_ERROR, None
+    if entry is not None:
+        return SubsystemStatus.OKAY, _record_from_entry(entry).to_dict()
+
+    # Jobs run inline in single thread mode never reach the queue
+    with _jobRecordLock:
+        record = _jobRecords.get(jobID)
+        if record is None:
+            return SubsystemStatus.INVALID_INPUT, None
+        return SubsystemStatus.OKAY, record.to_dict()
+
+def _stop_running_job(jobID:int)->bool:
+    """Tells a job this process is running to stop, returning False if it isn't running one by that ID."""
+    with _runningLock:
+        job = _runningJobs.get(jobID)
+    if job is None or job.token is None:
+        return False
+    job.token.cancel()
+    return True
+
+def _cancel_where(matches)->int:
+    """Cancels every queued or running job for which matches(job ID, job type, data) is true, returning how many.
+    Queued jobs are cancelled straight away, running ones stop at their next check."""
+    if _jobQueue is None:
+        return 0
+    cancelled, running = _jobQueue.cancel(matches)
+    for jobID, jobType, data in cancelled:
+        job = _SubsystemJob(jobID, jobType, data)
+        if (data or {}).get('batch_id') is not None and viva.client is not None:
+            batch_api.cancel_batch(viva.client, data['batch_id'])
+        _jobsFinished.inc(job_type=_jobTypeNames.get(jobType, 'UNDEFINED'), status=SubsystemStatus.CANCELLED.name)
+        _mark_job_finished(job, SubsystemStatus.CANCELLED)
+        _report(job, events.CANCELLED)
+
+    # Running jobs of this process are stopped here, the queue has flagged any other process's for its heartbeat
+    with _runningLock:
+        local = [job for job in _runningJobs.values() if matches(job.jobID, job.jobType, job.data)]
+    for job in local:
+        job.token.cancel()
+    return len(cancelled) + len(set(running) | { job.jobID for job in local })
+
+def cancel_job(jobID:int)->(SubsystemStatus, dict):
+    """Cancels a job. A queued job is taken off the queue, a running one stops at its next check (between pages of
+    its PDF, or part way through its OpenAI call) and frees its worker. Returns the job's status afterwards, or
+    INVALID_INPUT if the job is unknown and WRONG_JOB if it had already finished."""
+    status, job = get_job_status(jobID)
+    if status != SubsystemStatus.OKAY:
+        return status, job
+    if job['status'] not in (JobState.QUEUED.value, JobState.RUNNING.value):
+        return SubsystemStatus.WRONG_JOB, job
+    try:
+        _cancel_where(lambda id, jobType, data: id == jobID)
+    except Exception as e:
+        print(f"Failed to cancel job {jobID}: {e}")
+        return SubsystemStatus.DB_SYS_ERROR, None
+    return get_job_status(jobID)
+
+def _job_unit(data:dict)->str:
+    if data.get('unit_code') is None and data.get('submissions'):
+        return data['submissions'][0].get('unit_code')
+    return data.get('unit_code')
+
+def cancel_jobs_for(unitCode:str, projectTitle:str = None, submissionID:int = None)->int:
+    """Cancels the queued and running jobs of a unit, of one of its projects, or of a single submission,
+    i.e before they are deleted. Returns how many were cancelled, a batch job is only cancelled with its project."""
+    if unitCode is None:
+        return 0
+    project = events.project_key(unitCode, projectTitle)
+    def matches(jobID, jobType, data):
+        data = data or {}
+        if submissionID is not None:
+            return str(data.get('submission_id')) == str(submissionID)
+        if project is not None:
+            return _job_project(data) == project
+        return _job_unit(data) == unitCode
+    try:
+        count = _cancel_where(matches)
+    except Exception as e:
+        print(f"Failed to cancel the jobs of {project or unitCode}: {e}")
+        return 0
+    if count:
+        print(f"Cancelled {count} jobs of {project or unitCode}" + (f" submission {submissionID}" if submissionID is not None else ""))
+    return count
+
+def _record_from_entry(entry:dict)->_JobRecord:
+    """Builds a status registry entry out of a database queue row."""
+    record = _JobRecord(entry['job_id'], entry['job_type'])
+    record.state = JobState(entry['state'])
+    record.status = SubsystemStatus[entry['subsystem_status']] if entry['subsystem_status'] else SubsystemStatus.OKAY
+    record.submittedAt = entry['submitted_at']
+    record.startedAt = entry['started_at']
+    record.finishedAt = entry['finished_at']
+    record.resultPath = entry['result_path']
+    record.error = entry['error']
+    return record
+
+def get_pipeline_stats()->dict:
+    """Returns the queue depth, wait and processing times of every pipeline stage, plus the number of jobs
+    still waiting on the job queue. Stages are empty if this process doesn't run jobs."""
+    queued = None
+    try:
+        queued = _jobQueue.qsize() if _jobQueue is not None else None
+    except Exception as e:
+        print(f"Failed to count the queued jobs: {e}")
+    pipeline = _pipeline
+    return { 'queued' : queued, 'stages' : pipeline.get_stats() if pipeline is not None else {} }
+
+def _queue_depths()->dict:
+    """Jobs waiting on the job queue per priority, read when /metrics is scraped."""
+    if _jobQueue is None:
+        return {}
+    queued = _jobQueue.qsize()
+    interactive = _jobQueue.qsize(maxPriority=sched.INTERACTIVE)
+    return { ('interactive',) : interactive, ('bulk',) : queued - interactive }
+
+def _stage_values(key:str):
+    """Reads one of the pipeline's per stage stats when /metrics is scraped."""
+    def read()->dict:
+        pipeline = _pipeline
+        if pipeline is None:
+            return {}
+        return { (name,) : stats[key] for name, stats in pipeline.get_stats().items() }
+    return read
+
+metrics.gauge('job_queue_depth', 'Jobs waiting on the job queue.', ('priority',), _queue_depths)
+metrics.gauge('job_stage_depth', 'Jobs waiting in front of a pipeline stage.', ('stage',), _stage_values('depth'))
+metrics.gauge('job_stage_in_flight', 'Jobs a pipeline stage is working on.', ('stage',), _stage_values('in_flight'))
+
 def check_subsystem_status()->SubsystemStatus:
     """Gets the current status of the subsystem for diagnostic purposes."""
     global _jobSubsystemState
     
     return _jobSubsystemState
 
+def is_running()->bool:
+    """Whether initialise has started the subsystem and it hasn't been shut down since. Unlike the status, which
+    follows what the dispatcher last did (i.e NO_JOBS on an empty queue), this doesn't change while it runs."""
+    return _jobSubsystemRunning
+
 def set_subsystem_frequency(wait:float)->SubsystemStatus:
     global _jobSubsystemFrequency
     if wait < 0:
@@ -583,38 +1635,110 @@ def set_subsystem_frequency(wait:float)->SubsystemStatus:
     _jobSubsystemFrequency = wait
     return SubsystemStatus.OKAY
 
+def set_scheduling(agingSeconds:float = None, tenantWeights:dict = None)->SubsystemStatus:
+    """Sets how long a queued job waits before moving up a priority, and the tenants with more (or less) than
+    an equal share of the workers, e.g { 'unit:COMP4050' : 2 }. Takes effect from the next initialise()."""
+    global _agingSeconds, _tenantWeights
+    if agingSeconds is not None and agingSeconds < 0:
+        return SubsystemStatus.INVALID_INPUT
+    if tenantWeights is not None and any(weight <= 0 for weight in tenantWeights.values()):
+        return SubsystemStatus.INVALID_INPUT
+    if agingSeconds is not None:
+        _agingSeconds = agingSeconds
+    if tenantWeights is not None:
+        _tenantWeights = dict(tenantWeights)
+    return SubsystemStatus.OKAY
+
+def set_admission_limits(maxQueuedJobs:int = None, maxQueuedPerTenant:int = None)->SubsystemStatus:
+    """Sets how many jobs may wait on the queue, in total and per unit or staff member, before check_admission
+    turns new ones away. 0 removes a limit."""
+    global _maxQueuedJobs, _maxQueuedPerTenant
+    if (maxQueuedJobs is not None and maxQueuedJobs < 0) or (maxQueuedPerTenant is not None and maxQueuedPerTenant < 0):
+        return SubsystemStatus.INVALID_INPUT
+    if maxQueuedJobs is not None:
+        _maxQueuedJobs = maxQueuedJobs
+    if maxQueuedPerTenant is not None:
+        _maxQueuedPerTenant = maxQueuedPerTenant
+    return SubsystemStatus.OKAY
+
+def set_stage_queue_size(size:int)->SubsystemStatus:
+    """Sets how many jobs may wait in front of each pipeline stage beyond one per worker, from the next initialise()."""
+    global _stageQueueSize
+    if size <= 0:
+        return SubsystemStatus.INVALID_INPUT
+    _stageQueueSize = size
+    return SubsystemStatus.OKAY
+
+def set_persist_batching(batchSize:int, window:float)->SubsystemStatus:
+    """Sets the most jobs saved in one db transaction, and how many seconds the persist stage waits for more
+    to arrive after the first (0 saves only those already waiting), from the next initialise()."""
+    global _persistBatchSize, _persistWindow
+    if batchSize <= 0 or window < 0:
+        return SubsystemStatus.INVALID_INPUT
+    _persistBatchSize = batchSize
+    _persistWindow = window
+    return SubsystemStatus.OKAY
+
+def set_job_deadlines(deadlines:dict)->SubsystemStatus:
+    """Sets how many seconds a job may run, from when the pipeline starts on it, before it is stopped, by job type name,
+    e.g { 'VIVA_GEN' : 300 }. 0 or None removes a job type's deadline. Applies to jobs claimed from then on."""
+    types = { name : jobType for jobType, name in _jobTypeNames.items() if jobType != _SJobType.UNDEFINED }
+    if any(name not in types or (seconds is not None and seconds < 0) for name, seconds in deadlines.items()):
+        return SubsystemStatus.INVALID_INPUT
+    for name, seconds in deadlines.items():
+        _jobDeadlines[types[name]] = seconds if seconds else None
+    return SubsystemStatus.OKAY
+
+def set_batch_poll_rate(wait:float)->SubsystemStatus:
+    """Sets how often batch jobs check on their OpenAI batch."""
+    global _batchPollSeconds
+    if wait <= 0:
+        return SubsystemStatus.INVALID_INPUT
+    _batchPollSeconds = wait
+    return SubsystemStatus.OKAY
+
 def _save()->SubsystemStatus:
-    """Saves the queue to the .queue file."""
-    global _jobQueue
+    """Saves the queue to the _queueFile (.queue). A database queue is always saved, so there is nothing to do."""
+    if _queueBackend == 'database':
+        return SubsystemStatus.OKAY
 
-    individual_dumps = map(lambda x:x.serialize(), _jobQueue)
+    individual_dumps = map(lambda x:x.serialize(), _drain_queue())
     
     data = json.dumps(list(individual_dumps))
     
-    with open('.queue', 'w') as file:
+    with open(_queueFile, 'w') as file:
         file.write(data)
         
     return SubsystemStatus.OKAY
 
 def _load()->SubsystemStatus:
-    """Loads the queue from a .queue file if present."""
+    """Loads the queue from the _queueFile (.queue) if present.
+    A database queue keeps its waiting jobs anyway, only the jobs whose lease has lapsed are requeued."""
     global _jobQueue, _globalJobCounter
 
-    if not os.path.isfile('.queue'):
-        return SubsystemStatus.NO_SAVED_QUEUE
+    if _queueBackend == 'database':
+        recovered = _jobQueue.recover()
+        if recovered > 0:
+            print(f"Requeued {recovered} jobs whose worker stopped renewing their lease.")
+        return SubsystemStatus.OKAY
+
+    if not os.path.isfile(_queueFile):
+        return SubsystemStatus.NO_SAVED_FILE
     
     data = ''
-    with open('.queue', 'r') as file:
+    with open(_queueFile, 'r') as file:
         data = file.read()
 
     temp_dumps:[str] = json.loads(data)
 
     mapped = map(create_job_from_json, temp_dumps)
     
-    _jobQueue = list(mapped)
-    
-    for i in _jobQueue:
-        if i.jobID > _globalJobCounter:
+    for i in mapped:
+        if i is None:
+            continue
+        _jobQueue.put(i.jobType, i.data, i.jobID)
+        _register_job(i)
+        if i.jobID >= _globalJobCounter:
             _globalJobCounter = i.jobID+1
 
     return SubsystemStatus.OKAY
@@ -623,7 +1747,7 @@ def create_job_from_json(json_data:str)->_SubsystemJob:
     """Creates an instance of a job from a given json data string. Single function to make it easier. Returns NONE if it failed."""
     if json_data == '':
         return None
-    job = _SubsystemJob(0, 0, '', 0, '', '', '', '')
+    job = _SubsystemJob(0, _SJobType.UNDEFINED, None)
     job.deserialize(json_data)
     return job
 
@@ -9,9 +9,24 @@ from src.db_instance import db  # Import the db object from the new db.py file
 import app_config
 import os
 import boto3
+from datetime import timedelta
 
 import src.file_management as fm
 import src.job_subsystem as js
+import src.extraction_cache as extraction_cache
+import src.job_checkpoints as job_checkpoints
+import src.ai.pdf_to_text as ptt
+import src.ai.rate_limiter as limiter
+import src.ai.resilience as resilience
+
+def add_retry_after(response):
+    # Generation requests turned away while the job queue is full say when to try again in the body,
+    # copy it into the Retry-After header
+    if response.status_code == 429 and response.is_json and 'Retry-After' not in response.headers:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict) and body.get('retry_after') is not None:
+            response.headers['Retry-After'] = str(int(body['retry_after']))
+    return response
 
 def create_app(test_config = None):
     print("Creating app...")
@@ -21,14 +36,39 @@ def create_app(test_config = None):
     # Initialize the S3 client using the IAM role (no credentials needed)
     s3 = boto3.client('s3')
     fm.initialise(s3, s3_bucket_name)
-    js.initialise(1, 1, False, s3, s3_bucket_name)    
     app.config.from_object(app_config)
     CORS(app)
     if test_config is not None:
         app.config.from_mapping(test_config)
 
     register_blueprints(app)
+    app.after_request(add_retry_after)
     db.init_app(app)
+    fm.configure_read_cache(app.config['FILE_CACHE_MAX_BYTES'], app.config['FILE_CACHE_TTL_SECONDS'])
+    extraction_cache.initialise(app.config['EXTRACTION_CACHE_DIR'], app.config['EXTRACTION_CACHE_MAX_ENTRIES'],
+                                app.config['EXTRACTION_CACHE_MAX_BYTES'])
+    job_checkpoints.initialise(app.config['JOB_CHECKPOINT_DIR'], app.config['JOB_QUEUE_BACKEND'] == 'database',
+                               timedelta(hours=app.config['JOB_CHECKPOINT_MAX_AGE_HOURS']))
+    ptt.configure_parallel(app.config['PDF_PARALLEL_PAGE_THRESHOLD'], app.config['PDF_PARALLEL_WORKERS'])
+    limiter.configure(None, app.config['OPENAI_RPM_LIMIT'], app.config['OPENAI_TPM_LIMIT'])
+    for apiKey, limits in app.config['OPENAI_KEY_RATE_LIMITS'].items():
+        limiter.configure(apiKey, limits.get('rpm'), limits.get('tpm'))
+    resilience.configure(maxAttempts=app.config['AI_MAX_ATTEMPTS'], attemptTimeout=app.config['AI_REQUEST_TIMEOUT_SECONDS'],
+                         deadline=app.config['AI_CALL_DEADLINE_SECONDS'], failureThreshold=app.config['AI_CIRCUIT_FAILURE_THRESHOLD'],
+                         resetTimeout=app.config['AI_CIRCUIT_RESET_SECONDS'])
+    js.set_stage_queue_size(app.config['JOB_STAGE_QUEUE_SIZE'])
+    js.set_persist_batching(app.config['JOB_PERSIST_BATCH_SIZE'], app.config['JOB_PERSIST_WINDOW_MS'] / 1000)
+    js.set_scheduling(app.config['JOB_AGING_SECONDS'], app.config['JOB_TENANT_WEIGHTS'])
+    js.set_admission_limits(app.config['JOB_MAX_QUEUED'], app.config['JOB_MAX_QUEUED_PER_TENANT'])
+    js.set_job_deadlines(app.config['JOB_DEADLINES'])
+    # Jobs run on the pipeline's worker threads and need the app context for db access,
+    # or in separate worker processes (src/worker.py) if JOB_RUN_WORKERS is off
+    js.initialise(app.config['JOB_POLL_SECONDS'], app.config['JOB_WORKER_COUNT'], False, s3, s3_bucket_name, app=app,
+                  aiConcurrency=app.config['OPENAI_MAX_CONCURRENCY'], queueBackend=app.config['JOB_QUEUE_BACKEND'],
+                  leaseSeconds=app.config['JOB_LEASE_SECONDS'], runWorkers=app.config['JOB_RUN_WORKERS'],
+                  stageWorkers={ 'fetch' : app.config['JOB_FETCH_WORKERS'], 'extract' : app.config['JOB_EXTRACT_WORKERS'],
+                                 'persist' : app.config['JOB_PERSIST_WORKERS'] })
+    js.set_batch_poll_rate(app.config['JOB_BATCH_POLL_SECONDS'])
     # migrate = Migrate(app, db)
     print("App created")
     return app
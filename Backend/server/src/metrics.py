@@ -0,0 +1,171 @@
+# Metrics
+#
+# Counters, gauges and histograms exported at /metrics in the Prometheus text format, so a
+# slow run can be traced to the stage it spends its time in (S3 download, PDF extraction,
+# OpenAI or saving the output). Recording a value is a dict lookup and a few additions under
+# the metric's own lock, the text is only built when /metrics is scraped.
+#
+# Values which are cheaper to read when scraped than to keep up to date (i.e queue depth)
+# are registered as gauges with a function instead.
+
+import math
+from bisect import bisect_left
+from threading import Lock
+
+# Buckets (upper bounds) for durations in seconds, from a cache hit to a slow OpenAI call
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+_registry: dict = {}                        # Name -> metric, in the order they were created.
+_registryLock = Lock()
+
+def _label_key(labelNames:tuple, labels:dict)->tuple:
+    return tuple(str(labels.get(name, '')) for name in labelNames)
+
+def _format_labels(labelNames:tuple, key:tuple, extra:str = None)->str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelNames, key)]
+    if extra is not None:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+def _escape(value:str)->str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value:float)->str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class _Metric:
+    type = None
+
+    def __init__(self, name:str, description:str, labelNames:tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self._lock = Lock()
+
+    def header(self)->list:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+
+class Counter(_Metric):
+    """A value which only goes up, per combination of labels."""
+    type = 'counter'
+
+    def __init__(self, name:str, description:str, labelNames:tuple = ()):
+        super().__init__(name, description, labelNames)
+        self._values = {}
+
+    def inc(self, amount:float = 1, **labels)->None:
+        key = _label_key(self.labelNames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels)->float:
+        with self._lock:
+            return self._values.get(_label_key(self.labelNames, labels), 0)
+
+    def render(self)->list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelNames, key)} {_format_value(value)}" for key, value in values]
+
+class Gauge(_Metric):
+    """A value which goes up and down. With function set, the value is read from function() when scraped,
+    which returns a number, or a dict of label values tuple -> number for a gauge with labels."""
+    type = 'gauge'
+
+    def __init__(self, name:str, description:str, labelNames:tuple = (), function = None):
+        super().__init__(name, description, labelNames)
+        self._values = {}
+        self.function = function
+
+    def set(self, value:float, **labels)->None:
+        with self._lock:
+            self._values[_label_key(self.labelNames, labels)] = value
+
+    def render(self)->list:
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception as e:
+                print(f"Failed to read metric {self.name}: {e}")
+                return []
+            if not isinstance(values, dict):
+                values = { () : values }
+            values = sorted((tuple(str(part) for part in key), value) for key, value in values.items())
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelNames, key)} {_format_value(value)}" for key, value in values]
+
+class Histogram(_Metric):
+    """Counts observed values into buckets, per combination of labels."""
+    type = 'histogram'
+
+    def __init__(self, name:str, description:str, labelNames:tuple = (), buckets:tuple = DURATION_BUCKETS):
+        super().__init__(name, description, labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}                   # Label values -> [counts per bucket (the last being +Inf), sum]
+
+    def observe(self, value:float, **labels)->None:
+        key = _label_key(self.labelNames, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def get_count(self, **labels)->int:
+        with self._lock:
+            entry = self._values.get(_label_key(self.labelNames, labels))
+            return sum(entry[0]) if entry else 0
+
+    def render(self)->list:
+        with self._lock:
+            values = sorted((key, (list(entry[0]), entry[1])) for key, entry in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelNames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelNames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelNames, key)} {cumulative}")
+        return lines
+
+def _register(metric:_Metric)->_Metric:
+    """Adds a metric to the registry, or returns the one already registered under its name (i.e on reload)."""
+    with _registryLock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+def counter(name:str, description:str, labelNames:tuple = ())->Counter:
+    return _register(Counter(name, description, labelNames))
+
+def gauge(name:str, description:str, labelNames:tuple = (), function = None)->Gauge:
+    metric = _register(Gauge(name, description, labelNames, function))
+    if function is not None:
+        metric.function = function
+    return metric
+
+def histogram(name:str, description:str, labelNames:tuple = (), buckets:tuple = DURATION_BUCKETS)->Histogram:
+    return _register(Histogram(name, description, labelNames, buckets))
+
+def render()->str:
+    """Every registered metric in the Prometheus text exposition format."""
+    with _registryLock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.header())
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -3,7 +3,7 @@ import io
 import random
 from ..db_instance import db
 from typing import List, Optional
-from sqlalchemy import JSON, BigInteger, Column, Table, ForeignKey, String, ForeignKeyConstraint, PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy import JSON, BigInteger, Column, Table, ForeignKey, String, ForeignKeyConstraint, PrimaryKeyConstraint, UniqueConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from datetime import datetime
 from sqlalchemy.ext.mutable import MutableList
@@ -283,3 +283,53 @@ class RubricGenerated(db.Model):
         )
 
         return f'<RubricGenerated hash={instance_hash} preview="{preview}">'
+
+class JobQueueEntry(db.Model):
+    # A job waiting on, or taken from, the job subsystem's queue. Rows outlive the process that
+    # enqueued them, so queued jobs survive a restart or crash.
+    # Workers claim the QUEUED row the scheduler picks (see src/job_scheduler.py) with SELECT ... FOR UPDATE SKIP LOCKED (see src/job_queue.py)
+    __tablename__ = 'job_queue'
+    job_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    job_type: Mapped[int] = mapped_column()
+    job_data: Mapped[dict] = mapped_column(JSON)
+    # QUEUED, IN_PROGRESS, COMPLETED, FAILED or CANCELLED (the values of job_subsystem.JobState)
+    state: Mapped[str] = mapped_column(String(20))
+    subsystem_status: Mapped[Optional[str]] = mapped_column(String(50))
+    submitted_at: Mapped[datetime] = mapped_column()
+    started_at: Mapped[Optional[datetime]] = mapped_column()
+    finished_at: Mapped[Optional[datetime]] = mapped_column()
+    result_path: Mapped[Optional[str]] = mapped_column(String(400))
+    error: Mapped[Optional[str]] = mapped_column(String(1000))
+    # The worker process holding an IN_PROGRESS job, and until when. The holder keeps pushing
+    # lease_expires_at back while it is alive, once it lapses any worker may claim the job again.
+    claimed_by: Mapped[Optional[str]] = mapped_column(String(100))
+    lease_expires_at: Mapped[Optional[datetime]] = mapped_column()
+    attempts: Mapped[int] = mapped_column(default=0)
+    # Identifies jobs which would produce the same output (see job_subsystem._job_fingerprint), a new
+    # job matching a QUEUED or IN_PROGRESS one is attached to it instead of being enqueued again
+    fingerprint: Mapped[Optional[str]] = mapped_column(String(64))
+    # Scheduling, 0 (interactive) goes before 1 (bulk), and jobs of the same priority take turns
+    # by tenant, the unit (unit:<unit_code>) or staff member (staff:<email>) the job is for
+    priority: Mapped[int] = mapped_column(default=0)
+    tenant: Mapped[str] = mapped_column(String(200), default='')
+    # How far the job has got (see src/job_events.py) and when that last changed, read by the
+    # progress event streams of processes which aren't running the job
+    progress: Mapped[Optional[str]] = mapped_column(String(20))
+    progress_at: Mapped[Optional[datetime]] = mapped_column()
+    # Set when a job is cancelled while IN_PROGRESS, its holder stops it (see DatabaseJobQueue.cancel)
+    cancel_requested: Mapped[bool] = mapped_column(default=False)
+    # A QUEUED job put back by its holder to be run later, i.e a batch job between checks on its
+    # OpenAI batch, isn't claimed before this
+    not_before: Mapped[Optional[datetime]] = mapped_column()
+    # Claiming takes the first job_id of each priority & tenant (one seek per lane), or the IN_PROGRESS
+    # jobs with a lapsed lease, which these indexes answer without a scan
+    __table_args__ = (
+        Index('ix_job_queue_state_job_id', 'state', 'job_id'),
+        Index('ix_job_queue_state_lane', 'state', 'priority', 'tenant', 'job_id'),
+        Index('ix_job_queue_state_lease', 'state', 'lease_expires_at'),
+        Index('ix_job_queue_fingerprint_state', 'fingerprint', 'state'),
+        Index('ix_job_queue_progress_at', 'progress_at'),
+    )
+
+    def __repr__(self):
+        return f"<JobQueueEntry(job_id={self.job_id}, job_type={self.job_type}, state='{self.state}')>"
@@ -11,6 +11,7 @@ from .qbank_routes import question_bank
 from .test_routes import test
 from .rubric_routes import rubric
 from .marking_guide_routes import marking_guide
+from .metrics_routes import monitoring
 
 def register_blueprints(app):
     """
@@ -27,3 +28,4 @@ def register_blueprints(app):
     app.register_blueprint(rubric)
     app.register_blueprint(question_bank)
     app.register_blueprint(marking_guide)
+    app.register_blueprint(monitoring)
@@ -0,0 +1,16 @@
+from flask import Blueprint, Response, jsonify
+import traceback
+
+import src.metrics as metrics
+import src.job_subsystem as js          # Registers the job subsystem's metrics
+
+monitoring = Blueprint('monitoring', __name__)
+
+# Route for Prometheus to scrape the job subsystem and OpenAI metrics from
+@monitoring.route('/metrics', methods=['GET'])
+def export_metrics():
+    try:
+        return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"message": "An error occurred while exporting the metrics.", "error": str(e)}), 500
@@ -1,4 +1,4 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 import traceback
 
 from src.controllers.qgen_queries import *
@@ -9,7 +9,9 @@ question = Blueprint('question', __name__)
 @question.route('/units/<string:unit_code>/projects/<string:project_title>/generate_questions', methods=['POST'])
 def generate_questions_for_all(unit_code, project_title):
     try:
-        response, status_code = generate_for_all(unit_code, project_title)
+        # ?batch=true sends every submission through the OpenAI Batch API as a single job
+        batch = request.args.get('batch', 'false').lower() in ('1', 'true', 'yes')
+        response, status_code = generate_for_all(unit_code, project_title, batch)
         return jsonify(response), status_code
     except Exception as e:
         traceback.print_exc()
@@ -57,6 +59,62 @@ def check_job_status(job_id):
         traceback.print_exc()
         return jsonify({"message: An error occured while getting the job status." "error": str(e)}), 500
 
+# Route to cancel a queued or running job
+@question.route('/job_cancel/<int:job_id>', methods=['POST'])
+def cancel_queued_job(job_id):
+    try:
+        response, status_code = cancel_job(job_id)
+        return jsonify(response), status_code
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"message": "An error occurred while cancelling the job.", "error": str(e)}), 500
+
+def _sse_response(stream):
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Route streaming the progress of a job as Server-Sent Events, until it has finished
+@question.route('/job_events/<int:job_id>', methods=['GET'])
+def stream_job_progress(job_id):
+    try:
+        response, status_code = stream_job_events(job_id)
+        if status_code != 200:
+            return jsonify(response), status_code
+        return _sse_response(response)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"message": "An error occurred while streaming the job's progress.", "error": str(e)}), 500
+
+# Route streaming the progress of every job of a project as Server-Sent Events
+@question.route('/units/<string:unit_code>/projects/<string:project_title>/job_events', methods=['GET'])
+def stream_project_progress(unit_code, project_title):
+    try:
+        response, status_code = stream_project_events(unit_code, project_title)
+        return _sse_response(response)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"message": "An error occurred while streaming the project's progress.", "error": str(e)}), 500
+
+# Route to check the circuit breaker, retry and rate limit counters of AI calls
+@question.route('/ai_status', methods=['GET'])
+def check_ai_status():
+    try:
+        response, status_code = get_ai_status()
+        return jsonify(response), status_code
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"message": "An error occurred while getting the AI status.", "error": str(e)}), 500
+
+# Route to check how busy each stage of the job pipeline is
+@question.route('/job_stats', methods=['GET'])
+def check_job_stats():
+    try:
+        response, status_code = get_job_stats()
+        return jsonify(response), status_code
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"message": "An error occurred while getting the job pipeline stats.", "error": str(e)}), 500
+
 # U-B09: Route for downloading questions PDF for a submission ID
 @question.route('/download_questions/<int:submission_id>/<string:format>', methods=['GET'])
 def download_questions_pdf(submission_id, format):
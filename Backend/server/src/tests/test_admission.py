@@ -0,0 +1,41 @@
+import pytest
+import src.job_queue as jq
+import src.job_subsystem as js
+
+# Test admission control of the job subsystem, on a memory queue without any workers
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = jq.MemoryJobQueue()
+    monkeypatch.setattr(js, '_jobQueue', queue)
+    monkeypatch.setattr(js, '_jobSubsystemState', js.SubsystemStatus.OKAY)
+    monkeypatch.setattr(js, '_instanceCount', 2)
+    monkeypatch.setattr(js, '_defaultJobSeconds', 10)
+    monkeypatch.setattr(js, '_maxQueuedJobs', 5)
+    monkeypatch.setattr(js, '_maxQueuedPerTenant', 3)
+    return queue
+
+def test_wait_is_estimated_from_the_queue(queue):
+    queue.put(1, {}, priority=1, tenant='unit:A')
+    # No job has finished yet, assume each takes 10 seconds on one of 2 workers
+    assert js.check_admission(1, 'COMP4050', bulk=True) == (js.SubsystemStatus.OKAY, 10)
+    # Interactive jobs don't wait behind bulk ones
+    assert js.check_admission(1, 'COMP4050') == (js.SubsystemStatus.OKAY, 5)
+
+    queue.put(1, {}, priority=1, tenant='unit:A')
+    for _ in range(2):
+        queue.finish(queue.claim()[0], jq.DONE, 'OKAY')
+    # 2 jobs finished in the 10 minute window, the queue is now empty
+    assert js.check_admission(1, 'COMP4050', bulk=True) == (js.SubsystemStatus.OKAY, 300)
+    assert js.check_admission(2, 'COMP4050', bulk=True) == (js.SubsystemStatus.OKAY, 600)
+
+def test_full_tenant_and_queue_are_turned_away(queue):
+    for i in range(3):
+        queue.put(1, {'n': i}, priority=1, tenant='unit:A')
+
+    status, retryAfter = js.check_admission(1, 'A', bulk=True)
+    assert status == js.SubsystemStatus.QUEUE_FULL and retryAfter == 5
+    assert js.check_admission(2, 'B', bulk=True)[0] == js.SubsystemStatus.OKAY
+    assert js.check_admission(3, 'B', bulk=True)[0] == js.SubsystemStatus.QUEUE_FULL
+    # More than a tenant could ever have queued
+    assert js.check_admission(4, 'B', bulk=True)[0] == js.SubsystemStatus.INVALID_INPUT
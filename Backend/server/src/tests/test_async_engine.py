@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import src.ai.async_engine as aiengine
+import src.ai.rate_limiter as limiter
+
+# Test the async AI engine against a local stub of the chat completions endpoint
+
+_STUB_DELAY = 0.5
+
+class _StubOpenAIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        time.sleep(_STUB_DELAY)
+        content = json.dumps({"factual_recall": {"question_1": "What is a viva?"}})
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope='module')
+def stub_engine():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubOpenAIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    aiengine.init_async_openai('test-key', None, None, max_concurrency=8,
+                               base_url=f"http://127.0.0.1:{server.server_port}/v1")
+    yield
+    aiengine.shutdown()
+    server.shutdown()
+
+def _viva_input(i):
+    return {
+        'assignment_title': f'Assignment {i}',
+        'unit_name': 'COMP4050',
+        'student_year_level': '3',
+        'question_challenging_level': 'Easy',
+        'no_of_questions_factual_recall': 1,
+        'assignment_content': 'Some content'
+    }
+
+def test_viva_batch_runs_concurrently(stub_engine):
+    start = time.monotonic()
+    results = aiengine.generate_viva_batch([_viva_input(i) for i in range(8)])
+    elapsed = time.monotonic() - start
+
+    assert len(results) == 8
+    assert all(success for success, _ in results)
+    # 8 calls within the concurrency limit should take about one call's latency, not eight
+    assert elapsed < _STUB_DELAY * 4
+
+def test_viva_batch_respects_concurrency_limit(stub_engine):
+    start = time.monotonic()
+    aiengine.generate_viva_batch([_viva_input(i) for i in range(16)])
+    elapsed = time.monotonic() - start
+
+    # 16 calls with at most 8 in flight need at least two round trips
+    assert elapsed >= _STUB_DELAY * 2
+
+def test_invalid_input_is_rejected(stub_engine):
+    success, message = aiengine.generate_viva_questions({'unit_name': 'COMP4050'})
+    assert not success
+    assert 'Missing required fields' in message
+
+def test_requests_are_held_to_the_rate_limit(stub_engine):
+    # One request per second with a burst of 10, the 11th and 12th wait for the bucket to refill
+    limiter.configure('test-key', rpm=60, tpm=1000000)
+    try:
+        start = time.monotonic()
+        results = aiengine.generate_viva_batch([_viva_input(i) for i in range(12)])
+        elapsed = time.monotonic() - start
+        stats = limiter.get_limiter('test-key').get_stats()
+    finally:
+        limiter.reset()
+
+    assert all(success for success, _ in results)
+    assert elapsed >= 2.0
+    assert (stats['requests'], stats['throttled']) == (12, 2)
+    # The stub reports 20 tokens per call
+    assert stats['used_tokens'] == 12 * 20
@@ -0,0 +1,211 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import src.ai.batch_api as batch_api
+import src.ai.resilience as resilience
+import src.ai.viva_questions as viva
+import src.cancellation as cancellation
+import src.job_checkpoints as checkpoints
+import src.job_queue as jq
+import src.job_subsystem as js
+
+# Test the OpenAI Batch API mode against a local stub of the files & batches endpoints
+
+_QUESTIONS = {"factual_recall": {"question_1": "What is a viva?"}}
+
+class _StubBatchServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _StubBatchHandler)
+        self.files = {}
+        self.batches = {}
+        self.polls = 0
+        self.failPolls = 0
+        self.failCreates = 0
+
+    def run_batch(self, inputFileID):
+        # Completes every request, except those whose prompt asks it to fail
+        output, errors = [], []
+        for line in self.files[inputFileID].splitlines():
+            request = json.loads(line)
+            prompt = json.dumps(request['body']['messages'])
+            if 'FAIL' in prompt:
+                errors.append({"id": "r", "custom_id": request['custom_id'], "response": None,
+                               "error": {"code": "server_error", "message": "stub failure"}})
+                continue
+            body = {"id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": json.dumps(_QUESTIONS)}}]}
+            output.append({"id": "r", "custom_id": request['custom_id'],
+                           "response": {"status_code": 200, "request_id": "x", "body": body}, "error": None})
+        return self._add_file('\n'.join(json.dumps(line) for line in output)), \
+               self._add_file('\n'.join(json.dumps(line) for line in errors)) if errors else None
+
+    def _add_file(self, content):
+        fileID = f"file-{len(self.files)}"
+        self.files[fileID] = content
+        return fileID
+
+class _StubBatchHandler(BaseHTTPRequestHandler):
+    def _reply(self, body, contentType='application/json'):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _batch(self, batchID):
+        batch = self.server.batches[batchID]
+        return {"id": batchID, "object": "batch", "endpoint": "/v1/chat/completions", "completion_window": "24h",
+                "created_at": 0, "input_file_id": batch['input'], "status": batch['status'],
+                "output_file_id": batch.get('output'), "error_file_id": batch.get('errors')}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/v1/files':
+            # Pull the JSONL lines out of the multipart upload
+            lines = [line for line in body.decode().splitlines() if line.startswith('{"custom_id"')]
+            fileID = self.server._add_file('\n'.join(lines))
+            self._reply({"id": fileID, "object": "file", "bytes": len(body), "created_at": 0,
+                         "filename": "batch_input.jsonl", "purpose": "batch", "status": "processed"})
+        elif self.path == '/v1/batches':
+            request = json.loads(body)
+            batchID = f"batch-{len(self.server.batches)}"
+            self.server.batches[batchID] = {'input': request['input_file_id'], 'status': 'validating'}
+            if self.server.failCreates > 0:
+                # The batch is created, but the response is lost
+                self.server.failCreates -= 1
+                self.send_response(500)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self._reply(self._batch(batchID))
+
+    def do_GET(self):
+        if self.path.startswith('/v1/batches/'):
+            if self.server.failPolls > 0:
+                self.server.failPolls -= 1
+                self.send_response(400)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            batchID = self.path.rsplit('/', 1)[1]
+            batch = self.server.batches[batchID]
+            self.server.polls += 1
+            # Still running on the first poll, done on the second
+            if batch['status'] == 'validating':
+                batch['status'] = 'in_progress'
+            elif batch['status'] == 'in_progress':
+                batch['output'], batch['errors'] = self.server.run_batch(batch['input'])
+                batch['status'] = 'completed'
+            self._reply(self._batch(batchID))
+        elif self.path.startswith('/v1/files/') and self.path.endswith('/content'):
+            self._reply(self.server.files[self.path.split('/')[3]].encode(), 'application/jsonl')
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub_server():
+    server = _StubBatchServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    viva.init_openai('test-key', None, None, base_url=f"http://127.0.0.1:{server.server_port}/v1")
+    yield server
+    viva.client = None
+    server.shutdown()
+
+def _request(prompt):
+    return {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": prompt}], "max_tokens": 800}
+
+def test_batch_file_is_one_request_per_line():
+    data = batch_api.build_batch_file({"a": _request("one"), "b": _request("two")})
+
+    lines = [json.loads(line) for line in data.decode().splitlines()]
+    assert [line['custom_id'] for line in lines] == ["a", "b"]
+    assert all(line['url'] == "/v1/chat/completions" and line['method'] == "POST" for line in lines)
+
+def test_batch_is_submitted_polled_and_fanned_out(stub_server):
+    results = batch_api.run_batch(viva.client, {"a": _request("one"), "b": _request("FAIL"), "c": _request("three")},
+                                  pollSeconds=0.01)
+
+    assert stub_server.polls == 2
+    assert results["a"] == (True, json.dumps(_QUESTIONS))
+    assert results["c"][0]
+    assert not results["b"][0] and "stub failure" in results["b"][1]
+
+def test_failed_batch_creation_isnt_retried(stub_server):
+    stub_server.failCreates = 1
+
+    with pytest.raises(Exception):
+        batch_api.submit_batch(viva.client, {"a": _request("one")})
+    assert list(stub_server.batches) == ['batch-0']
+
+def test_batch_job_saves_each_submission(stub_server, monkeypatch):
+    saved = []
+    monkeypatch.setattr(js, '_read_job_file', lambda filePath: (js.SubsystemStatus.OKAY, f"Content of {filePath}"))
+    monkeypatch.setattr(js, '_process_viva', lambda job, data: saved.append((job.data['submission_id'], data)) or js.SubsystemStatus.OKAY)
+    monkeypatch.setattr(js, '_batchPollSeconds', 0.01)
+    monkeypatch.setattr(js, '_jobSubsystemState', js.SubsystemStatus.OKAY)
+
+    submissions = [{'submission_id': 1, 'file_path': 'one.pdf'}, {'submission_id': 2, 'file_path': 'FAIL.pdf'},
+                   {'submission_id': 3, 'file_path': 'three.pdf'}]
+    job = js._SubsystemJob(7, js._SJobType.VIVA_BATCH, {'submissions': [
+        {'submission_id': sub['submission_id'], 'file_path': sub['file_path'], 'assignment_title': 'A1',
+         'unit_name': 'COMP4050', 'student_year_level': '3', 'question_challenging_level': 'Easy',
+         'no_of_questions_factual_recall': 1} for sub in submissions]})
+
+    status, results = js._submit_job(job)
+    assert status == js.SubsystemStatus.OKAY
+    assert js._process_completed_job(job, results) == js.SubsystemStatus.AI_SYS_ERROR
+
+    # The failed submission doesn't stop the others being saved
+    assert [subID for subID, _ in saved] == [1, 3]
+    assert 'question_1' in json.dumps(saved[0][1])
+    assert job.error.startswith("1 of 3 submissions failed. 2:")
+
+def _submission(submissionID, filePath):
+    return {'submission_id': submissionID, 'file_path': filePath, 'assignment_title': 'A1', 'unit_name': 'COMP4050',
+            'student_year_level': '3', 'question_challenging_level': 'Easy', 'no_of_questions_factual_recall': 1}
+
+def test_batch_job_checks_on_its_batch_from_the_queue(stub_server, monkeypatch, tmp_path):
+    queue = jq.MemoryJobQueue()
+    monkeypatch.setattr(checkpoints, '_checkpointDir', None)
+    checkpoints.initialise(str(tmp_path))
+    monkeypatch.setattr(js, '_jobQueue', queue)
+    monkeypatch.setattr(js, '_runningJobs', {})
+    monkeypatch.setattr(js, '_batchPollSeconds', 0.01)
+    monkeypatch.setattr(js, '_fetch_file', lambda filePath: (js.SubsystemStatus.OKAY, filePath.encode()))
+    monkeypatch.setattr(js, '_extract_file', lambda pdf_bytes, token=None: (js.SubsystemStatus.OKAY, f"Content of {pdf_bytes.decode()}"))
+
+    def claim():
+        job = js._SubsystemJob(*queue.claim())
+        job.token = cancellation.CancelToken()
+        js._mark_job_running(job)
+        return job
+
+    queue.put(js._SJobType.VIVA_BATCH, {'submissions': [_submission(1, 'one.pdf'), _submission(2, 'FAIL.pdf')]}, 7)
+    job = claim()
+
+    # Each submission is fetched & extracted as a part of its own, the last one submits the batch and puts the job back
+    for part in js._viva_batch_parts(job):
+        assert js._stage_fetch(part) and not js._stage_extract(part)
+    assert list(stub_server.batches) == ['batch-0'] and queue.qsize() == 1
+
+    # Neither a failed check nor an open circuit gives up on the batch, the job keeps checking the same one
+    stub_server.failPolls = 1
+    job = claim()
+    assert job.data['batch_id'] == 'batch-0'
+    assert not js._stage_fetch(job)
+    monkeypatch.setattr(resilience, '_state', resilience.OPEN)
+    monkeypatch.setattr(resilience, '_openedAt', float('inf'))
+    assert not js._stage_fetch(claim())
+    monkeypatch.setattr(resilience, '_state', resilience.CLOSED)
+    job = claim()
+    assert js._stage_fetch(job)
+
+    assert list(stub_server.batches) == ['batch-0'] and stub_server.polls == 2
+    assert job.result['submission-1'][0] and 'question_1' in json.dumps(job.result['submission-1'][1])
+    assert not job.result['submission-2'][0] and 'stub failure' in job.result['submission-2'][1]
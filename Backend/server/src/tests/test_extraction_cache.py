@@ -0,0 +1,65 @@
+import pytest
+import src.extraction_cache as extraction_cache
+import src.metrics as metrics
+
+# Test the PDF extraction cache's local tier
+
+class _CountingExtractor:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, file_obj):
+        self.calls += 1
+        content = file_obj.read().decode()
+        return [f"Page 1:\n{content}\n\n"], {1: "a | b\n"}
+
+@pytest.fixture
+def cache(tmp_path):
+    extraction_cache.initialise(str(tmp_path), maxEntries=2, useS3=False)
+    extraction_cache.clear()
+    yield extraction_cache
+    extraction_cache.clear()
+
+def test_repeat_extraction_is_a_hit(cache):
+    extractor = _CountingExtractor()
+    first = cache.get_or_extract(b'pdf one', extractor)
+    second = cache.get_or_extract(b'pdf one', extractor)
+
+    assert extractor.calls == 1
+    assert first == second
+    # Page number keys survive the JSON round trip
+    assert list(second[1].keys()) == [1]
+    stats = cache.get_cache_stats()
+    assert stats['misses'] == 1 and stats['local_hits'] == 1
+
+def test_hits_and_misses_are_exported(cache):
+    hits, misses = cache._hits.get(tier='local'), cache._misses.get()
+    extractor = _CountingExtractor()
+    cache.get_or_extract(b'pdf one', extractor)
+    cache.get_or_extract(b'pdf one', extractor)
+
+    assert (cache._hits.get(tier='local'), cache._misses.get()) == (hits + 1, misses + 1)
+    text = metrics.render()
+    assert '# TYPE extraction_cache_hits_total counter' in text and 'extraction_cache_entries 1' in text
+
+def test_least_recently_used_entry_is_evicted(cache):
+    extractor = _CountingExtractor()
+    cache.get_or_extract(b'pdf one', extractor)
+    cache.get_or_extract(b'pdf two', extractor)
+    cache.get_or_extract(b'pdf one', extractor)     # pdf two is now the least recently used
+    cache.get_or_extract(b'pdf three', extractor)
+
+    assert cache.get_cache_stats()['evictions'] == 1
+    cache.get_or_extract(b'pdf one', extractor)
+    assert extractor.calls == 3
+    cache.get_or_extract(b'pdf two', extractor)
+    assert extractor.calls == 4
+
+def test_errors_are_not_cached(cache):
+    calls = []
+    def failing(file_obj):
+        calls.append(1)
+        return "Error: PDF is encrypted."
+    cache.get_or_extract(b'encrypted', failing)
+    cache.get_or_extract(b'encrypted', failing)
+    assert len(calls) == 2
@@ -0,0 +1,162 @@
+import io
+import boto3
+import pytest
+from moto import mock_aws
+from werkzeug.datastructures import FileStorage
+import src.file_management as fm
+import src.metrics as metrics
+
+# Test the S3 file management functions against a mocked bucket
+
+BUCKET = 'test-bucket'
+
+@pytest.fixture
+def bucket():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        fm.initialise(client, BUCKET)
+        fm._reservedNames.clear()
+        yield client
+
+def test_object_is_read_by_uri_or_key(bucket):
+    fm.clear_read_cache()
+    bucket.put_object(Bucket=BUCKET, Key='a.pdf', Body=b'%PDF small')
+    bucket.put_object(Bucket=BUCKET, Key='a.json', Body=b'{}')
+
+    # Read once objects (i.e job PDFs) go through the read cache without being kept in it
+    assert fm.get_object_bytes(f's3://{BUCKET}/a.pdf', cache=False) == (fm.FileStatus.OKAY, b'%PDF small')
+    assert fm.get_object_bytes('a.json') == (fm.FileStatus.OKAY, b'{}')
+    assert fm.get_read_cache_stats()['entries'] == 1
+
+def test_missing_file_is_bad_path(bucket):
+    assert fm.get_object_bytes(f's3://{BUCKET}/missing.pdf') == (fm.FileStatus.BAD_PATH, None)
+    assert fm.get_pdf_binary_file(f's3://{BUCKET}/missing.pdf') == (fm.FileStatus.BAD_PATH, None)
+    assert fm.get_file(f's3://{BUCKET}/missing.json') == (fm.FileStatus.BAD_PATH, None)
+
+def test_pdf_binary_file_uses_initialised_bucket(bucket):
+    bucket.put_object(Bucket=BUCKET, Key='a.pdf', Body=b'%PDF')
+
+    status, file = fm.get_pdf_binary_file(f's3://{BUCKET}/a.pdf')
+    assert status == fm.FileStatus.OKAY
+    assert file.read() == b'%PDF'
+
+def _count_listings(client):
+    calls = []
+    client.meta.events.register('before-call.s3.ListObjectsV2', lambda **kwargs: calls.append(1))
+    return calls
+
+def test_rename_takes_one_listing(bucket):
+    bucket.put_object(Bucket=BUCKET, Key='report.pdf', Body=b'')
+    for i in range(1, 41):
+        bucket.put_object(Bucket=BUCKET, Key=f'report_{i}.pdf', Body=b'')
+    # Keys which only share the prefix don't count as copies
+    bucket.put_object(Bucket=BUCKET, Key='report_card.pdf', Body=b'')
+    bucket.put_object(Bucket=BUCKET, Key='report_99.json', Body=b'')
+    calls = _count_listings(bucket)
+
+    assert fm._rename_for_duplicates('report.pdf') == 'report_41.pdf'
+    assert len(calls) == 1
+
+def test_rename_keeps_free_names(bucket):
+    bucket.put_object(Bucket=BUCKET, Key='report_card.pdf', Body=b'')
+
+    assert fm._rename_for_duplicates('report.pdf') == 'report.pdf'
+
+def test_rename_never_hands_out_a_name_twice(bucket):
+    # Nothing is uploaded in between, the second caller must still get a different name
+    first = fm._rename_for_duplicates('report.pdf')
+    second = fm._rename_for_duplicates('report.pdf')
+
+    assert (first, second) == ('report.pdf', 'report_1.pdf')
+
+def test_batch_store_keeps_order_and_names(bucket):
+    files = [FileStorage(io.BytesIO(b'%PDF'), filename='same.pdf') for _ in range(5)]
+    files.append(FileStorage(io.BytesIO(b'text'), filename='notes.txt'))
+
+    results = fm.store_file_storages(files)
+
+    assert [status for status, _ in results] == [fm.FileStatus.OKAY] * 5 + [fm.FileStatus.BAD_EXTENSION]
+    paths = [path for _, path in results[:5]]
+    # Uploaded concurrently under the same name, every file still gets its own key
+    assert len(set(paths)) == 5
+    for path in paths:
+        assert bucket.get_object(Bucket=BUCKET, Key=fm.key_of(path))['Body'].read() == b'%PDF'
+
+def test_large_files_use_multipart_upload(bucket):
+    data = b'0' * (9 * 1024 * 1024)
+
+    [(status, path)] = fm.store_file_storages([FileStorage(io.BytesIO(data), filename='big.pdf')])
+
+    assert status == fm.FileStatus.OKAY
+    # Multipart uploads have an ETag ending in the part count
+    assert bucket.head_object(Bucket=BUCKET, Key=fm.key_of(path))['ETag'].strip('"').endswith('-2')
+
+def _count_gets(client):
+    calls = []
+    client.meta.events.register('before-call.s3.GetObject', lambda params, **kwargs: calls.append(params))
+    return calls
+
+@pytest.fixture
+def read_cache(bucket):
+    fm.clear_read_cache()
+    fm.configure_read_cache(ttl=30.0)
+    yield bucket
+    fm.clear_read_cache()
+    fm.configure_read_cache()
+
+def test_fresh_reads_skip_s3(read_cache):
+    read_cache.put_object(Bucket=BUCKET, Key='q.json', Body=b'{"a": 1}')
+    calls = _count_gets(read_cache)
+
+    for _ in range(3):
+        status, file = fm.get_file(f's3://{BUCKET}/q.json')
+        assert status == fm.FileStatus.OKAY
+        assert file.read() == '{"a": 1}'
+    assert len(calls) == 1
+
+def test_read_cache_is_exported(read_cache):
+    read_cache.put_object(Bucket=BUCKET, Key='q.json', Body=b'{}')
+    hits, misses = fm._readCacheHits.get(), fm._readCacheMisses.get()
+    fm.get_file(f's3://{BUCKET}/q.json')
+    fm.get_file(f's3://{BUCKET}/q.json')
+
+    assert (fm._readCacheHits.get(), fm._readCacheMisses.get()) == (hits + 1, misses + 1)
+    text = metrics.render()
+    assert 'file_read_cache_entries 1' in text and 'file_read_cache_bytes 2' in text
+
+def test_stale_reads_revalidate_with_etag(read_cache):
+    read_cache.put_object(Bucket=BUCKET, Key='q.json', Body=b'{"a": 1}')
+    fm.configure_read_cache(ttl=0)
+    calls = _count_gets(read_cache)
+
+    fm.get_file(f's3://{BUCKET}/q.json')
+    status, file = fm.get_file(f's3://{BUCKET}/q.json')
+
+    assert file.read() == '{"a": 1}'
+    assert 'If-None-Match' in calls[1]['headers']
+    assert fm.get_read_cache_stats()['revalidated'] == 1
+    assert '# TYPE file_read_cache_revalidations_total counter' in metrics.render()
+
+    # Changed by someone else, the conditional GET downloads the new content
+    read_cache.put_object(Bucket=BUCKET, Key='q.json', Body=b'{"a": 2}')
+    assert fm.get_file(f's3://{BUCKET}/q.json')[1].read() == '{"a": 2}'
+
+def test_writes_invalidate(read_cache):
+    status, path = fm.create_json_file('q.json', {"a": 1})
+    assert fm.get_file(path)[1].read() == '{"a": 1}'
+
+    fm.update_file_in_s3(path, '{"a": 2}', 'application/json')
+    assert fm.get_file(path)[1].read() == '{"a": 2}'
+
+    fm.del_file('q.json')
+    assert fm.get_file(path) == (fm.FileStatus.BAD_PATH, None)
+
+def test_cache_is_size_bounded(read_cache):
+    fm.configure_read_cache(maxBytes=10)
+    for name in ('a.json', 'b.json', 'c.json'):
+        read_cache.put_object(Bucket=BUCKET, Key=name, Body=b'12345')
+        fm.get_file(f's3://{BUCKET}/{name}')
+
+    stats = fm.get_read_cache_stats()
+    assert (stats['entries'], stats['bytes']) == (2, 10)
@@ -0,0 +1,110 @@
+import asyncio
+from threading import Timer
+import pytest
+import src.cancellation as cancellation
+import src.job_queue as jq
+import src.job_subsystem as js
+import src.ai.async_engine as aiengine
+import src.controllers.rubric_queries as rubric_queries
+import src.controllers.qgen_queries as qgen_queries
+
+# Test cancelling jobs and stopping them at their deadline, on a memory queue without any workers
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = jq.MemoryJobQueue()
+    monkeypatch.setattr(js, '_jobQueue', queue)
+    monkeypatch.setattr(js, '_jobSubsystemState', js.SubsystemStatus.OKAY)
+    monkeypatch.setattr(js, '_runningJobs', {})
+    return queue
+
+def _viva_data(unit, project, submission):
+    return {'unit_code': unit, 'assignment_title': project, 'submission_id': submission}
+
+def _running(queue, data, deadline=None):
+    jobID = queue.put(js._SJobType.VIVA_GEN, data, js._next_job_id())
+    job = js._SubsystemJob(*queue.claim())
+    job.token = cancellation.CancelToken(deadline)
+    js._runningJobs[jobID] = job
+    js._mark_job_running(job)
+    return job
+
+def test_token_stops_at_its_deadline():
+    clock = FakeClock()
+    token = cancellation.CancelToken(10, clock)
+    assert token.reason is None and token.remaining() == 10
+    clock.now = 10
+    with pytest.raises(cancellation.Cancelled) as stopped:
+        token.check()
+    assert stopped.value.reason == cancellation.DEADLINE
+
+def test_deleting_a_project_cancels_its_jobs(queue):
+    running = _running(queue, _viva_data('COMP4050', 'A1', 4))
+    _, _, first = js._enqueue_job(js._SJobType.VIVA_GEN, _viva_data('COMP4050', 'A1', 1))
+    js._enqueue_job(js._SJobType.VIVA_GEN, _viva_data('COMP4050', 'A1', 2))
+    js._enqueue_job(js._SJobType.VIVA_GEN, _viva_data('COMP4050', 'A2', 3))
+
+    assert js.cancel_jobs_for('COMP4050', 'A1') == 3
+    assert queue.qsize() == 1
+    assert js.get_job_status(first)[1]['status'] == js.JobState.CANCELLED.value
+
+    # The running job stops before its next stage, without running it
+    stages = []
+    assert js._stoppable(lambda job: stages.append(job))(running) is False
+    assert stages == []
+    assert js.get_job_status(running.jobID)[1]['status'] == js.JobState.CANCELLED.value
+    assert running.jobID not in js._runningJobs
+
+def test_cancel_job_refuses_finished_jobs(queue):
+    _, _, jobID = js._enqueue_job(js._SJobType.VIVA_GEN, _viva_data('COMP4050', 'A1', 1))
+    assert js.cancel_job(jobID)[0] == js.SubsystemStatus.OKAY
+    assert js.cancel_job(jobID)[0] == js.SubsystemStatus.WRONG_JOB
+    assert js.cancel_job(jobID + 1)[0] == js.SubsystemStatus.INVALID_INPUT
+
+def test_status_of_a_cancelled_job_is_reported(queue):
+    _, _, rubricJob = js._enqueue_job(js._SJobType.RUBRIC_GEN, {'staff_email': 'convener1@example.com'})
+    _, _, vivaJob = js._enqueue_job(js._SJobType.VIVA_GEN, _viva_data('COMP4050', 'A1', 1))
+    js.cancel_job(rubricJob)
+    js.cancel_job(vivaJob)
+
+    assert rubric_queries.get_job_status(rubricJob) == ({'message': "Rubric generation was cancelled.", **js.get_job_status(rubricJob)[1]}, 200)
+    assert qgen_queries.get_job_status(vivaJob)[0]['message'] == "Question generation was cancelled."
+
+def test_job_past_its_deadline_fails(queue):
+    job = _running(queue, _viva_data('COMP4050', 'A1', 1), deadline=0.01)
+    def slow(job):
+        job.token.wait(5)
+        job.token.check()
+    assert js._stoppable(slow)(job) is False
+
+    status = js.get_job_status(job.jobID)[1]
+    assert status['status'] == js.JobState.FAILED.value and status['subsystem_status'] == 'DEADLINE_EXCEEDED'
+
+def test_deadline_starts_once_a_stage_works_on_the_job(queue):
+    clock = FakeClock()
+    job = _running(queue, _viva_data('COMP4050', 'A1', 1))
+    job.token = cancellation.CancelToken(10, clock, start=False)
+
+    # Waiting in front of the pipeline doesn't count against the deadline
+    clock.now = 60
+    assert js._stoppable(lambda job: True)(job) is True
+    clock.now = 69
+    assert job.token.reason is None
+    clock.now = 70
+    assert job.token.reason == cancellation.DEADLINE
+
+def test_cancelled_token_abandons_an_engine_call():
+    aiengine._start_loop()
+    try:
+        token = cancellation.CancelToken()
+        Timer(0.1, token.cancel).start()
+        with pytest.raises(cancellation.Cancelled):
+            aiengine._run(asyncio.sleep(30), token)
+    finally:
+        aiengine.shutdown()
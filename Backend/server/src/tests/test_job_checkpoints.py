@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+import json
+import os
+import pytest
+import src.cancellation as cancellation
+import src.job_checkpoints as checkpoints
+import src.job_queue as jq
+import src.job_subsystem as js
+import src.controllers.qgen_queries as qgen_queries
+
+# Test retries of failed jobs resuming from their checkpoint, with a local checkpoint directory and no workers
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+    monkeypatch.setattr(checkpoints, '_checkpointDir', None)
+    monkeypatch.setattr(checkpoints, '_useS3', False)
+    checkpoints.initialise(str(tmp_path))
+    queue = jq.MemoryJobQueue()
+    monkeypatch.setattr(js, '_jobQueue', queue)
+    monkeypatch.setattr(js, '_jobSubsystemState', js.SubsystemStatus.OKAY)
+    monkeypatch.setattr(js, '_runningJobs', {})
+    return queue
+
+DATA = {'unit_code': 'COMP4050', 'assignment_title': 'A1', 'submission_id': 1, 'file_path': 's3://bucket/a1.pdf'}
+
+def _claim(queue):
+    queue.put(js._SJobType.VIVA_GEN, dict(DATA), js._next_job_id())
+    job = js._SubsystemJob(*queue.claim())
+    job.token = cancellation.CancelToken()
+    js._mark_job_running(job)
+    return job
+
+def _run(job):
+    for stage in (js._stage_fetch, js._stage_extract, js._stage_generate):
+        if not stage(job):
+            return
+    js._stage_persist([job])
+
+def test_extracted_text_keeps_its_page_numbers(queue):
+    checkpoints.save('key', checkpoints.EXTRACTED, (['page one'], {1: [['a', 'b']]}))
+    assert checkpoints.load('key') == (checkpoints.EXTRACTED, (['page one'], {1: [['a', 'b']]}))
+
+def test_expired_checkpoints_are_dropped(queue, tmp_path):
+    checkpoints.save('key', checkpoints.RESPONSE, {'questions': []})
+    path = tmp_path / 'key.json'
+    entry = json.loads(path.read_text())
+    entry['saved_at'] = (datetime.now() - timedelta(hours=25)).isoformat()
+    path.write_text(json.dumps(entry))
+
+    assert checkpoints.load('key') == (None, None)
+    assert not os.path.exists(path)
+
+def test_retries_resume_from_the_failed_stage(queue, monkeypatch):
+    calls = {'fetch': 0, 'generate': 0, 'package': 0, 'persist_fails': True}
+    def fetch(path):
+        calls['fetch'] += 1
+        return js.SubsystemStatus.OKAY, b'%PDF'
+    def generate(job, content):
+        calls['generate'] += 1
+        if calls['generate'] == 1:
+            return js.SubsystemStatus.AI_SYS_ERROR, "Bad response"
+        return js.SubsystemStatus.OKAY, {'factual_recall': {'q1': 'Why?'}}
+    def package(job, data, submission=None):
+        if job.packaged is None:
+            calls['package'] += 1
+            job.packaged = {'name': 'A1_generated', 's3_path': 's3://bucket/A1_generated.json'}
+        return js.SubsystemStatus.OKAY
+    monkeypatch.setattr(js, '_fetch_file', fetch)
+    monkeypatch.setattr(js, '_extract_file', lambda pdf_bytes, token=None: (js.SubsystemStatus.OKAY, (['text'], {})))
+    monkeypatch.setattr(js, '_generate_job', generate)
+    monkeypatch.setattr(js, '_package_viva', package)
+    monkeypatch.setattr(js, '_save_generated_files', lambda outputs: [not calls['persist_fails']] * len(outputs))
+    monkeypatch.setattr(qgen_queries, 'get_submissions_for_packaging', lambda submission_ids: {})
+
+    # The AI call fails, the retry starts from the extracted text
+    _run(_claim(queue))
+    retry = _claim(queue)
+    _run(retry)
+    assert (calls['fetch'], calls['generate'], calls['package']) == (1, 2, 1)
+    assert js.get_job_status(retry.jobID)[1]['subsystem_status'] == 'DB_SYS_ERROR'
+
+    # Saving to the db fails after the JSON is in S3, the retry only writes the db rows
+    calls['persist_fails'] = False
+    last = _claim(queue)
+    _run(last)
+    assert (calls['fetch'], calls['generate'], calls['package']) == (1, 2, 1)
+    assert js.get_job_status(last.jobID)[1]['status'] == js.JobState.DONE.value
+    assert checkpoints.load(js._job_fingerprint(js._SJobType.VIVA_GEN, DATA)) == (None, None)
@@ -0,0 +1,66 @@
+import json
+from datetime import datetime
+from flask import Flask
+import src.job_events as events
+import src.job_subsystem as js
+from src.routes.qgen_routes import question
+
+# Test the job progress events and their SSE streams
+
+def test_subscribers_get_matching_events_once():
+    job = events.subscribe(jobID=101)
+    project = events.subscribe(project=events.project_key('COMP4050', 'Viva'))
+    try:
+        events.publish(101, events.QUEUED, project='COMP4050/Viva')
+        events.publish(101, events.QUEUED, project='COMP4050/Viva')        # Repeated, dropped
+        events.publish(102, events.GENERATING, project='COMP4050/Viva')
+        events.publish(101, events.QUEUED, initial=True)                    # The job has moved on already
+
+        assert [job.get(0)['event'], job.get(0)] == [events.QUEUED, None]
+        assert [(e['job_id'], e['event']) for e in (project.get(0), project.get(0))] == [(101, 'queued'), (102, 'generating')]
+    finally:
+        job.close()
+        project.close()
+
+def test_watcher_publishes_progress_from_other_processes():
+    calls = []
+    def source(since):
+        calls.append(since)
+        return [(103, events.PERSISTED, { 'project' : 'COMP4050/Viva' })], datetime.now()
+
+    events.watch(source, 0.05)
+    subscription = events.subscribe(jobID=103)
+    try:
+        event = subscription.get(2)
+        assert event['event'] == events.PERSISTED and event['project'] == 'COMP4050/Viva'
+        assert len(calls) >= 1
+    finally:
+        subscription.close()
+        events.stop_watching()
+
+def test_job_stream_ends_once_the_job_has_finished(monkeypatch):
+    app = Flask(__name__)
+    app.register_blueprint(question)
+    status = { 'job_id' : 104, 'status' : js.JobState.RUNNING.value }
+    monkeypatch.setattr(js, 'get_job_status', lambda jobID: (js.SubsystemStatus.OKAY, status) if jobID == 104 else (js.SubsystemStatus.INVALID_INPUT, None))
+
+    assert app.test_client().get('/job_events/105').status_code == 404
+
+    response = app.test_client().get('/job_events/104', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    stream = (message.decode() for message in response.response)
+    assert next(stream).startswith("event: status\ndata: ")
+    events.publish(104, events.GENERATING)
+    events.publish(104, events.FAILED, error='AI_SYS_ERROR')
+    messages = list(stream)
+    assert [message.split('\n')[1] for message in messages] == ['event: generating', 'event: failed']
+    assert json.loads(messages[1].split('data: ')[1])['error'] == 'AI_SYS_ERROR'
+
+def test_stream_of_a_cancelled_job_ends_straight_away(monkeypatch):
+    app = Flask(__name__)
+    app.register_blueprint(question)
+    status = { 'job_id' : 106, 'status' : js.JobState.CANCELLED.value }
+    monkeypatch.setattr(js, 'get_job_status', lambda jobID: (js.SubsystemStatus.OKAY, status))
+
+    messages = list(app.test_client().get('/job_events/106', buffered=False).response)
+    assert len(messages) == 1 and messages[0].decode().startswith("event: status\ndata: ")
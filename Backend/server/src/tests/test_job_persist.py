@@ -0,0 +1,60 @@
+import pytest
+import src.cancellation as cancellation
+import src.job_queue as jq
+import src.job_subsystem as js
+import src.controllers.qgen_queries as qgen_queries
+
+# Test the persist stage saving a group of finished jobs in one db transaction, without a db or S3
+
+@pytest.fixture
+def saved(monkeypatch):
+    monkeypatch.setattr(js, '_jobQueue', jq.MemoryJobQueue())
+    monkeypatch.setattr(js, '_runningJobs', {})
+    saved = {'lookups': [], 'batches': [], 'single': []}
+    def package(job, data, submission=None):
+        job.packaged = {'name': f"q{job.data['submission_id']}", 's3_path': f"s3://bucket/q{job.data['submission_id']}.json"}
+        job.resultPath = job.packaged['s3_path']
+        return js.SubsystemStatus.OKAY
+    def save_batch(rows, status):
+        saved['batches'].append(rows)
+        if any(submission_id == 13 for submission_id, _, _ in rows):
+            return {"message": "An error occurred", "error": "foreign key"}, 500
+        return {"message": "Saved"}, 201
+    def save_one(submission_id, name, path, status):
+        saved['single'].append(submission_id)
+        return ({"message": "Saved"}, 201) if submission_id != 13 else ({"message": "An error occurred"}, 500)
+    monkeypatch.setattr(js, '_package_viva', package)
+    monkeypatch.setattr(qgen_queries, 'get_submissions_for_packaging', lambda ids: saved['lookups'].append(sorted(ids)) or {})
+    monkeypatch.setattr(qgen_queries, 'upload_generated_files_batch', save_batch)
+    monkeypatch.setattr(qgen_queries, 'upload_generated_files', save_one)
+    return saved
+
+def _job(jobType, data, result):
+    job = js._SubsystemJob(js._next_job_id(), jobType, data)
+    job.token = cancellation.CancelToken()
+    job.result = result
+    js._register_job(job)
+    return job
+
+def test_group_is_saved_in_one_transaction(saved):
+    first = _job(js._SJobType.VIVA_GEN, {'submission_id': 1}, {'factual_recall': {}})
+    second = _job(js._SJobType.VIVA_GEN, {'submission_id': 2}, {'factual_recall': {}})
+    batch = _job(js._SJobType.VIVA_BATCH, {'submissions': [{'submission_id': 3}, {'submission_id': 4}]},
+                 {'submission-3': (True, {}), 'submission-4': (False, "Bad response")})
+
+    assert js._stage_persist([first, second, batch]) == [False, False, False]
+    assert saved['lookups'] == [[1, 2, 3]]
+    assert [[row[0] for row in rows] for rows in saved['batches']] == [[1, 2, 3]]
+    assert js.get_job_status(first.jobID)[1]['status'] == js.JobState.DONE.value
+    assert js.get_job_status(first.jobID)[1]['result_path'] == 's3://bucket/q1.json'
+    status = js.get_job_status(batch.jobID)[1]
+    assert status['subsystem_status'] == 'AI_SYS_ERROR' and '4: Bad response' in status['error']
+
+def test_failed_group_falls_back_to_a_transaction_per_job(saved):
+    good = _job(js._SJobType.VIVA_GEN, {'submission_id': 12}, {})
+    bad = _job(js._SJobType.VIVA_GEN, {'submission_id': 13}, {})
+
+    js._stage_persist([good, bad])
+    assert saved['single'] == [12, 13]
+    assert js.get_job_status(good.jobID)[1]['status'] == js.JobState.DONE.value
+    assert js.get_job_status(bad.jobID)[1]['subsystem_status'] == 'DB_SYS_ERROR'
@@ -0,0 +1,96 @@
+from threading import Event, Lock
+from time import sleep
+import queue
+import pytest
+import src.job_pipeline as jp
+
+# Test the staged job pipeline
+
+def test_items_pass_through_every_stage_in_order():
+    seen = []
+    lock = Lock()
+    def step(name):
+        def handler(item):
+            with lock:
+                seen.append((name, item))
+            return True
+        return handler
+
+    pipeline = jp.Pipeline([jp.Stage('fetch', step('fetch')), jp.Stage('generate', step('generate'), workers=2)])
+    pipeline.start()
+    for i in range(5):
+        pipeline.submit(i)
+    pipeline.close()
+
+    for i in range(5):
+        assert seen.index(('fetch', i)) < seen.index(('generate', i))
+    stats = pipeline.get_stats()
+    assert list(stats.keys()) == ['fetch', 'generate']
+    assert stats['generate']['processed'] == 5 and stats['generate']['depth'] == 0
+
+def test_failed_and_raising_items_stop_early():
+    errors = []
+    def first(item):
+        if item == 'boom':
+            raise RuntimeError('bad item')
+        return item != 'drop'
+    finished = []
+
+    pipeline = jp.Pipeline([jp.Stage('first', first), jp.Stage('last', finished.append)],
+                           onError=lambda item, e: errors.append((item, str(e))))
+    pipeline.start()
+    for item in ('ok', 'drop', 'boom'):
+        pipeline.submit(item)
+    pipeline.close()
+
+    assert finished == ['ok']
+    assert errors == [('boom', 'bad item')]
+    assert pipeline.get_stats()['first']['failed'] == 1
+
+def test_full_stage_blocks_the_submitter():
+    release = Event()
+    pipeline = jp.Pipeline([jp.Stage('slow', lambda item: release.wait(), workers=1, maxQueue=1)])
+    pipeline.start()
+    pipeline.submit(1)              # Taken by the worker
+    sleep(0.1)
+    pipeline.submit(2)              # Waits in the queue
+    with pytest.raises(queue.Full):
+        pipeline.submit(3, timeout=0.1)
+    assert pipeline.get_stats()['slow']['depth'] == 1
+
+    release.set()
+    pipeline.close()
+    assert pipeline.get_stats()['slow']['processed'] == 2
+
+def test_stages_overlap():
+    # While the generate stage is stuck on one item, the next is fetched
+    release = Event()
+    fetched = []
+    pipeline = jp.Pipeline([jp.Stage('fetch', lambda item: fetched.append(item) or True),
+                            jp.Stage('generate', lambda item: release.wait())])
+    pipeline.start()
+    pipeline.submit(1)
+    pipeline.submit(2)
+    sleep(0.2)
+    assert fetched == [1, 2]
+    assert pipeline.get_stats()['generate']['in_flight'] == 1
+
+    release.set()
+    pipeline.close()
+
+def test_batch_stage_takes_items_waiting_together():
+    release = Event()
+    groups = []
+    pipeline = jp.Pipeline([jp.Stage('generate', lambda item: release.wait() or True),
+                            jp.Stage('persist', lambda items: groups.append(items) or [False] * len(items),
+                                     maxQueue=8, batchSize=4, batchWindow=0.5)])
+    pipeline.start()
+    for i in range(6):
+        pipeline.submit(i)
+    release.set()
+    pipeline.close()
+
+    # Items arriving within the window share a group, no group is larger than the batch size
+    assert sorted(item for group in groups for item in group) == list(range(6))
+    assert len(groups) < 6 and max(len(group) for group in groups) <= 4
+    assert pipeline.get_stats()['persist']['processed'] == 6
@@ -0,0 +1,238 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Thread
+from time import sleep
+import pytest
+from sqlalchemy import create_engine, event
+import src.job_queue as jq
+import src.job_subsystem as js
+
+# Test the database job queue on SQLite
+
+@pytest.fixture
+def queue(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}", connect_args={'timeout': 30})
+    queue = jq.DatabaseJobQueue(engine, pollRate=0.05)
+    yield queue
+    queue.close()
+    engine.dispose()
+
+def test_jobs_are_claimed_in_order(queue):
+    first = queue.put(1, {'file_path': 'a.pdf'})
+    second = queue.put(2, {'file_path': 'b.pdf'})
+
+    assert queue.qsize() == 2
+    assert queue.claim() == (first, 1, {'file_path': 'a.pdf'})
+    assert queue.claim() == (second, 2, {'file_path': 'b.pdf'})
+    assert queue.empty()
+    assert queue.get(first)['state'] == jq.RUNNING
+
+def test_concurrent_claims_are_unique(queue):
+    jobIDs = [queue.put(1, {'n': i}) for i in range(40)]
+    claimed = []
+
+    def worker():
+        while not queue.empty():
+            job = queue._try_claim()
+            if job is not None:
+                claimed.append(job[0])
+
+    workers = [Thread(target=worker) for _ in range(4)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    assert sorted(claimed) == jobIDs
+
+def test_claims_seek_the_head_of_each_lane(queue):
+    first = queue.put(1, {'n': 0}, priority=1, tenant='unit:A')
+    queue.put(1, {'n': 1}, priority=1, tenant='unit:A')
+    other = queue.put(1, {'n': 2}, priority=1, tenant='unit:B')
+    # Put by another process, it is found when the lanes are next refreshed
+    elsewhere = _worker(queue, 'host-b:1', 60).put(1, {'n': 3}, priority=0, tenant='unit:C')
+    statements = []
+    event.listen(queue._engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+
+    assert queue.claim()[0] == elsewhere
+    heads = queue._lane_heads()
+    assert sorted((lane[1], lane[3]) for lane in heads) == [('unit:A', first), ('unit:B', other)]
+    assert not any('GROUP BY' in statement for statement in statements)
+    assert sum('DISTINCT' in statement for statement in statements) == 1
+
+def test_outcome_is_recorded(queue):
+    jobID = queue.put(1, {})
+    queue.claim()
+    queue.finish(jobID, jq.FAILED, 'AI_SYS_ERROR', None, 'An error occurred')
+
+    entry = queue.get(jobID)
+    assert (entry['state'], entry['subsystem_status'], entry['error']) == (jq.FAILED, 'AI_SYS_ERROR', 'An error occurred')
+    assert entry['finished_at'] is not None
+    assert queue.get(jobID + 1) is None
+
+def test_recover_requeues_lapsed_jobs(queue):
+    worker = _worker(queue, 'host-a:1', 0.1)
+    jobID = worker.put(1, {})
+    worker._try_claim()
+    assert worker.recover() == 0
+
+    sleep(0.2)
+    assert worker.recover() == 1
+    assert worker.get(jobID)['state'] == jq.QUEUED
+
+def test_close_wakes_waiting_claims(queue):
+    result = []
+    waiter = Thread(target=lambda: result.append(queue.claim()))
+    waiter.start()
+    queue.close()
+    waiter.join(timeout=5)
+
+    assert result == [None]
+
+def _worker(queue, name, leaseSeconds):
+    # A second process sharing the first one's table
+    return jq.DatabaseJobQueue(queue._engine, pollRate=0.05, leaseDuration=timedelta(seconds=leaseSeconds), workerName=name)
+
+def test_lapsed_lease_is_claimed_by_another_worker(queue):
+    first = _worker(queue, 'host-a:1', 0.2)
+    second = _worker(queue, 'host-b:1', 0.2)
+    jobID = first.put(1, {})
+
+    # Claimed without a heartbeat running, as if the process died straight after
+    assert first._try_claim()[0] == jobID
+    assert second._try_claim() is None
+    sleep(0.3)
+    assert second._try_claim()[0] == jobID
+    assert second.get(jobID)['claimed_by'] == 'host-b:1'
+
+    # The first worker's late outcome is dropped in favour of the new holder's
+    assert not first.finish(jobID, jq.DONE, 'OKAY')
+    assert second.finish(jobID, jq.DONE, 'OKAY')
+    assert second.get(jobID)['state'] == jq.DONE
+
+def test_heartbeat_keeps_the_lease(queue):
+    first = _worker(queue, 'host-a:1', 0.3)
+    second = _worker(queue, 'host-b:1', 0.3)
+    jobID = first.put(1, {})
+
+    assert first.claim()[0] == jobID
+    sleep(0.8)
+    assert second._try_claim() is None
+    first.close()
+
+def test_repeatedly_abandoned_job_fails(queue):
+    worker = _worker(queue, 'host-a:1', 0.05)
+    jobID = worker.put(1, {})
+
+    for _ in range(3):
+        assert worker._try_claim()[0] == jobID
+        sleep(0.1)
+    assert worker._try_claim() is None
+    assert worker.get(jobID)['state'] == jq.FAILED
+
+@pytest.mark.parametrize('store', ['memory', 'database'])
+def test_active_jobs_are_found_by_fingerprint(queue, store):
+    if store == 'memory':
+        queue = jq.MemoryJobQueue()
+    jobID = queue.put(1, {'file_path': 'a.pdf'}, fingerprint='abc')
+    queue.put(1, {'file_path': 'b.pdf'}, fingerprint='def')
+
+    assert queue.find_active('abc') == jobID
+    # Still active while it runs
+    assert queue.claim()[0] == jobID
+    assert queue.find_active('abc') == jobID
+
+    queue.finish(jobID, jq.DONE, 'OKAY', 's3://bucket/a.json')
+    assert queue.find_active('abc') is None
+    assert queue.find_active('missing') is None
+
+@pytest.mark.parametrize('store', ['memory', 'database'])
+def test_jobs_are_claimed_by_priority_then_tenant(queue, store):
+    if store == 'memory':
+        queue = jq.MemoryJobQueue()
+    bulk = [queue.put(1, {'n': i}, priority=1, tenant='unit:A') for i in range(3)]
+    other = queue.put(1, {'n': 3}, priority=1, tenant='unit:B')
+    regen = queue.put(2, {'n': 4}, priority=0, tenant='unit:B')
+
+    claimed = [queue.claim()[0] for _ in range(5)]
+    assert claimed == [regen, bulk[0], other, bulk[1], bulk[2]]
+
+@pytest.mark.parametrize('store', ['memory', 'database'])
+def test_queued_jobs_are_counted_by_tenant_and_priority(queue, store):
+    if store == 'memory':
+        queue = jq.MemoryJobQueue()
+    queue.put(1, {'n': 0}, priority=1, tenant='unit:A')
+    queue.put(1, {'n': 1}, priority=1, tenant='unit:A')
+    queue.put(2, {'n': 2}, priority=0, tenant='unit:B')
+    started = datetime.now()
+
+    assert (queue.qsize(), queue.qsize('unit:A'), queue.qsize(maxPriority=0)) == (3, 2, 1)
+    jobID = queue.claim()[0]
+    queue.finish(jobID, jq.DONE, 'OKAY')
+    assert queue.finished_since(started) == 1
+    assert queue.qsize() == 2
+
+@pytest.mark.parametrize('store', ['memory', 'database'])
+def test_cancelled_jobs_dont_count_as_finished(queue, store):
+    if store == 'memory':
+        queue = jq.MemoryJobQueue()
+    started = datetime.now()
+    for n in range(3):
+        queue.put(1, {'n': n})
+    for state in (jq.DONE, jq.FAILED, jq.CANCELLED):
+        queue.finish(queue.claim()[0], state, state)
+
+    assert queue.finished_since(started) == 2
+
+def test_cancel_takes_queued_jobs_and_flags_running_ones(queue):
+    stopped = []
+    holder = jq.DatabaseJobQueue(queue._engine, pollRate=0.05, workerName='host-a:1', onCancel=stopped.append)
+    running = holder.put(1, {'unit_code': 'A'})
+    holder.claim()
+    queued = queue.put(1, {'unit_code': 'A'})
+    other = queue.put(1, {'unit_code': 'B'})
+
+    cancelled, flagged = queue.cancel(lambda jobID, jobType, data: data.get('unit_code') == 'A')
+    assert cancelled == [(queued, 1, {'unit_code': 'A'})] and flagged == [running]
+    assert queue.get(queued)['state'] == jq.CANCELLED and queue.get(other)['state'] == jq.QUEUED
+
+    # The holder learns of it from its heartbeat, a job put back instead of stopped is cancelled when next claimed
+    holder.heartbeat()
+    assert stopped == [running]
+    holder.release(running)
+    assert queue.claim()[0] == other
+    assert queue.get(running)['state'] == jq.CANCELLED
+    holder.close()
+
+@pytest.mark.parametrize('store', ['memory', 'database'])
+def test_released_job_waits_until_not_before(queue, store):
+    if store == 'memory':
+        queue = jq.MemoryJobQueue()
+    jobID = queue.put(5, {'batch_id': None})
+    queue.claim()
+    queue.release(jobID, 5, {'batch_id': 'batch-0'}, datetime.now() + timedelta(seconds=0.3))
+    other = queue.put(1, {'n': 1})
+
+    # Still counted as waiting, but other jobs are claimed first and it isn't claimed until it's due
+    assert queue.qsize() == 2
+    started = datetime.now()
+    assert queue.claim()[0] == other
+    assert queue.claim() == (jobID, 5, {'batch_id': 'batch-0'})
+    assert datetime.now() - started >= timedelta(seconds=0.25)
+
+def test_memory_queue_is_saved_and_loaded(monkeypatch, tmp_path):
+    # Saved under tmp_path, not .queue in the working directory
+    monkeypatch.setattr(js, '_queueFile', str(tmp_path / '.queue'))
+    monkeypatch.setattr(js, '_queueBackend', 'memory')
+    monkeypatch.setattr(js, '_jobQueue', jq.MemoryJobQueue())
+    monkeypatch.setattr(js, '_jobRecords', {})
+    monkeypatch.setattr(js, '_finishedJobs', OrderedDict())
+    monkeypatch.setattr(js, '_globalJobCounter', 0)
+    js._jobQueue.put(js._SJobType.VIVA_GEN, {'submission_id': 1}, 4)
+    js._jobQueue.put(js._SJobType.VIVA_REGEN, {'submission_id': 2}, 5)
+
+    assert js._save() == js.SubsystemStatus.OKAY
+    assert (tmp_path / '.queue').is_file() and js._jobQueue.empty()
+    assert js._load() == js.SubsystemStatus.OKAY
+    assert [js._jobQueue.claim()[0] for _ in range(2)] == [4, 5]
+    assert js._globalJobCounter == 6
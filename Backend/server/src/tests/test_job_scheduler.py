@@ -0,0 +1,111 @@
+import src.job_scheduler as sched
+
+# Test the priority & fair-share job scheduler
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def drain(scheduler):
+    items = []
+    while len(scheduler) > 0:
+        items.append(scheduler.pop())
+    return items
+
+def test_interactive_jobs_go_before_bulk():
+    scheduler = sched.FairScheduler(clock=FakeClock())
+    for i in range(3):
+        scheduler.push(f"bulk{i}", sched.BULK, 'unit:A')
+    scheduler.push('regen', sched.INTERACTIVE, 'unit:B')
+
+    assert scheduler.pop() == 'regen'
+    assert drain(scheduler) == ['bulk0', 'bulk1', 'bulk2']
+    assert scheduler.pop() is None
+
+def test_tenants_take_turns():
+    scheduler = sched.FairScheduler(clock=FakeClock())
+    for i in range(4):
+        scheduler.push(f"A{i}", sched.BULK, 'unit:A')
+    scheduler.push('B0', sched.BULK, 'unit:B')
+    scheduler.push('B1', sched.BULK, 'unit:B')
+
+    assert drain(scheduler) == ['A0', 'B0', 'A1', 'B1', 'A2', 'A3']
+
+def test_tenant_returning_from_idle_gets_no_backlog_of_turns():
+    scheduler = sched.FairScheduler(clock=FakeClock())
+    for i in range(4):
+        scheduler.push(f"A{i}", sched.BULK, 'unit:A')
+    assert scheduler.pop() == 'A0'
+    assert scheduler.pop() == 'A1'
+
+    scheduler.push('B0', sched.BULK, 'unit:B')
+    scheduler.push('B1', sched.BULK, 'unit:B')
+    # B goes next, but then alternates with A rather than catching up on the turns it missed
+    assert drain(scheduler) == ['B0', 'A2', 'B1', 'A3']
+
+def test_weighted_tenants_get_more_turns():
+    scheduler = sched.FairScheduler({ 'unit:A' : 2 }, clock=FakeClock())
+    for i in range(4):
+        scheduler.push(f"A{i}", sched.BULK, 'unit:A')
+        scheduler.push(f"B{i}", sched.BULK, 'unit:B')
+
+    first = drain(scheduler)[:6]
+    assert [item[0] for item in first].count('A') == 4
+
+def test_waiting_bulk_jobs_age_past_new_interactive_ones():
+    clock = FakeClock()
+    scheduler = sched.FairScheduler(agingSeconds=60, clock=clock)
+    scheduler.push('bulk', sched.BULK, 'unit:A')
+    clock.now = 30
+    scheduler.push('regen0', sched.INTERACTIVE, 'unit:B')
+    assert scheduler.pop() == 'regen0'
+
+    # Aged into the interactive tier, from then on it takes turns with the interactive jobs
+    clock.now = 61
+    scheduler.push('regen1', sched.INTERACTIVE, 'unit:B')
+    scheduler.push('regen2', sched.INTERACTIVE, 'unit:B')
+    assert drain(scheduler) == ['bulk', 'regen1', 'regen2']
+    assert scheduler.depths() == { sched.INTERACTIVE : 0, sched.BULK : 0 }
+
+def test_regen_goes_ahead_of_its_own_units_aged_bulk_run():
+    clock = FakeClock()
+    scheduler = sched.FairScheduler(agingSeconds=60, clock=clock)
+    for i in range(500):
+        scheduler.push(f"bulk{i}", sched.BULK, 'unit:A')
+
+    # Only the oldest job of the run has moved up, not all 500 of them
+    clock.now = 61
+    scheduler.push('regen', sched.INTERACTIVE, 'unit:A')
+    assert [scheduler.pop() for _ in range(3)] == ['regen', 'bulk0', 'bulk1']
+    assert scheduler.depths() == { sched.INTERACTIVE : 0, sched.BULK : 498 }
+
+    # The next one moves up an interval later
+    clock.now = 122
+    scheduler.push('regen2', sched.INTERACTIVE, 'unit:A')
+    assert [scheduler.pop() for _ in range(2)] == ['regen2', 'bulk2']
+    assert scheduler.depths() == { sched.INTERACTIVE : 0, sched.BULK : 497 }
+
+def test_fair_share_ages_one_job_of_a_lane_per_interval():
+    clock = FakeClock()
+    share = sched.FairShare(clock=clock)
+    regen = (sched.INTERACTIVE, 'unit:A', 0.0, 501)
+
+    # The database queue reports a lane by its oldest job, once that has been served the rest wait another interval
+    lane, level = share.choose([(sched.BULK, 'unit:A', 100.0, 1), regen], 60)
+    assert lane[3] == 1 and level == sched.INTERACTIVE
+    share.charge(level, 'unit:A', lane[0])
+    assert share.choose([(sched.BULK, 'unit:A', 100.0, 2), regen], 60)[0] == regen
+    share.charge(sched.INTERACTIVE, 'unit:A')
+
+    clock.now = 61
+    assert share.choose([(sched.BULK, 'unit:A', 161.0, 2)], 60) == ((sched.BULK, 'unit:A', 161.0, 2), sched.INTERACTIVE)
+
+def test_clear_returns_every_job():
+    scheduler = sched.FairScheduler(clock=FakeClock())
+    scheduler.push('a', sched.BULK, 'unit:A')
+    scheduler.push('b', sched.INTERACTIVE, 'staff:x@mq.edu.au')
+
+    assert sorted(scheduler.clear()) == ['a', 'b']
+    assert len(scheduler) == 0 and scheduler.pop() is None
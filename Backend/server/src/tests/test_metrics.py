@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+import src.metrics as metrics
+import src.job_pipeline as jp
+import src.ai.rate_limiter as limiter
+
+# Test the Prometheus metrics exporter
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram('test_seconds', 'A test histogram.', ('stage',), buckets=(0.1, 1))
+    histogram.observe(0.05, stage='fetch')
+    histogram.observe(0.5, stage='fetch')
+    histogram.observe(5, stage='fetch')
+
+    assert histogram.render() == [
+        'test_seconds_bucket{stage="fetch",le="0.1"} 1',
+        'test_seconds_bucket{stage="fetch",le="1"} 2',
+        'test_seconds_bucket{stage="fetch",le="+Inf"} 3',
+        'test_seconds_sum{stage="fetch"} 5.55',
+        'test_seconds_count{stage="fetch"} 3',
+    ]
+
+def test_counters_and_scraped_gauges():
+    counter = metrics.Counter('test_total', 'A test counter.', ('status',))
+    counter.inc(status='OKAY')
+    counter.inc(2, status='AI_SYS_ERROR')
+    gauge = metrics.Gauge('test_depth', 'A test gauge.', ('stage',), lambda: { ('fetch',) : 3 })
+
+    assert counter.render() == ['test_total{status="AI_SYS_ERROR"} 2', 'test_total{status="OKAY"} 1']
+    assert gauge.render() == ['test_depth{stage="fetch"} 3']
+    assert metrics.Gauge('test_broken', 'Raises.', function=lambda: 1 / 0).render() == []
+
+def test_pipeline_observer_sees_every_stage():
+    seen = []
+    pipeline = jp.Pipeline([jp.Stage('a', lambda item: True), jp.Stage('b', lambda item: True)],
+                           observer=lambda stage, waited, took, failed: seen.append(stage))
+    pipeline.start()
+    pipeline.submit(1)
+    pipeline.close()
+    assert seen == ['a', 'b']
+
+def test_job_and_token_metrics_are_exported():
+    import src.job_subsystem as js
+    usage = SimpleNamespace(prompt_tokens=300, completion_tokens=200, total_tokens=500)
+    limiter.observe_usage(SimpleNamespace(model='test-model', usage=usage))
+
+    text = metrics.render()
+    assert 'openai_tokens_per_call_count{model="test-model",kind="total"}' in text
+    assert '# TYPE job_stage_duration_seconds histogram' in text
+    assert '# TYPE job_queue_depth gauge' in text
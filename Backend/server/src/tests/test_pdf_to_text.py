@@ -0,0 +1,67 @@
+import io
+import fitz  # PyMuPDF
+import src.ai.pdf_to_text as ptt
+
+# Test the single pass PDF extractor on documents built in memory
+
+def _build_pdf(with_table_on_page):
+    doc = fitz.open()
+    for page_num in range(1, 4):
+        page = doc.new_page()
+        # A white page background should never be mistaken for a table
+        page.draw_rect(page.rect, color=None, fill=(1, 1, 1))
+        if page_num == with_table_on_page:
+            # 3 x 2 grid of ruled cells with a word in each
+            for row in range(4):
+                page.draw_line((100, 200 + row * 30), (400, 200 + row * 30))
+            for col in range(3):
+                page.draw_line((100 + col * 150, 200), (100 + col * 150, 290))
+            for row in range(3):
+                for col in range(2):
+                    page.insert_text((110 + col * 150, 220 + row * 30), f"r{row}c{col}")
+        page.insert_text((72, 72), f"Paragraph on page {page_num}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+def test_text_from_every_page_once():
+    text_by_page, _ = ptt.extract_text_and_tables_from_pdf(io.BytesIO(_build_pdf(2)))
+
+    assert len(text_by_page) == 3
+    for page_num, text in enumerate(text_by_page, 1):
+        assert text.startswith(f"Page {page_num}:\n")
+        assert f"page {page_num}" in text
+
+def test_tables_only_from_ruled_pages():
+    pdf = fitz.open(stream=_build_pdf(2), filetype="pdf")
+    assert [ptt._page_has_ruling_lines(page) for page in pdf] == [False, True, False]
+    pdf.close()
+
+    _, tables_by_page = ptt.extract_text_and_tables_from_pdf(io.BytesIO(_build_pdf(2)))
+    assert list(tables_by_page.keys()) == [2]
+    assert "r2c1" in tables_by_page[2]
+
+def test_invalid_pdf_is_an_error():
+    result = ptt.extract_text_and_tables_from_pdf(io.BytesIO(b"not a pdf"))
+
+    assert result[0].startswith("Error")
+
+def test_parallel_extraction_matches_serial():
+    doc = fitz.open()
+    for _ in range(20):
+        doc.insert_pdf(fitz.open(stream=_build_pdf(2), filetype="pdf"))
+    data = doc.tobytes()
+    doc.close()
+
+    try:
+        ptt.configure_parallel(0)
+        serial = ptt.extract_text_and_tables_from_pdf(io.BytesIO(data))
+        # 60 pages over 3 workers, one shard of 20 pages each
+        ptt.configure_parallel(10, 3)
+        parallel = ptt.extract_text_and_tables_from_pdf(io.BytesIO(data))
+    finally:
+        ptt.configure_parallel()
+        ptt.shutdown_pool()
+
+    assert parallel == serial
+    assert list(parallel[1].keys()) == list(range(2, 60, 3))
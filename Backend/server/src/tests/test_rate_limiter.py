@@ -0,0 +1,83 @@
+import pytest
+import src.ai.rate_limiter as limiter
+
+# Test the token bucket rate limiter on a fake clock
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_bucket_bursts_then_meters():
+    clock = _Clock()
+    bucket = limiter.TokenBucket(60, burstSeconds=5, clock=clock)
+
+    # 60 per minute is one per second, with a burst of 5
+    assert [bucket.reserve(1) for _ in range(5)] == [0.0] * 5
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    # Later callers queue behind earlier ones
+    assert bucket.reserve(1) == pytest.approx(2.0)
+
+    clock.now = 10.0
+    assert bucket.reserve(1) == 0.0
+
+def test_request_waits_for_both_budgets():
+    clock = _Clock()
+    rate = limiter.RateLimiter(rpm=600, tpm=6000, clock=clock)
+
+    # Plenty of requests left, but the tokens run out first
+    assert rate.reserve(1000) == 0.0
+    assert rate.reserve(1000) == pytest.approx(10.0)
+    assert rate.get_stats()['throttled'] == 1
+
+def test_settle_returns_unused_tokens():
+    clock = _Clock()
+    rate = limiter.RateLimiter(rpm=600, tpm=6000, clock=clock)
+
+    rate.reserve(1000)
+    rate.settle(1000, 200)
+    assert rate.tokens.available() == pytest.approx(800)
+    # The bucket never holds more than its capacity
+    rate.settle(1000, 0)
+    assert rate.tokens.available() == pytest.approx(1000)
+
+def test_estimate_counts_prompt_and_completion_budget():
+    request = {
+        "messages": [{"role": "system", "content": "a" * 400}, {"role": "user", "content": "b" * 41}],
+        "max_tokens": 800
+    }
+
+    assert limiter.estimate_tokens(request) == (4 + 100) + (4 + 11) + 800
+
+def test_limits_are_per_api_key():
+    limiter.reset()
+    try:
+        limiter.configure('key-a', rpm=6, tpm=100000)
+        limiter.configure(None, rpm=600, tpm=100000)
+
+        assert limiter.get_limiter('key-a').requests.rate == pytest.approx(0.1)
+        assert limiter.get_limiter('key-b').requests.rate == pytest.approx(10)
+    finally:
+        limiter.reset()
+        limiter.configure(None, 500, 200000)
+
+def test_failed_calls_give_their_tokens_back():
+    limiter.reset()
+    try:
+        limiter.configure('key-f', rpm=600, tpm=6000)
+        request = {"messages": [], "max_tokens": 500}
+        def fail():
+            raise TimeoutError("request timed out")
+        for _ in range(3):
+            with pytest.raises(TimeoutError):
+                limiter.call('key-f', request, fail)
+
+        rate = limiter.get_limiter('key-f')
+        assert rate.tokens.available() == pytest.approx(1000)
+        assert rate.get_stats()['released_tokens'] == 1500
+        # The requests were still sent, so they still count
+        assert rate.requests.available() == pytest.approx(97, abs=0.1)
+    finally:
+        limiter.reset()
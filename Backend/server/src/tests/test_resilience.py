@@ -0,0 +1,116 @@
+import time
+import httpx
+import openai
+import pytest
+import src.ai.resilience as resilience
+import src.metrics as metrics
+
+# Test the retry and circuit breaker layer around AI calls with fake requests
+
+_REQUEST = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+
+def _status_error(cls, code, headers=None):
+    return cls("error", response=httpx.Response(code, request=_REQUEST, headers=headers), body=None)
+
+@pytest.fixture(autouse=True)
+def fast_retries():
+    resilience.reset()
+    resilience.configure(maxAttempts=4, baseDelay=0.001, maxDelay=0.01, deadline=5, failureThreshold=3, resetTimeout=0.2)
+    yield
+    resilience.reset()
+    resilience.configure(maxAttempts=4, baseDelay=1.0, maxDelay=30.0, deadline=180.0, failureThreshold=5, resetTimeout=30.0)
+
+def _flaky(errors, result='ok'):
+    calls = []
+    def send(timeout):
+        calls.append(timeout)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return send, calls
+
+def test_errors_are_classified():
+    assert resilience.classify(_status_error(openai.RateLimitError, 429)) == 'rate_limited'
+    assert resilience.classify(_status_error(openai.InternalServerError, 503)) == 'server_error'
+    assert resilience.classify(openai.APITimeoutError(_REQUEST)) == 'timeout'
+    assert resilience.classify(openai.APIConnectionError(request=_REQUEST)) == 'connection'
+    assert resilience.classify(_status_error(openai.BadRequestError, 400)) is None
+
+def test_transient_errors_are_retried():
+    send, calls = _flaky([_status_error(openai.RateLimitError, 429), _status_error(openai.InternalServerError, 500)])
+
+    assert resilience.call(send) == 'ok'
+    assert len(calls) == 3
+    stats = resilience.get_metrics()
+    assert (stats['retries_rate_limited'], stats['retries_server_error']) == (1, 1)
+    assert stats['circuit_state'] == resilience.CLOSED
+
+def test_bad_requests_fail_straight_away():
+    send, calls = _flaky([_status_error(openai.BadRequestError, 400)])
+
+    with pytest.raises(openai.BadRequestError):
+        resilience.call(send)
+    assert len(calls) == 1
+
+def test_retry_after_is_honoured():
+    error = _status_error(openai.RateLimitError, 429, {'retry-after': '0.005'})
+
+    assert resilience.backoff(0, error) >= 0.005
+
+def test_call_gives_up_at_its_deadline():
+    resilience.configure(baseDelay=10, maxDelay=10, deadline=0.5)
+    send, calls = _flaky([_status_error(openai.RateLimitError, 429, {'retry-after': '10'})])
+
+    with pytest.raises(openai.RateLimitError):
+        resilience.call(send)
+    assert len(calls) == 1
+    assert resilience.get_metrics()['deadline_exceeded'] == 1
+
+def test_circuit_opens_then_recovers_through_a_probe():
+    resilience.configure(maxAttempts=1)
+    failing, _ = _flaky([_status_error(openai.InternalServerError, 502)] * 3)
+    for _ in range(3):
+        with pytest.raises(openai.InternalServerError):
+            resilience.call(failing)
+
+    # Open, requests are rejected without being sent
+    send, calls = _flaky([])
+    with pytest.raises(resilience.CircuitOpenError):
+        resilience.call(send)
+    assert calls == []
+    assert resilience.wait_time() > 0
+
+    # After the reset timeout a probe goes through and closes the circuit
+    time.sleep(0.25)
+    assert resilience.call(send) == 'ok'
+    stats = resilience.get_metrics()
+    assert (stats['circuit_opened'], stats['circuit_half_opened'], stats['circuit_closed']) == (1, 1, 1)
+    assert stats['rejected'] == 1
+
+def test_failed_probe_reopens_the_circuit():
+    resilience.configure(maxAttempts=1, failureThreshold=1, resetTimeout=0.05)
+    failing, _ = _flaky([_status_error(openai.InternalServerError, 500)] * 2)
+    with pytest.raises(openai.InternalServerError):
+        resilience.call(failing)
+
+    time.sleep(0.1)
+    with pytest.raises(openai.InternalServerError):
+        resilience.call(failing)
+    assert resilience.get_metrics()['circuit_opened'] == 2
+    assert resilience.get_state() == resilience.OPEN
+
+def test_retries_give_ups_and_transitions_are_exported():
+    resilience.configure(maxAttempts=2, failureThreshold=2)
+    retries, giveUps = resilience._retries.get(kind='server_error'), resilience._giveUps.get(reason='attempts')
+    opened = resilience._transitions.get(state=resilience.OPEN)
+    failing, _ = _flaky([_status_error(openai.InternalServerError, 500)] * 2)
+
+    with pytest.raises(openai.InternalServerError):
+        resilience.call(failing)
+
+    assert resilience._retries.get(kind='server_error') == retries + 1
+    assert resilience._giveUps.get(reason='attempts') == giveUps + 1
+    assert resilience._transitions.get(state=resilience.OPEN) == opened + 1
+    text = metrics.render()
+    assert '# TYPE ai_retries_total counter' in text
+    assert 'ai_circuit_state{state="open"} 1' in text and 'ai_circuit_state{state="closed"} 0' in text
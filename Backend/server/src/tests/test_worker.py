@@ -0,0 +1,62 @@
+import signal
+import pytest
+import src.job_subsystem as js
+import src.worker as worker
+
+# Test the worker process entry point, with the app & job subsystem replaced by fakes
+
+def test_only_given_arguments_override_the_config():
+    args = worker.parse_args(['--workers', '4', '--poll-rate', '0.5'])
+
+    assert (args.workers, args.poll_rate, args.ai_concurrency, args.pdf_workers) == (4, 0.5, None, None)
+    assert worker.config_from_args(args) == { 'JOB_RUN_WORKERS' : True, 'JOB_QUEUE_BACKEND' : 'database',
+                                              'JOB_WORKER_COUNT' : 4, 'JOB_POLL_SECONDS' : 0.5 }
+
+def test_worker_always_uses_the_database_queue():
+    config = worker.config_from_args(worker.parse_args(['--ai-concurrency', '8', '--pdf-workers', '2']))
+
+    assert config == { 'JOB_RUN_WORKERS' : True, 'JOB_QUEUE_BACKEND' : 'database',
+                       'OPENAI_MAX_CONCURRENCY' : 8, 'PDF_PARALLEL_WORKERS' : 2 }
+
+class _FakeApp:
+    def __init__(self, config):
+        self.config = { 'JOB_WORKER_COUNT' : 2, **config }
+
+@pytest.fixture
+def stopped(monkeypatch):
+    stopped = []
+    monkeypatch.setattr(js, 'shutdown', lambda save=True: stopped.append(('jobs', save)))
+    monkeypatch.setattr(worker.ptt, 'shutdown_pool', lambda: stopped.append(('pdf', None)))
+    monkeypatch.setattr(worker.aiengine, 'shutdown', lambda: stopped.append(('ai', None)))
+    return stopped
+
+def _start(monkeypatch, running, status):
+    configs = []
+    def create_app(config):
+        configs.append(config)
+        monkeypatch.setattr(js, '_jobSubsystemRunning', running)
+        monkeypatch.setattr(js, '_jobSubsystemState', status)
+        return _FakeApp(config)
+    monkeypatch.setattr(worker, 'create_app', create_app)
+    return configs
+
+def test_idle_worker_runs_until_signalled(monkeypatch, stopped):
+    # An empty queue leaves the status at NO_JOBS, which is no reason to exit
+    configs = _start(monkeypatch, True, js.SubsystemStatus.NO_JOBS)
+    handlers = {}
+    def on_signal(signum, handler):
+        handlers[signum] = handler
+        handler(signum, None)       # Signalled straight away, so main doesn't wait
+    monkeypatch.setattr(signal, 'signal', on_signal)
+
+    assert worker.main(['--workers', '3']) == 0
+    assert configs[0]['JOB_WORKER_COUNT'] == 3
+    assert set(handlers) == {signal.SIGTERM, signal.SIGINT}
+    assert stopped == [('jobs', False), ('pdf', None), ('ai', None)]
+
+def test_worker_which_failed_to_start_shuts_down(monkeypatch, stopped):
+    _start(monkeypatch, False, js.SubsystemStatus.NOT_INITIALISED)
+    monkeypatch.setattr(signal, 'signal', lambda signum, handler: pytest.fail("Signal handlers installed"))
+
+    assert worker.main([]) == 1
+    assert stopped == [('jobs', False), ('pdf', None), ('ai', None)]
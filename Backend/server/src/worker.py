@@ -0,0 +1,73 @@
+# Job Worker
+#
+# Runs the job subsystem workers in a process of their own, separate from the
+# web server. The web server is started with JOB_RUN_WORKERS=false so it only
+# enqueues jobs into the database queue; any number of these processes then
+# claim and run them.
+#
+# Usage: python -m src.worker [--workers N] [--ai-concurrency N] [--pdf-workers N] [--poll-rate S]
+# Anything not given on the command line is read from the environment as usual.
+
+import argparse
+import signal
+import sys
+from threading import Event
+
+import src.job_subsystem as js
+import src.ai.async_engine as aiengine
+import src.ai.pdf_to_text as ptt
+from src.main import create_app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.worker', description='Runs queued generation jobs.')
+    parser.add_argument('--workers', type=int, help='Number of worker threads (JOB_WORKER_COUNT)')
+    parser.add_argument('--ai-concurrency', type=int, help='Maximum OpenAI requests in flight (OPENAI_MAX_CONCURRENCY)')
+    parser.add_argument('--pdf-workers', type=int, help='Processes used to extract large PDFs (PDF_PARALLEL_WORKERS)')
+    parser.add_argument('--poll-rate', type=float, help='Seconds between idle workers checking the queue (JOB_POLL_SECONDS)')
+    return parser.parse_args(argv)
+
+def config_from_args(args)->dict:
+    """The app config overrides for a worker process, the queue has to be the shared database one."""
+    config = { 'JOB_RUN_WORKERS' : True, 'JOB_QUEUE_BACKEND' : 'database' }
+    if args.workers is not None:
+        config['JOB_WORKER_COUNT'] = args.workers
+    if args.ai_concurrency is not None:
+        config['OPENAI_MAX_CONCURRENCY'] = args.ai_concurrency
+    if args.pdf_workers is not None:
+        config['PDF_PARALLEL_WORKERS'] = args.pdf_workers
+    if args.poll_rate is not None:
+        config['JOB_POLL_SECONDS'] = args.poll_rate
+    return config
+
+def _stop():
+    # Jobs still queued stay in the database for the other workers, running ones are allowed to finish
+    js.shutdown(False)
+    ptt.shutdown_pool()
+    aiengine.shutdown()
+
+def main(argv=None)->int:
+    args = parse_args(argv)
+    app = create_app(config_from_args(args))
+    # Not the status, which is NO_JOBS whenever a healthy worker finds the queue empty
+    if not js.is_running():
+        print("Job subsystem failed to start")
+        _stop()
+        return 1
+
+    stop = Event()
+    def _on_signal(signum, frame):
+        print(f"Received signal {signum}, finishing running jobs...")
+        stop.set()
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    print(f"Worker running {app.config['JOB_WORKER_COUNT']} job threads")
+    while not stop.wait(1):
+        pass
+
+    _stop()
+    print("Worker stopped")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
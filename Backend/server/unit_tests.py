@@ -60,7 +60,7 @@ class Test_Job_Subsystem(unittest.TestCase):
 
     def test_running(self):
         js.initialise(0, 1)
-        self.assertEqual(js._threadObj.is_alive(), True)
+        self.assertEqual(js._workerThreads[0].is_alive(), True)
         
     def test_no_job_status(self):
         js.initialise(0.1, 1)
@@ -71,13 +71,13 @@ class Test_Job_Subsystem(unittest.TestCase):
     def test_add_job_1(self):
         js.initialise(0.25, 1)
         ret,jID = js.submit_new_job(0)
-        self.assertEqual(len(js._jobQueue), 1)
+        self.assertEqual(js._jobQueue.qsize(), 1)
 
     def test_add_job_2(self):
         js.initialise(3, 1)
         js.submit_new_job(0)
         js.submit_new_job(0)
-        self.assertEqual(len(js._jobQueue), 2)
+        self.assertEqual(js._jobQueue.qsize(), 2)
 
     def test_shutdown_1(self):
         js.initialise(0.1, 1)
@@ -88,7 +88,7 @@ class Test_Job_Subsystem(unittest.TestCase):
     def test_shutdown_2(self):
         js.initialise(0.1, 1)
         js.shutdown()
-        self.assertEqual(js._threadObj, None)
+        self.assertEqual(js._workerThreads, [])
 
     def test_shutdown_restart_1(self):
         js.initialise(1, 1)
@@ -96,12 +96,12 @@ class Test_Job_Subsystem(unittest.TestCase):
         sleep(0.1)
         for i in range(0, 4):
             js.submit_new_job(i)
-        self.assertEqual(len(js._jobQueue), 4)       # 4 jobs submitted
+        self.assertEqual(js._jobQueue.qsize(), 4)       # 4 jobs submitted
         js.debug_destroy_waiting()
         js.shutdown(True)
         self.assertEqual(js._jobQueue, None)         # Shutdown occurred properly
         js.initialise(1, 1, True)
-        self.assertEqual(len(js._jobQueue), 4)       # should still have 4 jobs
+        self.assertEqual(js._jobQueue.qsize(), 4)       # should still have 4 jobs
         self.assertEqual(js._globalJobCounter, 4)    # should keep the ID at 4
 
 if __name__== '__main__':